@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright MonetDB Solutions B.V. 2018-2019
+"""Benchmark of every endpoint against a synthetic trace database.
+
+The application built by ``create_app`` is driven through the falcon
+test client, against a database generated by ``synthetic_db.py`` (or
+an existing one). Every route is requested a number of times and the
+latency percentiles, and the peak memory allocated while serving it,
+are reported. The response cache is disabled unless ``--cache`` is
+given, so that every request reaches the database.
+
+Trace uploads are not benchmarked: they go through the trace parser of
+the embedded database, which the SQLite stand-in does not provide.
+
+Usage::
+
+    python benchmarks/bench_endpoints.py --instructions 1000 100000 1000000
+    python benchmarks/bench_endpoints.py --database synthetic.sqlite --requests 50
+"""
+import argparse
+import json
+import os
+import time
+import tracemalloc
+
+from falcon import testing
+import numpy as np
+
+from marvin_backend import cache, metrics
+from marvin_backend.marvin_backend import create_app
+
+from synthetic_db import SQLiteManager, generate
+
+
+def routes(dbm):
+    """The requests to benchmark: a name, the method, the path, the
+    query string and the body."""
+    qid = int(dbm.execute_query("SELECT max(query_id) / 2 AS qid FROM query")['qid'][0])
+    root = dbm.execute_query("SELECT root_execution_id FROM query WHERE query_id=%(qid)s", {'qid': qid})
+    eid = int(root['root_execution_id'][0])
+    sessions = dbm.execute_query("SELECT DISTINCT server_session FROM heartbeat")
+    sid = str(sessions['server_session'][0])
+    span = dbm.execute_query("SELECT min(ctime) AS start_t, max(ctime) AS end_t FROM heartbeat")
+    hour = 3600 * 1000000
+    start_t = int(span['start_t'][0]) // hour * hour
+    end_t = int(span['end_t'][0]) // hour * hour + hour
+    label = json.dumps({'label': 'benchmark'})
+    sql = json.dumps({'query': "SELECT count(*) AS instructions FROM instructions WHERE mal_execution_id=%(eid)s",
+                      'params': {'eid': eid}})
+
+    return [
+        ('queries', 'GET', '/queries', '', None),
+        ('queries columnar', 'GET', '/queries', 'layout=columnar&limit=1000', None),
+        ('query', 'GET', '/queries/{}'.format(qid), '', None),
+        ('label query', 'PATCH', '/queries/{}'.format(qid), '', label),
+        ('query executions', 'GET', '/queries/{}/executions'.format(qid), '', None),
+        ('query load', 'GET', '/queries/{}/load'.format(qid), '', None),
+        ('executions', 'GET', '/executions', '', None),
+        ('execution', 'GET', '/executions/{}'.format(eid), '', None),
+        ('execution statements', 'GET', '/executions/{}/statements'.format(eid), '', None),
+        ('heartbeats', 'GET', '/heartbeats', '', None),
+        ('server heartbeats', 'GET', '/heartbeats/{}'.format(sid), '', None),
+        ('cpuload', 'GET', '/cpuload/{}'.format(sid), '', None),
+        ('cpuload bucket', 'GET', '/cpuload/{}'.format(sid),
+         'from={}&to={}&bucket=60000000'.format(start_t, end_t), None),
+        ('cpuload max_points', 'GET', '/cpuload/{}'.format(sid), 'max_points=100', None),
+        ('developer query', 'PUT', '/developer/query', '', sql),
+        ('cache stats', 'GET', '/developer/cache', '', None),
+        ('metrics', 'GET', '/metrics', '', None),
+    ]
+
+
+def run(client, method, path, query_string, body, requests):
+    """Request a route repeatedly.
+
+    Returns:
+        The latencies in milliseconds, the peak memory allocated in
+        bytes, and the status of the last response
+    """
+    # Warm up
+    response = client.simulate_request(method, path, query_string=query_string, body=body)
+
+    latencies = list()
+    tracemalloc.clear_traces()
+    for _ in range(requests):
+        start = time.perf_counter()
+        response = client.simulate_request(method, path, query_string=query_string, body=body)
+        latencies.append((time.perf_counter() - start) * 1000)
+    peak = tracemalloc.get_traced_memory()[1]
+
+    return latencies, peak, response.status
+
+
+def benchmark(dbm, requests, cache_bytes):
+    app = create_app(dbm, cache_bytes=cache_bytes, slow_query_seconds=None)
+    client = testing.TestClient(app)
+
+    print("{:<22} {:>8} {:>10} {:>10} {:>10} {:>12}  {}".format(
+        'route', 'requests', 'p50 (ms)', 'p90 (ms)', 'p99 (ms)', 'peak (KiB)', 'status'))
+    for name, method, path, query_string, body in routes(dbm):
+        latencies, peak, status = run(client, method, path, query_string, body, requests)
+        p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+        print("{:<22} {:>8} {:>10.2f} {:>10.2f} {:>10.2f} {:>12.0f}  {}".format(
+            name, requests, p50, p90, p99, peak / 1024, status))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--instructions', type=float, nargs='+', default=[1e3, 1e5],
+                        help='Sizes of the synthetic databases, in instructions (1e3 to 1e7)')
+    parser.add_argument('--database',
+                        help='Benchmark an existing database created by synthetic_db.py instead')
+    parser.add_argument('--requests', type=int, default=20,
+                        help='Number of requests per route')
+    parser.add_argument('--cache', action='store_true',
+                        help='Enable the response cache')
+    arguments = parser.parse_args()
+
+    cache_bytes = cache.DEFAULT_MAX_BYTES if arguments.cache else 0
+    tracemalloc.start()
+
+    if arguments.database is not None:
+        if not os.path.exists(arguments.database):
+            parser.error("{} does not exist".format(arguments.database))
+        print("Database {}".format(arguments.database))
+        benchmark(SQLiteManager(arguments.database), arguments.requests, cache_bytes)
+        return
+
+    for instructions in arguments.instructions:
+        dbm = SQLiteManager()
+        start = time.perf_counter()
+        # Not traced, the generator allocates much more than the endpoints
+        tracemalloc.stop()
+        counts = generate(dbm, int(instructions))
+        tracemalloc.start()
+        print("\n{} instructions, {} queries, {} heartbeats (generated in {:.1f} s)".format(
+            counts['instructions'], counts['query'], counts['heartbeat'], time.perf_counter() - start))
+        benchmark(dbm, arguments.requests, cache_bytes)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright MonetDB Solutions B.V. 2018-2019
+"""Scaling benchmark of the execution graph traversal.
+
+Synthetic ``initiates_executions`` relations are built as forests of
+queries: every query has a root execution that initiates a tree of
+remote executions with the given fan-out. The traversal of one query
+is timed with the indexed :class:`marvin_backend.utils.SimpleGraph`
+and with the edge-scanning search it replaced.
+
+Usage::
+
+    python benchmarks/bench_graph.py --edges 1000 10000 100000
+"""
+import argparse
+from collections import deque
+import time
+
+import numpy as np
+
+from marvin_backend import utils
+
+
+def edge_scan_bfs(edges, start_node):
+    """The traversal used before the adjacency index was introduced."""
+    ret = list()
+    q = deque()
+    q.append(start_node)
+
+    while len(q) != 0:
+        n = q.popleft()
+        ret.append(n)
+        neighbors = [e[1] for e in edges if e[0] == n and e[1] not in ret]
+        q.extend(neighbors)
+
+    return ret
+
+
+def execution_forest(edge_count, query_size, fanout, seed=0):
+    """Edges of a forest of execution trees, in random order.
+
+    Returns:
+        The parent ids, the child ids and the root of one of the trees.
+    """
+    rng = np.random.RandomState(seed)
+    parents = list()
+    children = list()
+    next_id = 1
+    roots = list()
+    while len(parents) < edge_count:
+        root = next_id
+        roots.append(root)
+        next_id += 1
+        frontier = [root]
+        nodes = 1
+        while frontier and nodes < query_size:
+            parent = frontier.pop(0)
+            for _ in range(fanout):
+                if nodes >= query_size:
+                    break
+                parents.append(parent)
+                children.append(next_id)
+                frontier.append(next_id)
+                next_id += 1
+                nodes += 1
+
+    order = rng.permutation(len(parents))
+    return (np.array(parents, dtype=np.int64)[order],
+            np.array(children, dtype=np.int64)[order],
+            roots[len(roots) // 2])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--edges', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='Sizes of the initiates_executions relation')
+    parser.add_argument('--query-size', type=int, default=200,
+                        help='Number of executions of every query')
+    parser.add_argument('--fanout', type=int, default=8,
+                        help='Number of executions initiated by every execution')
+    parser.add_argument('--max-scan-edges', type=int, default=100000,
+                        help='Skip the edge scanning search above this size')
+    arguments = parser.parse_args()
+
+    print("{:>10} {:>10} {:>14} {:>14} {:>14}".format('edges', 'visited', 'build (ms)', 'indexed (ms)', 'scan (ms)'))
+    for edge_count in arguments.edges:
+        parents, children, root = execution_forest(edge_count, arguments.query_size, arguments.fanout)
+
+        start = time.perf_counter()
+        graph = utils.SimpleGraph(parents, children)
+        build = time.perf_counter() - start
+
+        start = time.perf_counter()
+        visited = graph.bfs(root)
+        indexed = time.perf_counter() - start
+
+        scan = float('nan')
+        if edge_count <= arguments.max_scan_edges:
+            edges = list(zip(parents, children))
+            start = time.perf_counter()
+            edge_scan_bfs(edges, root)
+            scan = time.perf_counter() - start
+
+        print("{:>10} {:>10} {:>14.2f} {:>14.2f} {:>14.2f}".format(
+            edge_count, len(visited), build * 1000, indexed * 1000, scan * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright MonetDB Solutions B.V. 2018-2019
+"""Benchmark of the consolidation of execution timelines.
+
+Random execution intervals are merged with
+:class:`marvin_backend.intervals.IntervalSet` and with the list based
+sweep that ``QueryLoad`` used before it.
+
+Usage::
+
+    python benchmarks/bench_intervals.py --intervals 1000 10000 100000
+"""
+import argparse
+import time
+
+import numpy as np
+
+from marvin_backend.intervals import IntervalSet
+
+
+def list_sweep(raw_intervals):
+    """The consolidation previously done in QueryLoad.on_get."""
+    raw_intervals.sort(key=lambda x: x[0])
+    current_interval = raw_intervals.pop(0)
+    intervals = list()
+
+    while raw_intervals:
+        interval_iterator = raw_intervals.pop(0)
+        if current_interval[1] < interval_iterator[0]:
+            intervals.append(current_interval)
+            current_interval = interval_iterator
+        elif interval_iterator[0] < current_interval[1]:
+            current_interval[1] = interval_iterator[1]
+
+    intervals.append(current_interval)
+    return intervals
+
+
+def random_executions(count, seed=0):
+    rng = np.random.RandomState(seed)
+    starts = rng.randint(0, 100 * count, count).astype(np.int64)
+    ends = starts + rng.exponential(50, count).astype(np.int64)
+    return starts, ends
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--intervals', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='Numbers of intervals to merge')
+    parser.add_argument('--max-sweep-intervals', type=int, default=100000,
+                        help='Skip the list based sweep above this size')
+    arguments = parser.parse_args()
+
+    print("{:>10} {:>10} {:>16} {:>16}".format('intervals', 'merged', 'IntervalSet (ms)', 'list sweep (ms)'))
+    for count in arguments.intervals:
+        starts, ends = random_executions(count)
+
+        start = time.perf_counter()
+        merged = IntervalSet(starts, ends)
+        vectorized = time.perf_counter() - start
+
+        sweep = float('nan')
+        if count <= arguments.max_sweep_intervals:
+            pairs = [[s, e] for s, e in zip(starts.tolist(), ends.tolist())]
+            start = time.perf_counter()
+            list_sweep(pairs)
+            sweep = time.perf_counter() - start
+
+        print("{:>10} {:>10} {:>16.2f} {:>16.2f}".format(count, len(merged), vectorized * 1000, sweep * 1000))
+
+
+if __name__ == '__main__':
+    main()
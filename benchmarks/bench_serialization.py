@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright MonetDB Solutions B.V. 2018-2019
+"""Micro-benchmark of the JSON encoding of query results.
+
+The results have the shape of the ones returned by
+``/executions/{eid}/statements``. The legacy encoding (``DLtoLD`` and
+``NumpyJSONEncoder``) is compared against the column-at-a-time
+encoding of :mod:`marvin_backend.serialization`, for every available
+JSON backend.
+
+Usage::
+
+    python benchmarks/bench_serialization.py --rows 10000 100000
+"""
+import argparse
+import json
+import timeit
+
+import numpy as np
+
+from marvin_backend import serialization
+from marvin_backend.utils import DLtoLD, NumpyJSONEncoder
+
+
+def statements_result(rows, seed=0):
+    """A result with the columns of the ``instructions`` view."""
+    rng = np.random.RandomState(seed)
+    start = np.cumsum(rng.randint(0, 50, rows)).astype(np.int64)
+    duration = rng.randint(0, 1000, rows).astype(np.int64)
+    modules = np.array(['algebra', 'bat', 'group', 'aggr', 'sql'], dtype=object)
+    instructions = np.array(['select', 'thetaselect', 'projection', 'subsum', 'bind'], dtype=object)
+    module_idx = rng.randint(0, len(modules), rows)
+    instruction_idx = rng.randint(0, len(instructions), rows)
+
+    return {
+        'pc': np.arange(rows, dtype=np.int32),
+        'short_statement': np.array(['X_{0}:=algebra.select(X_{1}, C_{1})'.format(i, i - 1) for i in range(rows)], dtype=object),
+        'start_time': start,
+        'end_time': start + duration,
+        'duration': duration,
+        'thread': rng.randint(0, 16, rows).astype(np.int32),
+        'mal_execution_id': np.ones(rows, dtype=np.int64),
+        'start_event_id': np.arange(0, 2 * rows, 2, dtype=np.int64),
+        'end_event_id': np.arange(1, 2 * rows + 1, 2, dtype=np.int64),
+        'mal_module': modules[module_idx],
+        'instruction': instructions[instruction_idx],
+    }
+
+
+def legacy_encoding(links, dl):
+    result = DLtoLD(dl)
+    doc = {
+        'links': links,
+        'data': result,
+        'data_length': len(result),
+    }
+    return json.dumps(doc, ensure_ascii=False, cls=NumpyJSONEncoder).encode('utf-8')
+
+
+def rows_encoding(links, dl):
+    return serialization.dumps(serialization.rows_document(links, dl))
+
+
+def columnar_encoding(links, dl):
+    return serialization.dumps(serialization.columnar_document(links, dl))
+
+
+def best_time(func, repeat):
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='Result sizes to benchmark')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Number of repetitions, the best one is reported')
+    arguments = parser.parse_args()
+
+    links = {'url': 'http://localhost:8000/executions/1/statements'}
+    print("{:>10} {:<24} {:>14} {:>9}".format('rows', 'encoding', 'rows/sec', 'speedup'))
+    for rows in arguments.rows:
+        dl = statements_result(rows)
+        baseline = best_time(lambda: legacy_encoding(links, dl), arguments.repeat)
+        print("{:>10} {:<24} {:>14,.0f} {:>8.2f}x".format(rows, 'legacy', rows / baseline, 1.0))
+
+        for backend in sorted(serialization.JSON_BACKENDS):
+            serialization.set_json_backend(backend)
+            for name, encoding in [('rows', rows_encoding), ('columnar', columnar_encoding)]:
+                elapsed = best_time(lambda: encoding(links, dl), arguments.repeat)
+                label = '{} ({})'.format(name, backend)
+                print("{:>10} {:<24} {:>14,.0f} {:>8.2f}x".format(rows, label, rows / elapsed, baseline / elapsed))
+        serialization.set_json_backend('json')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright MonetDB Solutions B.V. 2018-2019
+"""Load test of a running server.
+
+Concurrent clients request the given paths in a loop for a fixed time,
+and the throughput and latency percentiles are reported. Run it against
+servers started with different numbers of workers to see how the
+throughput scales now that every worker opens its own database
+manager.
+
+Usage::
+
+    marvin_backend -d /path/to/db -w 4 &
+    python benchmarks/load_test.py --url http://127.0.0.1:8000 \\
+        --paths /queries /heartbeats --clients 16 --duration 30
+"""
+import argparse
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import numpy as np
+
+
+def client_loop(base_url, paths, deadline, latencies, errors):
+    index = 0
+    while time.perf_counter() < deadline:
+        url = base_url + paths[index % len(paths)]
+        index += 1
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(url) as response:
+                response.read()
+        except (urllib.error.URLError, OSError):
+            errors.append(url)
+            continue
+        latencies.append(time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default='http://127.0.0.1:8000',
+                        help='Base URL of the server')
+    parser.add_argument('--paths', nargs='+', default=['/queries'],
+                        help='Paths requested in turn by every client')
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 4, 16],
+                        help='Numbers of concurrent clients')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='Duration of every run, in seconds')
+    arguments = parser.parse_args()
+
+    print("{:>8} {:>10} {:>8} {:>10} {:>10} {:>10}".format(
+        'clients', 'requests', 'errors', 'req/s', 'p50 (ms)', 'p99 (ms)'))
+    for clients in arguments.clients:
+        latencies = list()
+        errors = list()
+        deadline = time.perf_counter() + arguments.duration
+        threads = [threading.Thread(target=client_loop,
+                                    args=(arguments.url.rstrip('/'), arguments.paths, deadline, latencies, errors))
+                   for _ in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        p50, p99 = np.percentile(latencies, [50, 99]) * 1000 if latencies else (float('nan'),) * 2
+        print("{:>8} {:>10} {:>8} {:>10.1f} {:>10.2f} {:>10.2f}".format(
+            clients, len(latencies), len(errors), len(latencies) / arguments.duration, p50, p99))
+
+
+if __name__ == '__main__':
+    main()
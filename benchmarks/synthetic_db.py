@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright MonetDB Solutions B.V. 2018-2019
+"""A synthetic trace database for the benchmarks.
+
+The tables read by the endpoints (``query``, ``mal_execution``,
+``initiates_executions``, ``instructions``, ``heartbeat`` and
+``cpuload``) are filled with random data of a given scale, shaped like
+real traces: every query has a root execution that initiates remote
+executions on other servers, the instructions of an execution run
+within its lifetime, and every server sends a heartbeat with the load
+of each core at regular intervals. The derived tables are then filled
+by the maintenance tasks.
+
+The data is stored in SQLite, behind :class:`SQLiteManager`, a stand-in
+for the ``mal_analytics`` database manager, so that the benchmarks run
+without MonetDBLite. Only the benchmarks use it.
+
+Usage::
+
+    python benchmarks/synthetic_db.py --instructions 1000000 --output synthetic.sqlite
+"""
+import argparse
+import logging
+import re
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from marvin_backend import closures, rollups
+
+LOGGER = logging.getLogger(__name__)
+
+SCHEMA = [
+    """CREATE TABLE mal_execution (
+        execution_id bigint PRIMARY KEY,
+        server_session char(36) NOT NULL,
+        tag int NOT NULL,
+        server_version char(120),
+        user_function char(30)
+    )""",
+    """CREATE TABLE query (
+        query_id bigint PRIMARY KEY,
+        query_text text,
+        query_label text,
+        root_execution_id bigint
+    )""",
+    """CREATE TABLE initiates_executions (
+        initiates_executions_id bigint PRIMARY KEY,
+        parent_id bigint,
+        child_id bigint,
+        remote bool NOT NULL
+    )""",
+    """CREATE TABLE instructions (
+        instruction_id bigint PRIMARY KEY,
+        mal_execution_id bigint NOT NULL,
+        pc int NOT NULL,
+        thread int,
+        astart_time bigint,
+        aend_time bigint,
+        rss int,
+        short_statement text
+    )""",
+    """CREATE TABLE heartbeat (
+        heartbeat_id bigint PRIMARY KEY,
+        server_session char(36) NOT NULL,
+        clk bigint,
+        ctime bigint,
+        rss int,
+        nvcsw int
+    )""",
+    """CREATE TABLE cpuload (
+        cpuload_id bigint PRIMARY KEY,
+        heartbeat_id bigint,
+        val decimal(3, 2)
+    )""",
+    "CREATE INDEX instructions_execution ON instructions (mal_execution_id)",
+    "CREATE INDEX initiates_parent ON initiates_executions (parent_id)",
+    "CREATE INDEX heartbeat_session ON heartbeat (server_session, ctime)",
+    "CREATE INDEX cpuload_heartbeat ON cpuload (heartbeat_id)",
+]
+
+STATEMENTS = [
+    'X_1:bat[:int] := sql.bind(X_0, "sys", "lineitem", "l_quantity", 0:int);',
+    'X_2:bat[:oid] := algebra.thetaselect(X_1, 24:int, "<");',
+    'X_3:bat[:lng] := algebra.projection(X_2, X_4);',
+    'X_5:lng := aggr.sum(X_3);',
+    'sql.resultSet(X_6, X_7, X_5);',
+]
+
+_PARAMETER = re.compile(r"%\((\w+)\)s")
+
+
+def _column(values):
+    """A numpy column, masked where the value is NULL, as returned by
+    MonetDBLite."""
+    mask = [v is None for v in values]
+    if not any(mask):
+        return np.array(values)
+
+    fill = next((v for v in values if v is not None), 0)
+    return np.ma.masked_array(np.array([fill if m else v for v, m in zip(values, mask)]), mask=mask)
+
+
+class SQLiteManager(object):
+    """The subset of the ``mal_analytics`` database manager used by the
+    endpoints, over SQLite.
+
+    Args:
+        path: The database file, or ``:memory:``
+    """
+
+    def __init__(self, path=':memory:'):
+        self._path = path
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+
+    def get_dbpath(self):
+        return self._path
+
+    def execute_query(self, query, params=None):
+        sql = _PARAMETER.sub(r':\1', query)
+        with self._lock:
+            try:
+                cursor = self._connection.execute(sql, params or {})
+                rows = cursor.fetchall()
+            except sqlite3.Error as e:
+                LOGGER.warning("query\n  %s\n with parameters\n %s failed with message: %s", query, params, e)
+                return None
+
+        if cursor.description is None:
+            return {}
+
+        names = [d[0] for d in cursor.description]
+        return dict((name, _column([row[i] for row in rows])) for i, name in enumerate(names))
+
+    def insert_data(self, table, data, block_size=100000):
+        """Insert a dictionary of columns, a block of rows at a time."""
+        names = list(data)
+        columns = [np.asarray(data[name]) for name in names]
+        sql = "INSERT INTO {} ({}) VALUES ({})".format(table, ", ".join(names), ", ".join("?" * len(names)))
+        for start in range(0, len(columns[0]), block_size):
+            block = [column[start:start + block_size].tolist() for column in columns]
+            with self._lock:
+                self._connection.executemany(sql, zip(*block))
+
+    def transaction(self):
+        self.execute_query("BEGIN")
+
+    def commit(self):
+        self.execute_query("COMMIT")
+
+    def rollback(self):
+        self.execute_query("ROLLBACK")
+
+
+def _session(rng):
+    return '{:08x}-{:04x}-{:04x}-{:04x}-{:012x}'.format(*(int(rng.randint(0, 1 << b)) for b in (32, 16, 16, 16, 48)))
+
+
+def generate(dbm, instructions, servers=4, cores=8, instructions_per_execution=100,
+             remote_executions=3, heartbeat_interval=1000000, seed=0):
+    """Fill a database with synthetic traces.
+
+    Args:
+        dbm: The :class:`SQLiteManager`
+        instructions: The number of instructions
+        servers: The number of server sessions
+        cores: The number of CPU loads of every heartbeat
+        instructions_per_execution: The average number of instructions
+            of an execution
+        remote_executions: The number of remote executions every query
+            initiates
+        heartbeat_interval: Microseconds between two heartbeats of a
+            server
+
+    Returns:
+        The number of rows of every table
+    """
+    rng = np.random.RandomState(seed)
+    dbm.transaction()
+    for statement in SCHEMA:
+        dbm.execute_query(statement)
+
+    sessions = np.array([_session(rng) for _ in range(servers)])
+    executions_per_query = remote_executions + 1
+    execution_count = max(executions_per_query, instructions // instructions_per_execution)
+    query_count = execution_count // executions_per_query
+    execution_count = query_count * executions_per_query
+
+    # The executions of a query are consecutive, its root first
+    execution_id = np.arange(1, execution_count + 1)
+    query_of = (execution_id - 1) // executions_per_query
+    session_of = np.where((execution_id - 1) % executions_per_query == 0,
+                          query_of % servers,
+                          rng.randint(0, servers, execution_count))
+
+    # Query start times, in microseconds, one every 50ms on average
+    query_start = np.cumsum(rng.exponential(50000, query_count)).astype(np.int64)
+    execution_start = query_start[query_of] + rng.randint(0, 5000, execution_count)
+
+    # The instructions of every execution, with exponential durations
+    instructions_of = rng.multinomial(instructions, np.ones(execution_count) / execution_count)
+    instruction_execution = np.repeat(execution_id, instructions_of)
+    offsets = np.arange(instructions) - np.repeat(np.cumsum(instructions_of) - instructions_of, instructions_of)
+    duration = rng.exponential(200, instructions).astype(np.int64) + 1
+    astart = execution_start[instruction_execution - 1] + offsets * 50 + rng.randint(0, 50, instructions)
+    aend = astart + duration
+
+    roots = execution_id[::executions_per_query]
+    children = np.delete(execution_id, np.arange(0, execution_count, executions_per_query))
+    parents = np.repeat(roots, remote_executions)
+
+    # Heartbeats of every server, over the whole time span
+    end_time = int(aend.max()) + heartbeat_interval
+    beats = end_time // heartbeat_interval + 1
+    heartbeat_count = beats * servers
+    heartbeat_id = np.arange(1, heartbeat_count + 1)
+    heartbeat_ctime = np.tile(np.arange(beats, dtype=np.int64) * heartbeat_interval, servers)
+
+    dbm.insert_data('mal_execution', {
+        'execution_id': execution_id,
+        'server_session': sessions[session_of],
+        'tag': execution_id,
+        'server_version': np.full(execution_count, '11.33.3'),
+        'user_function': np.full(execution_count, 'user.main'),
+    })
+    dbm.insert_data('query', {
+        'query_id': np.arange(1, query_count + 1),
+        'query_text': np.array(['select count(*) from lineitem where l_quantity < {};'.format(i)
+                                for i in range(query_count)]),
+        'query_label': np.full(query_count, 'synthetic'),
+        'root_execution_id': roots,
+    })
+    dbm.insert_data('initiates_executions', {
+        'initiates_executions_id': np.arange(1, len(children) + 1),
+        'parent_id': parents,
+        'child_id': children,
+        'remote': np.ones(len(children), dtype=np.int64),
+    })
+    dbm.insert_data('instructions', {
+        'instruction_id': np.arange(1, instructions + 1),
+        'mal_execution_id': instruction_execution,
+        'pc': offsets,
+        'thread': rng.randint(0, cores, instructions),
+        'astart_time': astart,
+        'aend_time': aend,
+        'rss': rng.randint(100, 4000, instructions),
+        'short_statement': np.array(STATEMENTS)[offsets % len(STATEMENTS)],
+    })
+    dbm.insert_data('heartbeat', {
+        'heartbeat_id': heartbeat_id,
+        'server_session': np.repeat(sessions, beats),
+        'clk': heartbeat_ctime,
+        'ctime': heartbeat_ctime,
+        'rss': rng.randint(100, 4000, heartbeat_count),
+        'nvcsw': rng.randint(0, 1000, heartbeat_count),
+    })
+    dbm.insert_data('cpuload', {
+        'cpuload_id': np.arange(1, heartbeat_count * cores + 1),
+        'heartbeat_id': np.repeat(heartbeat_id, cores),
+        'val': np.round(rng.beta(2, 5, heartbeat_count * cores), 2),
+    })
+
+    # The derived tables, as maintained on ingestion
+    execution_closures = closures.ExecutionClosures(dbm)
+    execution_closures.create_table()
+    execution_closures.backfill()
+    cpuload_rollups = rollups.CPULoadRollups(dbm)
+    cpuload_rollups.create_tables()
+    cpuload_rollups.backfill()
+    dbm.commit()
+
+    return {
+        'query': query_count,
+        'mal_execution': execution_count,
+        'initiates_executions': len(children),
+        'instructions': instructions,
+        'heartbeat': heartbeat_count,
+        'cpuload': heartbeat_count * cores,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--instructions', type=float, default=1e5,
+                        help='Number of instructions, from 1e3 to 1e7')
+    parser.add_argument('--servers', type=int, default=4,
+                        help='Number of server sessions')
+    parser.add_argument('--output', default='synthetic.sqlite',
+                        help='The database file to create')
+    arguments = parser.parse_args()
+
+    start = time.perf_counter()
+    counts = generate(SQLiteManager(arguments.output), int(arguments.instructions), servers=arguments.servers)
+    for table, count in counts.items():
+        print("{:>22} {:>12}".format(table, count))
+    print("Generated in {:.1f} s".format(time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
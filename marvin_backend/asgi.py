@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright MonetDB Solutions B.V. 2018-2019
+"""Serving the application over ASGI.
+
+A sync gunicorn worker serves one request at a time, so one slow
+request occupies a whole process. An ASGI server keeps the connections
+in an event loop instead, and :class:`WSGIBridge` runs the application,
+and with it the blocking database calls, in a bounded pool of threads.
+Idle and slow clients then only cost a coroutine, and the number of
+concurrent database calls per process is capped by the pool.
+
+The request body is read from the event loop while the application
+reads it, and the response is sent while it is produced, so uploads
+and streamed responses are not buffered.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import sys
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_MAX_WORKERS = 16
+
+
+class _ReceiveStream(object):
+    """The ``wsgi.input`` of a request, read from the ASGI ``receive``
+    callable of the event loop."""
+
+    def __init__(self, receive, loop):
+        self._receive = receive
+        self._loop = loop
+        self._buffer = b''
+        self._eof = False
+
+    def _fill(self):
+        message = asyncio.run_coroutine_threadsafe(self._receive(), self._loop).result()
+        if message['type'] == 'http.request':
+            self._buffer += message.get('body', b'')
+            self._eof = not message.get('more_body', False)
+        else:
+            # http.disconnect
+            self._eof = True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            while not self._eof:
+                self._fill()
+            size = len(self._buffer)
+
+        while len(self._buffer) < size and not self._eof:
+            self._fill()
+
+        ret, self._buffer = self._buffer[:size], self._buffer[size:]
+        return ret
+
+    def readline(self, size=-1):
+        while b'\n' not in self._buffer and not self._eof:
+            self._fill()
+
+        end = self._buffer.find(b'\n') + 1 or len(self._buffer)
+        if size is not None and 0 <= size < end:
+            end = size
+        ret, self._buffer = self._buffer[:end], self._buffer[end:]
+        return ret
+
+
+def build_environ(scope, stream):
+    """The WSGI environment of an ASGI HTTP request."""
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        # PEP 3333 strings are bytes decoded as latin-1
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/{}'.format(scope.get('http_version', '1.1')),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': stream,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+        environ['REMOTE_PORT'] = str(scope['client'][1])
+
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+        if name in environ:
+            value = environ[name] + ',' + value
+        environ[name] = value
+
+    return environ
+
+
+class WSGIBridge(object):
+    """An ASGI application running a WSGI application in threads.
+
+    Args:
+        app: The WSGI application
+        max_workers: The maximum number of requests served at once.
+            Further requests wait in the event loop.
+    """
+
+    def __init__(self, app, max_workers=DEFAULT_MAX_WORKERS):
+        self._app = app
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='marvin-asgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            raise ValueError("Unsupported ASGI scope type {}".format(scope['type']))
+
+        loop = asyncio.get_event_loop()
+        environ = build_environ(scope, _ReceiveStream(receive, loop))
+        await loop.run_in_executor(self._executor, self._serve, environ, send, loop)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await asyncio.get_event_loop().run_in_executor(None, self._executor.shutdown)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def _serve(self, environ, send, loop):
+        """Call the application, in a thread of the pool."""
+        def send_message(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        started = dict()
+
+        def start_response(status, headers, exc_info=None):
+            started.update(status=status, headers=headers)
+
+        def send_start():
+            headers = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                       for name, value in started['headers']]
+            send_message({
+                'type': 'http.response.start',
+                'status': int(started['status'].split(' ', 1)[0]),
+                'headers': headers,
+            })
+
+        result = self._app(environ, start_response)
+        try:
+            # Applications may call start_response on the first iteration
+            blocks = iter(result)
+            first = next(blocks, b'')
+            send_start()
+            if first:
+                send_message({'type': 'http.response.body', 'body': first, 'more_body': True})
+            for block in blocks:
+                if block:
+                    send_message({'type': 'http.response.body', 'body': block, 'more_body': True})
+            send_message({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright MonetDB Solutions B.V. 2018-2019
+"""A cache of encoded responses.
+
+The responses of some resources only change when the traces of the
+queries they describe are ingested (or labeled). Their encoded bodies
+are kept in a least recently used cache, bounded by the total size of
+the bodies, and tagged with the queries and server sessions they were
+computed from, so that writes only invalidate the affected entries.
+
+The cache lives in a single process. Writes made by other processes
+are noticed through the database generation, and clear the whole
+cache. A response computed while a write was made is not stored, as
+it may predate the write.
+"""
+from collections import OrderedDict, namedtuple
+import logging
+import threading
+
+import falcon
+import numpy as np
+
+from marvin_backend import serialization
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_MAX_BYTES = 64 << 20
+
+CacheEntry = namedtuple('CacheEntry', ['body', 'content_type', 'headers', 'tags'])
+
+
+def query_tag(qid):
+    return ('query', str(qid))
+
+
+def server_tag(sid):
+    return ('server', str(sid))
+
+
+class ResponseCache(object):
+    """A least recently used cache of response bodies.
+
+    Args:
+        max_bytes: The maximum total size of the cached bodies
+        generation: The :class:`marvin_backend.generations.Generation`
+            of the database, to detect writes by other processes
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, generation=None):
+        self._max_bytes = max_bytes
+        self._generation = generation
+        self._generation_seen = generation.current() if generation is not None else None
+        # Changed whenever entries are dropped because of a write
+        self._version = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._counters = dict.fromkeys(
+            ['hits', 'misses', 'stores', 'stale_stores', 'evictions', 'invalidations', 'clears'], 0)
+
+    def _check_generation(self):
+        if self._generation is None:
+            return
+
+        current = self._generation.current()
+        if current != self._generation_seen:
+            LOGGER.debug("Database generation changed to %d, clearing the response cache", current)
+            self._clear()
+            self._counters['clears'] += 1
+            self._generation_seen = current
+
+    def _clear(self):
+        self._entries.clear()
+        self._bytes = 0
+        self._version += 1
+
+    def version(self):
+        """The version of the cache, to pass to :meth:`put`.
+
+        The version changes with every write noticed by the cache.
+        """
+        with self._lock:
+            self._check_generation()
+            return self._version
+
+    def get(self, key):
+        """The entry stored under ``key``, or None."""
+        with self._lock:
+            self._check_generation()
+            entry = self._entries.get(key)
+            if entry is None:
+                self._counters['misses'] += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self._counters['hits'] += 1
+            return entry
+
+    def put(self, key, entry, version=None):
+        """Store an entry, evicting the least recently used ones.
+
+        Args:
+            key: The key of the entry
+            entry: The :class:`CacheEntry`
+            version: The :meth:`version` of the cache before the
+                response was computed. The entry is not stored if a
+                write was noticed since then.
+        """
+        size = len(entry.body)
+        if size > self._max_bytes:
+            return
+
+        with self._lock:
+            self._check_generation()
+            if version is not None and version != self._version:
+                self._counters['stale_stores'] += 1
+                return
+
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old.body)
+
+            self._entries[key] = entry
+            self._bytes += size
+            self._counters['stores'] += 1
+            while self._bytes > self._max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted.body)
+                self._counters['evictions'] += 1
+
+    def invalidate(self, tags, generation=None):
+        """Drop the entries carrying any of ``tags``.
+
+        Writes made by this process should bump the generation first,
+        and then invalidate the entries they affect, passing the
+        generation returned by the bump, so that the rest of the cache
+        survives the bump. If the generation moved further, another
+        process wrote too, and the whole cache is cleared.
+
+        Args:
+            tags: The tags of the entries affected by the write
+            generation: The generation bumped to by the write
+
+        Returns:
+            The number of entries dropped
+        """
+        tags = set(tags)
+        with self._lock:
+            if self._generation is not None:
+                if generation is None:
+                    generation = self._generation.current()
+                    previous = generation
+                else:
+                    previous = generation - 1
+
+                if previous != self._generation_seen:
+                    LOGGER.debug("Database generation changed to %d, clearing the response cache", generation)
+                    count = len(self._entries)
+                    self._clear()
+                    self._counters['clears'] += 1
+                    self._generation_seen = max(self._generation_seen, generation)
+                    return count
+                self._generation_seen = generation
+
+            keys = [k for k, e in self._entries.items() if not tags.isdisjoint(e.tags)]
+            for key in keys:
+                self._bytes -= len(self._entries.pop(key).body)
+            self._counters['invalidations'] += len(keys)
+            self._version += 1
+
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._clear()
+            self._counters['clears'] += 1
+
+    def stats(self):
+        """The counters of the cache, and its current size."""
+        with self._lock:
+            ret = dict(self._counters)
+            ret.update(entries=len(self._entries), bytes=self._bytes, max_bytes=self._max_bytes)
+
+        return ret
+
+
+class ResponseCacheMiddleware(object):
+    """Serve the responses of some resources from a :class:`ResponseCache`.
+
+    Responses are keyed by the resource, the URI parameters, the query
+    string and the requested media type. They are stored before they
+    are compressed, so this middleware must come after
+    :class:`marvin_backend.compression.CompressionMiddleware`.
+
+    Entries are tagged with the query of the ``qid`` parameter, and
+    with any tags the resource adds to ``req.context['cache_tags']``.
+
+    Args:
+        cache: The :class:`ResponseCache`
+        resources: The resources whose responses are cached. More can
+            be added with :meth:`add`.
+    """
+
+    def __init__(self, cache, resources=()):
+        self._cache = cache
+        self._resources = list(resources)
+
+    def add(self, resource):
+        """Cache the responses of ``resource``."""
+        self._resources.append(resource)
+
+    def _cacheable(self, resource):
+        return any(resource is r for r in self._resources)
+
+    def process_resource(self, req, resp, resource, params):
+        if req.method != 'GET' or not self._cacheable(resource):
+            return
+
+        key = (
+            type(resource).__name__,
+            tuple(sorted(params.items())),
+            req.query_string,
+            req.get_header('Accept') or '',
+        )
+        version = self._cache.version()
+        entry = self._cache.get(key)
+        if entry is not None:
+            headers = dict(entry.headers, **{'Content-Type': entry.content_type})
+            raise falcon.HTTPStatus(falcon.HTTP_200, headers=headers, body=entry.body)
+
+        req.context['cache_key'] = key
+        req.context['cache_version'] = version
+        req.context['cache_tags'] = [query_tag(params['qid'])] if 'qid' in params else []
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        key = req.context.get('cache_key')
+        if key is None or not req_succeeded or resp.status != falcon.HTTP_200 or resp.stream is not None:
+            return
+
+        body = resp.body
+        if body is None:
+            body = resp.data
+        if body is None:
+            return
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+
+        headers = dict((name, resp.get_header(name)) for name in ('Link',) if resp.get_header(name))
+        content_type = resp.content_type or serialization.JSON_MEDIA_TYPE
+        entry = CacheEntry(body, content_type, headers, frozenset(req.context['cache_tags']))
+        self._cache.put(key, entry, req.context['cache_version'])
+
+
+class CacheInvalidation(object):
+    """A :class:`marvin_backend.traces.Traces` hook invalidating the
+    cached responses affected by an ingested trace.
+
+    The affected queries are read from the ``query_execution`` table,
+    so this hook must run after the
+    :class:`marvin_backend.closures.ExecutionClosures` one. The hook
+    bumps the generation itself, so that the cache can tell this write
+    from writes by other processes.
+
+    Args:
+        db: The database manager
+        cache: The :class:`ResponseCache`
+        generation: The :class:`marvin_backend.generations.Generation`
+            of the database
+    """
+
+    def __init__(self, db, cache, generation=None):
+        self._db = db
+        self._cache = cache
+        self._generation = generation
+
+    def before_ingest(self):
+        limits_sql = ("SELECT (SELECT max(execution_id) FROM mal_execution) AS max_execution_id, "
+                      "(SELECT max(heartbeat_id) FROM heartbeat) AS max_heartbeat_id")
+        limits = self._db.execute_query(limits_sql)
+
+        return dict((k, _limit(limits, k)) for k in ('max_execution_id', 'max_heartbeat_id'))
+
+    def after_ingest(self, limits):
+        # Bumped first, so that the ETags change even if the affected
+        # entries cannot be found.
+        generation = self._generation.bump() if self._generation is not None else None
+
+        queries_sql = "SELECT DISTINCT query_id FROM query_execution WHERE execution_id > %(max_execution_id)s"
+        servers_sql = "SELECT DISTINCT server_session FROM heartbeat WHERE heartbeat_id > %(max_heartbeat_id)s"
+
+        tags = list()
+        result = self._db.execute_query(queries_sql, limits)
+        if result:
+            tags.extend(query_tag(qid) for qid in serialization.column_to_list(result['query_id']))
+        result = self._db.execute_query(servers_sql, limits)
+        if result:
+            tags.extend(server_tag(sid) for sid in serialization.column_to_list(result['server_session']))
+
+        count = self._cache.invalidate(tags, generation)
+        LOGGER.debug("Invalidated %d cached responses", count)
+        return count
+
+
+def _limit(limits, key):
+    # max() over an empty table is NULL
+    if not limits or len(limits[key]) == 0 or limits[key][0] is np.ma.masked:
+        return 0
+
+    return int(limits[key][0])
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright MonetDB Solutions B.V. 2018-2019
+import logging
+
+import numpy as np
+
+from marvin_backend import queries, serialization, utils
+
+LOGGER = logging.getLogger(__name__)
+
+# The executions of every query (the nodes of the execution graph
+# reachable from its root execution), in breadth first order.
+CREATE_TABLE_SQL = """CREATE TABLE IF NOT EXISTS query_execution (
+    query_id bigint NOT NULL,
+    execution_id bigint NOT NULL,
+    execution_order int NOT NULL,
+
+    CONSTRAINT pk_query_execution PRIMARY KEY (query_id, execution_id)
+)"""
+
+
+class ExecutionClosures(object):
+    """Maintain the ``query_execution`` table.
+
+    The executions of a query do not change after its traces have been
+    ingested, so instead of searching the execution graph on every
+    request we store the result of the search. The table is updated
+    after every ingested trace, for the new queries and for the
+    queries that new edges of the graph start from.
+
+    Args:
+        db: The database manager
+    """
+
+    def __init__(self, db):
+        self._db = db
+        # Used to compute the closures, so it must not read them.
+        self._query_executions = queries.QueryExecutions(db)
+
+    def create_table(self):
+        self._db.execute_query(CREATE_TABLE_SQL)
+
+    def lookup(self, qid):
+        """The stored executions of a query.
+
+        Returns:
+            A list of execution ids, or None if nothing is stored for
+            the query.
+        """
+        lookup_sql = "SELECT execution_id FROM query_execution WHERE query_id=%(qid)s ORDER BY execution_order"
+        result = self._db.execute_query(lookup_sql, {'qid': qid})
+
+        if not result or len(result['execution_id']) == 0:
+            return None
+
+        return serialization.column_to_list(result['execution_id'])
+
+    def before_ingest(self):
+        """Record the state of the database before a trace is ingested."""
+        limits_sql = ("SELECT (SELECT max(query_id) FROM query) AS max_query_id, "
+                      "(SELECT max(initiates_executions_id) FROM initiates_executions) AS max_initiates_id")
+        limits = self._db.execute_query(limits_sql)
+
+        return dict((k, _limit(limits, k)) for k in ('max_query_id', 'max_initiates_id'))
+
+    def after_ingest(self, limits):
+        """Store the closures affected by the last ingested trace.
+
+        Args:
+            limits: The result of :meth:`before_ingest`
+
+        Returns:
+            The ids of the queries whose closure was stored
+        """
+        new_queries_sql = "SELECT query_id FROM query WHERE query_id > %(max_query_id)s"
+        extended_queries_sql = ("SELECT DISTINCT query_id FROM query_execution WHERE execution_id IN "
+                                "(SELECT parent_id FROM initiates_executions WHERE initiates_executions_id > %(max_initiates_id)s)")
+
+        qids = list()
+        for sql in (new_queries_sql, extended_queries_sql):
+            result = self._db.execute_query(sql, limits)
+            if result:
+                qids.extend(serialization.column_to_list(result['query_id']))
+        qids = sorted(set(qids))
+
+        for qid in qids:
+            try:
+                execution_ids = self._query_executions.gather_executions(qid)
+            except Exception as e:
+                LOGGER.warning("Could not find the executions of query %s: %s", qid, e)
+                continue
+            self.refresh(qid, execution_ids)
+
+        LOGGER.info("Stored the executions of %d queries", len(qids))
+        return qids
+
+    def refresh(self, qid, execution_ids):
+        """Replace the stored executions of a query."""
+        self._db.execute_query("DELETE FROM query_execution WHERE query_id=%(qid)s", {'qid': qid})
+        self._db.insert_data('query_execution', {
+            'query_id': [qid] * len(execution_ids),
+            'execution_id': list(execution_ids),
+            'execution_order': list(range(len(execution_ids))),
+        })
+
+    def backfill(self):
+        """Store the executions of all the queries in the database.
+
+        This is needed for databases that were populated before the
+        ``query_execution`` table was introduced. All the edges of the
+        execution graph are loaded once, and searched for every query.
+
+        Returns:
+            The number of queries processed
+        """
+        self.create_table()
+        roots = self._db.execute_query("SELECT query_id, root_execution_id FROM query WHERE root_execution_id IS NOT NULL")
+        edges = self._db.execute_query("SELECT parent_id, child_id FROM initiates_executions ORDER BY initiates_executions_id")
+
+        graph = utils.SimpleGraph(edges['parent_id'], edges['child_id'])
+        qids = serialization.column_to_list(roots['query_id'])
+        for qid, root in zip(qids, serialization.column_to_list(roots['root_execution_id'])):
+            self.refresh(qid, graph.bfs(root))
+
+        LOGGER.info("Stored the executions of %d queries", len(qids))
+        return len(qids)
+
+
+def _limit(limits, key):
+    # max() over an empty table is NULL
+    if not limits or len(limits[key]) == 0 or limits[key][0] is np.ma.masked:
+        return 0
+
+    return int(limits[key][0])
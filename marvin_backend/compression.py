@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright MonetDB Solutions B.V. 2018-2019
+"""Compressed request and response bodies.
+
+Request bodies sent with ``Content-Encoding: gzip`` (or ``zstd``, if
+the zstandard package is installed) are decompressed while they are
+read, up to a maximum decompressed size. The length of the body is then
+unknown, so the resources must read it with
+:func:`marvin_backend.utils.read_body` rather than by its
+``Content-Length``. Responses are compressed with the best encoding the client
+accepts, if they are large enough for it to pay off.
+"""
+import logging
+import zlib
+
+import falcon
+
+try:
+    import zstandard
+except ImportError:  # pragma: no coverage
+    zstandard = None
+
+LOGGER = logging.getLogger(__name__)
+
+GZIP = 'gzip'
+ZSTD = 'zstd'
+IDENTITY = 'identity'
+
+# Responses smaller than this many bytes are sent uncompressed.
+COMPRESSION_THRESHOLD = 1024
+
+# Size of the compressed blocks read from the request
+READ_BLOCK_SIZE = 64 << 10
+
+# Decompressed request bodies larger than this are refused.
+DEFAULT_MAX_DECOMPRESSED_BYTES = 4 << 30
+
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+def _decompressor(encoding):
+    if encoding == GZIP:
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif encoding == ZSTD and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompressobj()
+
+    return None
+
+
+def _compressor(encoding):
+    if encoding == GZIP:
+        return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+
+
+def supported_encodings():
+    """The content codings understood by the server, best first."""
+    return [ZSTD, GZIP] if zstandard is not None else [GZIP]
+
+
+class DecompressingStream(object):
+    """A file-like object decompressing a request body as it is read.
+
+    Args:
+        stream: The stream of the compressed body
+        length: The length of the compressed body, or None to read
+            until the end of the stream
+        decompressor: A zlib or zstandard decompression object
+        max_bytes: The maximum size of the decompressed body. Reading
+            past it raises ``413 Payload Too Large``.
+    """
+
+    def __init__(self, stream, length, decompressor, max_bytes=DEFAULT_MAX_DECOMPRESSED_BYTES):
+        self._stream = stream
+        self._remaining = length
+        self._decompressor = decompressor
+        self._max_bytes = max_bytes
+        self._decompressed = 0
+        self._buffer = b''
+        self._eof = False
+
+    def _fill(self):
+        size = READ_BLOCK_SIZE if self._remaining is None else min(READ_BLOCK_SIZE, self._remaining)
+        block = self._stream.read(size) if size > 0 else b''
+        if not block:
+            self._eof = True
+            flush = getattr(self._decompressor, 'flush', None)
+            if flush is not None:
+                self._buffer += flush()
+            return
+
+        if self._remaining is not None:
+            self._remaining -= len(block)
+        try:
+            data = self._decompressor.decompress(block)
+        except Exception as e:
+            raise ValueError("Invalid compressed body: {}".format(e))
+
+        self._decompressed += len(data)
+        if self._decompressed > self._max_bytes:
+            raise falcon.HTTPError(falcon.HTTP_413, 'Payload too large',
+                                   'The decompressed body is larger than {} bytes.'.format(self._max_bytes))
+        self._buffer += data
+
+    def read(self, size=-1):
+        while not self._eof and (size is None or size < 0 or len(self._buffer) < size):
+            self._fill()
+
+        if size is None or size < 0:
+            size = len(self._buffer)
+        ret, self._buffer = self._buffer[:size], self._buffer[size:]
+        return ret
+
+
+def accepted_encodings(header):
+    """Parse an ``Accept-Encoding`` header.
+
+    Returns:
+        A dictionary mapping each coding to its quality value
+    """
+    ret = dict()
+    for item in (header or '').split(','):
+        parts = [p.strip() for p in item.split(';')]
+        if not parts[0]:
+            continue
+        quality = 1.0
+        for param in parts[1:]:
+            if param.startswith('q='):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        ret[parts[0].lower()] = quality
+
+    return ret
+
+
+def negotiate_encoding(header):
+    """The best supported coding accepted by a client.
+
+    Returns:
+        One of :func:`supported_encodings`, or None to send the
+        response uncompressed
+    """
+    accepted = accepted_encodings(header)
+    default = accepted.get('*', 0.0)
+    best, best_quality = None, 0.0
+    for encoding in supported_encodings():
+        quality = accepted.get(encoding, default)
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+
+    return best
+
+
+def _compress_stream(chunks, compressor):
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+class CompressionMiddleware(object):
+    """Decompress requests and compress responses.
+
+    Args:
+        threshold: Responses smaller than this many bytes are sent
+            uncompressed. Streamed responses, whose size is not known in
+            advance, are always compressed.
+        max_decompressed_bytes: The maximum size of a decompressed
+            request body
+    """
+
+    def __init__(self, threshold=COMPRESSION_THRESHOLD, max_decompressed_bytes=DEFAULT_MAX_DECOMPRESSED_BYTES):
+        self._threshold = threshold
+        self._max_decompressed_bytes = max_decompressed_bytes
+
+    def process_request(self, req, resp):
+        encoding = (req.get_header('Content-Encoding') or IDENTITY).strip().lower()
+        if encoding == IDENTITY:
+            return
+
+        decompressor = _decompressor(encoding)
+        if decompressor is None:
+            raise falcon.HTTPUnsupportedMediaType(
+                'Unsupported Content-Encoding {} (supported: {})'.format(encoding, ', '.join(supported_encodings())))
+
+        if 'chunked' in (req.get_header('Transfer-Encoding') or '').lower():
+            length = None
+        else:
+            length = req.content_length or 0
+        req.stream = DecompressingStream(req.stream, length, decompressor, self._max_decompressed_bytes)
+        # The length of the decompressed body is not known, see
+        # marvin_backend.utils.body_length.
+        req.context['decompressed'] = True
+        LOGGER.debug("Decompressing %s request body", encoding)
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        if resp.status in (falcon.HTTP_204, falcon.HTTP_304) or resp.get_header('Content-Encoding'):
+            return
+
+        body = resp.body
+        if body is not None:
+            data = body.encode('utf-8') if isinstance(body, str) else body
+        else:
+            data = resp.data
+        stream = resp.stream if data is None else None
+        if data is None and stream is None:
+            return
+        if data is not None and len(data) < self._threshold:
+            return
+
+        resp.append_header('Vary', 'Accept-Encoding')
+        encoding = negotiate_encoding(req.get_header('Accept-Encoding'))
+        if encoding is None:
+            return
+
+        compressor = _compressor(encoding)
+        if data is not None:
+            resp.body = None
+            resp.data = compressor.compress(data) + compressor.flush()
+        else:
+            resp.stream = _compress_stream(stream, compressor)
+        resp.set_header('Content-Encoding', encoding)
@@ -9,7 +9,8 @@ import logging
 
 import falcon
 
-from marvin_backend.utils import DLtoLD, NumpyJSONEncoder, find_query_execution_ids
+from marvin_backend import serialization
+from marvin_backend.utils import DLtoLD, NumpyJSONEncoder, find_query_execution_ids, read_body
 
 LOGGER = logging.getLogger(__name__)
 
@@ -21,7 +22,8 @@ class SQLQuery(object):  # pragma: no coverage
         self._db = db
 
     def on_put(self, req, resp):
-        if not req.content_length:
+        body = read_body(req)
+        if not body:
             # Bad request
             msg = 'JSON body is required for this call'
             doc = {
@@ -37,7 +39,8 @@ class SQLQuery(object):  # pragma: no coverage
             LOGGER.error(msg)
             return
 
-        doc = json.load(req.stream)
+        layout = serialization.requested_layout(req)
+        doc = json.loads(body)
         query = doc.get('query')
         params = doc.get('params')
         if params:
@@ -45,16 +48,40 @@ class SQLQuery(object):  # pragma: no coverage
         else:
             sql_result = self._db.execute_query(query)
 
-        result = DLtoLD(sql_result)
+        links = {
+            'url': req.url,
+        }
+        if layout == serialization.COLUMNAR_LAYOUT:
+            doc = serialization.columnar_document(links, sql_result)
+        else:
+            result = DLtoLD(sql_result)
+            doc = {
+                'links': links,
+                'data': result,
+                'data_length': len(result),
+            }
+
+        # TODO: pagination
+        resp.body = json.dumps(doc, ensure_ascii=False, cls=NumpyJSONEncoder)
+        resp.status = falcon.HTTP_200
 
+
+class CacheStats(object):
+    """The counters of the response cache.
+
+    Args:
+        cache: The :class:`marvin_backend.cache.ResponseCache`
+    """
+
+    def __init__(self, cache):
+        self._cache = cache
+
+    def on_get(self, req, resp):
         doc = {
             'links': {
                 'url': req.url,
             },
-            'data': result,
-            'data_length': len(result),
+            'data': self._cache.stats(),
         }
-
-        # TODO: pagination
-        resp.body = json.dumps(doc, ensure_ascii=False, cls=NumpyJSONEncoder)
+        resp.body = json.dumps(doc)
         resp.status = falcon.HTTP_200
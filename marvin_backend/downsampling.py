@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright MonetDB Solutions B.V. 2018-2019
+"""Downsampling of time series for plotting."""
+import numpy as np
+
+
+def lttb(x, y, threshold):
+    """Select the points of a time series to keep when plotting it.
+
+    This is the Largest-Triangle-Three-Buckets algorithm, described in
+    S. Steinarsson, *Downsampling Time Series for Visual
+    Representation*, 2013. The first and the last point are always
+    kept. The rest of the series is divided in ``threshold - 2``
+    buckets, and from each bucket we keep the point that forms the
+    largest triangle with the point kept from the previous bucket and
+    the average of the next bucket. This preserves the peaks and the
+    troughs of the series, that plain averaging would flatten.
+
+    Args:
+        x: The x coordinates, sorted
+        y: The y coordinates
+        threshold: The maximum number of points to keep
+
+    Returns:
+        The indices of the selected points, in increasing order
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    length = len(x)
+    if threshold >= length or threshold < 3:
+        return np.arange(length)
+
+    # The bucket boundaries, excluding the first and last points
+    edges = np.floor(np.linspace(1, length - 1, threshold - 1)).astype(np.int64)
+
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = length - 1
+    previous = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], edges[i + 1]
+
+        # The average of the next bucket (the last point for the last one)
+        if i + 2 < len(edges):
+            next_start, next_end = edges[i + 1], edges[i + 2]
+        else:
+            next_start, next_end = length - 1, length
+        avg_x = x[next_start:next_end].mean()
+        avg_y = y[next_start:next_end].mean()
+
+        # Twice the area of the triangles formed by the previous point,
+        # the average and every candidate point.
+        area = np.abs((x[previous] - avg_x) * (y[start:end] - y[previous]) -
+                      (x[previous] - x[start:end]) * (avg_y - y[previous]))
+        previous = start + int(np.argmax(area))
+        selected[i + 1] = previous
+
+    return selected
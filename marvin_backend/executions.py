@@ -17,9 +17,10 @@ class Executions(object):
         self._db = db
 
     @utils.api_endpoint
-    def on_get(self, req, resp):
-        all_executions_sql = "SELECT * FROM mal_execution"
-        return self._db.execute_query(all_executions_sql)
+    @utils.paginated('execution_id')
+    def on_get(self, req, resp, page):
+        all_executions_sql = page.sql('mal_execution', 'execution_id')
+        return self._db.execute_query(all_executions_sql, page.params())
 
 
 class SingleExecution(object):
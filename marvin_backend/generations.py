@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright MonetDB Solutions B.V. 2018-2019
+"""Conditional GET requests.
+
+Every write to the database bumps a generation counter. The ETag of a
+response is derived from the generation and the request, so it can be
+computed, and compared with ``If-None-Match``, before the database is
+queried.
+"""
+import fcntl
+import hashlib
+import logging
+import threading
+import uuid
+
+import falcon
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Generation(object):
+    """A counter of the writes to the database.
+
+    The counter is kept in a file when ``path`` is given, so that all
+    the server processes using the database share it. Otherwise it is
+    kept in memory, and a random epoch makes sure that the ETags of
+    different processes never collide.
+
+    A generation can be used as a :class:`marvin_backend.traces.Traces`
+    hook, to be bumped after every ingested trace.
+
+    Args:
+        path: The file holding the counter
+    """
+
+    def __init__(self, path=None):
+        self._path = path
+        self._value = 0
+        self._lock = threading.Lock()
+        self._epoch = '' if path is not None else uuid.uuid4().hex
+
+    @property
+    def epoch(self):
+        return self._epoch
+
+    def current(self):
+        if self._path is None:
+            return self._value
+
+        try:
+            with open(self._path) as fl:
+                fcntl.flock(fl, fcntl.LOCK_SH)
+                return int(fl.read() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def bump(self):
+        """Record a write.
+
+        Returns:
+            The new generation
+        """
+        if self._path is None:
+            with self._lock:
+                self._value += 1
+                return self._value
+
+        with open(self._path, 'a+') as fl:
+            fcntl.flock(fl, fcntl.LOCK_EX)
+            fl.seek(0)
+            value = int(fl.read() or 0) + 1
+            fl.seek(0)
+            fl.truncate()
+            fl.write(str(value))
+            fl.flush()
+
+        LOGGER.debug("Database generation %d", value)
+        return value
+
+    def before_ingest(self):
+        return None
+
+    def after_ingest(self, state):
+        self.bump()
+
+
+def _etag_matches(header, etag):
+    if header is None:
+        return False
+
+    for candidate in header.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == '*' or candidate == etag:
+            return True
+
+    return False
+
+
+class ConditionalGetMiddleware(object):
+    """Answer ``If-None-Match`` requests with ``304 Not Modified``.
+
+    Args:
+        generation: The :class:`Generation` of the database
+        exclude: Path prefixes of resources that change without writes
+            to the database, and must not get an ETag
+    """
+
+    def __init__(self, generation, exclude=('/traces', '/developer', '/metrics')):
+        self._generation = generation
+        self._exclude = tuple(exclude)
+
+    def etag(self, req):
+        """The ETag of the response to a request, in the current generation."""
+        # The representation depends on the negotiated media type and
+        # content coding, as well as on the URL.
+        key = '\n'.join([
+            self._generation.epoch,
+            str(self._generation.current()),
+            req.relative_uri,
+            req.get_header('Accept') or '',
+            req.get_header('Accept-Encoding') or '',
+        ])
+        return '"{}"'.format(hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def process_request(self, req, resp):
+        if req.method not in ('GET', 'HEAD') or req.path.startswith(self._exclude):
+            return
+
+        etag = self.etag(req)
+        if _etag_matches(req.get_header('If-None-Match'), etag):
+            raise falcon.HTTPStatus(falcon.HTTP_304, headers={'ETag': etag})
+        req.context['etag'] = etag
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        etag = req.context.get('etag')
+        # Responses served by middleware (e.g. from a cache) count as
+        # failed requests, so only the status is checked.
+        if etag is not None and resp.status == falcon.HTTP_200:
+            resp.set_header('ETag', etag)
@@ -6,8 +6,15 @@
 # Copyright MonetDB Solutions B.V. 2018-2019
 import logging
 
+import numpy as np
+
+from marvin_backend import cache
+from marvin_backend import downsampling
+from marvin_backend import intervals
 from marvin_backend import utils
 from marvin_backend import queries
+from marvin_backend import rollups
+from marvin_backend import serialization
 
 LOGGER = logging.getLogger(__name__)
 
@@ -17,9 +24,10 @@ class HeartBeats(object):
         self._db = db
 
     @utils.api_endpoint
-    def on_get(self, req, resp):
-        all_heartbeats_sql = "SELECT * FROM heartbeat"
-        all_heartbeats = self._db.execute_query(all_heartbeats_sql)
+    @utils.paginated('heartbeat_id')
+    def on_get(self, req, resp, page):
+        all_heartbeats_sql = page.sql('heartbeat', 'heartbeat_id')
+        all_heartbeats = self._db.execute_query(all_heartbeats_sql, page.params())
 
         return all_heartbeats
 
@@ -30,126 +38,165 @@ class SingleServerHeartbeats(object):
 
     @utils.api_endpoint_404_on_empty
     @utils.api_endpoint
-    def on_get(self, req, resp, sid):
-        server_beats_sql = "SELECT * FROM heartbeat WHERE server_session=%(sid)s"
-        server_beats = self._db.execute_query(server_beats_sql, {'sid': sid})
+    @utils.paginated('heartbeat_id')
+    def on_get(self, req, resp, sid, page):
+        server_beats_sql = page.sql('heartbeat', 'heartbeat_id', ["server_session=%(sid)s"])
+        server_beats = self._db.execute_query(server_beats_sql, page.params({'sid': sid}))
 
         return server_beats
 
 
 class CPUload(object):
+    """The CPU load of a server over time.
+
+    The optional parameters ``from`` and ``to`` restrict the result to
+    a range of ``ctime``. With ``bucket`` the load is averaged in the
+    database over fixed-width time buckets, and with ``max_points`` the
+    series is reduced to at most that many points, keeping its shape
+    (see :func:`marvin_backend.downsampling.lttb`).
+
+    The load is read from the rollup tables maintained by
+    :class:`marvin_backend.rollups.CPULoadRollups`: buckets that are
+    multiples of a rollup resolution, over a range aligned to it, are
+    combined from the coarser level, and everything else from the per
+    heartbeat level. If the rollup tables are not available, or hold
+    nothing for the server and range (e.g. heartbeats ingested before
+    the tables were created), the load is computed from the
+    ``cpuload`` table.
+    """
+
     def __init__(self, db):
         self._db = db
 
     @utils.api_endpoint
     def on_get(self, req, resp, sid):
-        cpuload_sql = "SELECT h.heartbeat_id, h.ctime, avg(c.val) AS cpuload FROM cpuload AS c JOIN heartbeat AS h ON c.heartbeat_id=h.heartbeat_id WHERE h.server_session=%(sid)s GROUP BY h.heartbeat_id, h.ctime"
-        cpuload = self._db.execute_query(cpuload_sql, {'sid': sid})
+        start_time = req.get_param_as_int('from')
+        end_time = req.get_param_as_int('to')
+        bucket = utils.int_param(req, 'bucket', minimum=1)
+        max_points = utils.int_param(req, 'max_points', minimum=3)
+
+        params = {'sid': sid}
+        if start_time is not None:
+            params['start_time'] = start_time
+        if end_time is not None:
+            params['end_time'] = end_time
+        if bucket is not None:
+            params['bucket'] = bucket
+
+        cpuload = self._rollup_cpuload(params)
+        if _no_rollups(cpuload):
+            cpuload = self._raw_cpuload(params)
+
+        if max_points is not None and cpuload and serialization.row_count(cpuload) > max_points:
+            keep = downsampling.lttb(cpuload['ctime'], cpuload['cpuload'], max_points)
+            cpuload = dict((k, np.asanyarray(v)[keep]) for k, v in cpuload.items())
 
         return cpuload
 
+    def _rollup_cpuload(self, params):
+        conditions = _range_conditions(params, "")
+
+        if 'bucket' not in params:
+            cpuload_sql = "SELECT heartbeat_id, ctime, cpuload FROM heartbeat_cpuload WHERE {} ORDER BY ctime"
+            return self._db.execute_query(cpuload_sql.format(" AND ".join(conditions)), params)
+
+        # ctime of the buckets is the start of the bucket
+        resolution = rollups.resolution_for(params['bucket'])
+        bounds = [params[k] for k in ('start_time', 'end_time') if k in params]
+        if resolution is not None and all(b % resolution == 0 for b in bounds):
+            # Every bucket is made of whole rollup buckets
+            cpuload_sql = "SELECT b.ctime, sum(b.load_sum) / sum(b.samples) AS cpuload, sum(b.heartbeats) AS heartbeats FROM (SELECT (ctime / %(bucket)s) * %(bucket)s AS ctime, load_sum, samples, heartbeats FROM cpuload_rollup WHERE resolution=%(resolution)s AND {}) AS b GROUP BY b.ctime ORDER BY b.ctime"
+            params = dict(params, resolution=resolution)
+        else:
+            cpuload_sql = "SELECT b.ctime, sum(b.cpuload * b.cores) / sum(b.cores) AS cpuload, count(*) AS heartbeats FROM (SELECT (ctime / %(bucket)s) * %(bucket)s AS ctime, cpuload, cores FROM heartbeat_cpuload WHERE {}) AS b GROUP BY b.ctime ORDER BY b.ctime"
+
+        return self._db.execute_query(cpuload_sql.format(" AND ".join(conditions)), params)
+
+    def _raw_cpuload(self, params):
+        conditions = _range_conditions(params, "h.")
+
+        if 'bucket' not in params:
+            cpuload_sql = "SELECT h.heartbeat_id, h.ctime, avg(c.val) AS cpuload FROM cpuload AS c JOIN heartbeat AS h ON c.heartbeat_id=h.heartbeat_id WHERE {} GROUP BY h.heartbeat_id, h.ctime ORDER BY h.ctime"
+        else:
+            cpuload_sql = "SELECT b.ctime, avg(b.val) AS cpuload, count(DISTINCT b.heartbeat_id) AS heartbeats FROM (SELECT (h.ctime / %(bucket)s) * %(bucket)s AS ctime, h.heartbeat_id, c.val FROM cpuload AS c JOIN heartbeat AS h ON c.heartbeat_id=h.heartbeat_id WHERE {}) AS b GROUP BY b.ctime ORDER BY b.ctime"
+
+        return self._db.execute_query(cpuload_sql.format(" AND ".join(conditions)), params)
+
+
+def _no_rollups(result):
+    """Whether the load must be computed from the ``cpuload`` table
+    instead of the rollup ``result``."""
+    if result is None:
+        LOGGER.warning("CPU load rollups not available, computing the load from the cpuload table")
+        return True
+    if serialization.row_count(result) == 0:
+        # Heartbeats ingested before the rollup tables were created
+        # are only aggregated by the backfill-rollups maintenance task.
+        LOGGER.debug("No CPU load rollups, computing the load from the cpuload table")
+        return True
+
+    return False
+
+
+def _range_conditions(params, prefix):
+    conditions = ["{}server_session=%(sid)s".format(prefix)]
+    if 'start_time' in params:
+        conditions.append("{}ctime>=%(start_time)s".format(prefix))
+    if 'end_time' in params:
+        conditions.append("{}ctime<%(end_time)s".format(prefix))
+
+    return conditions
+
 
 class QueryLoad(object):
-    def __init__(self, db):
+    def __init__(self, db, query_executions=None):
         self._db = db
+        self._query_executions = query_executions or queries.QueryExecutions(db)
 
     @utils.api_endpoint
     def on_get(self, req, resp, qid):
-        # This method is heavily commented because it is written in a hurry and
-        # will need to be heavily refactored. Consider creating a data
-        # structure for intervals, with getters for start and end time.
-
         # First find all the executions related to this query
-        # TODO I should not have to instantiate this class
-        qe = queries.QueryExecutions(self._db)
-        execution_ids = list(map(int, qe.gather_executions(qid)))
-
-        # Find the the server sessions of these executions
-        sessions_sql = "SELECT server_session FROM mal_execution WHERE execution_id=%(eid)s"
-        sessions = set()
-        for ex_id in execution_ids:
-            s = self._db.execute_query(sessions_sql, {'eid': ex_id})
-            sessions.add(s['server_session'][0])
-
-        # TODO probably does not do what it's supposed to do... I suspect it
-        # interacts badly with following fetches...
-        # cursor.executemany(sessions_sql, execution_ids)
-
-        # Find the execution time limits: the earliest and the latest timestamp
-        # of each execution.
-        times_sql = "SELECT m.server_session AS server, min(i.astart_time) AS start_t, max(i.aend_time) AS end_t FROM instructions AS i JOIN mal_execution AS m ON i.mal_execution_id=m.execution_id WHERE mal_execution_id=%(eid)s GROUP BY m.server_session"
+        execution_ids = list(map(int, self._query_executions.gather_executions(qid)))
+
+        # Find the server session and the execution time limits (the
+        # earliest and the latest timestamp) of all the executions in one
+        # go.
+        times_sql = "SELECT m.server_session AS server, i.mal_execution_id, min(i.astart_time) AS start_t, max(i.aend_time) AS end_t FROM instructions AS i JOIN mal_execution AS m ON i.mal_execution_id=m.execution_id WHERE i.mal_execution_id IN ({}) GROUP BY m.server_session, i.mal_execution_id"
+        t = self._db.execute_query(times_sql.format(utils.sql_int_list(execution_ids)))
         times = dict()
-        for ex_id in execution_ids:
-            t = self._db.execute_query(times_sql, {'eid': ex_id})
-            if not times.get(t['server'][0]):
-                times[t['server'][0]] = list()
-            times[t['server'][0]].append([t['start_t'][0], t['end_t'][0]])
-
-        # TODO the following functionality regarding intervals should be
-        # factored out of this class.
-
-        # Consolidate intervals. We could consider using an interval tree [1],
-        # but we would only need it for the initialization (no inserts,
-        # deletes, dynamic queries etc). Normally if we have $n$ intervals we
-        # would need to check $O(n^2)$ pairs. We can however sort the intervals
-        # in $O(n\log n)$ by start time and then we would only need to make one
-        # sweep through the list.
-        #
-        # [1] https://en.wikipedia.org/wiki/Interval_tree
-
-        # There are the following cases for two intervals A, B, where A.start_time < B.start_time:
-        #   1. The intervals do not overlap (A.end_time < B.start_time)
-        #   2. Interval B starts before A finishes (B.start_time < A.end_time)
-        #   3. Interval B is enclosed in A (B.end_time < A.end_time)
-
-        timelines = dict()
-        # We maintain the invariant that `current_interval` holds A and
-        # `interval_iterator` holds B.
-        for server, raw_intervals in times.items():
-            raw_intervals.sort(
-                key=lambda x: x[0])  # Make sure the interval list is sorted
-            current_interval = raw_intervals.pop(0)
-            intervals = list()
-
-            while raw_intervals:
-                interval_iterator = raw_intervals.pop(0)
-                # Case 1, non overlapping intervals. Add the current interval
-                # to the final list and make the iterator the new current
-                # interval.
-                if current_interval[1] < interval_iterator[0]:
-                    intervals.append(current_interval)
-                    current_interval = interval_iterator
-                # Case 2: Merge the two intervals by extending A up to the end
-                # of B, and discard B.
-                elif interval_iterator[0] < current_interval[1]:
-                    current_interval[1] = interval_iterator[1]
-                # Case 3: B is contained in A, so just discard it. We do not
-                # really need to examine this case but I leave it here for
-                # completeness.
-                elif interval_iterator[1] < current_interval[1]:
-                    pass
-
-            # Don't forget to put the last interval in the list
-            intervals.append(current_interval)
-            timelines[server] = intervals
-
-        # Now that we have the relevant timelines find all the cpuload objects
-        # from the database.
-
-        cpuload_sql = "SELECT h.server_session, h.heartbeat_id, h.ctime, avg(c.val) AS cpuload FROM cpuload AS c JOIN heartbeat AS h ON c.heartbeat_id=h.heartbeat_id WHERE h.server_session=%(sid)s AND h.ctime>=%(start_time)s AND h.ctime<%(end_time)s GROUP BY h.heartbeat_id, h.ctime, h.server_session"
+        for server, start_t, end_t in zip(t['server'], t['start_t'], t['end_t']):
+            times.setdefault(server, list()).append((start_t, end_t))
+
+        # Consolidate the intervals during which the executions were
+        # running on each server.
+        timelines = dict((server, intervals.IntervalSet.from_pairs(pairs)) for server, pairs in times.items())
+        # New heartbeats of these servers may change the result
+        req.context.setdefault('cache_tags', []).extend(cache.server_tag(server) for server in timelines)
+
+        # Now that we have the relevant timelines find the load of the
+        # heartbeats in them, with one query for all the intervals of
+        # each server. The per heartbeat rollup is read if it has
+        # the heartbeats of the server.
+        rollup_sql = "SELECT server_session, heartbeat_id, ctime, cpuload FROM heartbeat_cpuload WHERE server_session=%(sid)s AND ({}) ORDER BY ctime"
+        cpuload_sql = "SELECT h.server_session, h.heartbeat_id, h.ctime, avg(c.val) AS cpuload FROM cpuload AS c JOIN heartbeat AS h ON c.heartbeat_id=h.heartbeat_id WHERE h.server_session=%(sid)s AND ({}) GROUP BY h.heartbeat_id, h.ctime, h.server_session ORDER BY h.ctime"
+        interval_sql = "({0}ctime>=%(start_time_{1})s AND {0}ctime<%(end_time_{1})s)"
         cpuload = dict()
         for server, timeline in timelines.items():
-            for interval in timeline:
-                result = self._db.execute_query(
-                    cpuload_sql, {
-                        "sid": server,
-                        "start_time": int(interval[0]),
-                        "end_time": int(interval[1])
-                    })
-                for k, v in result.items():
-                    if not cpuload.get(k):
-                        cpuload[k] = v.tolist()
-                    else:
-                        cpuload[k].extend(v.tolist())
+            if len(timeline) == 0:
+                continue
+
+            params = {"sid": server}
+            for idx, interval in enumerate(timeline):
+                params["start_time_{}".format(idx)] = int(interval[0])
+                params["end_time_{}".format(idx)] = int(interval[1])
+
+            conditions = " OR ".join(interval_sql.format("", idx) for idx in range(len(timeline)))
+            result = self._db.execute_query(rollup_sql.format(conditions), params)
+            if _no_rollups(result):
+                conditions = " OR ".join(interval_sql.format("h.", idx) for idx in range(len(timeline)))
+                result = self._db.execute_query(cpuload_sql.format(conditions), params)
+
+            for k, v in result.items():
+                cpuload.setdefault(k, list()).extend(serialization.column_to_list(v))
 
         return cpuload
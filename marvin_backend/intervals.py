@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright MonetDB Solutions B.V. 2018-2019
+"""Sets of time intervals.
+
+Timelines (e.g. the periods during which the executions of a query
+were running on a server) are represented as sets of disjoint,
+half-open intervals ``[start, end)``, stored as two sorted numpy
+arrays. Building a set from arbitrary, possibly overlapping, intervals
+takes :math:`O(n\\log n)` time, for the sort, and all other operations
+are either linear or use binary search.
+"""
+import numpy as np
+
+
+class IntervalSet(object):
+    """A set of disjoint half-open intervals.
+
+    Overlapping and adjacent intervals are merged, and empty intervals
+    are dropped, so that each point in the set belongs to exactly one
+    interval, and there is a gap between consecutive intervals.
+
+    Args:
+        starts: The start points of the intervals
+        ends: The end points of the intervals, in the same order
+
+    Raises:
+        ValueError: If an interval ends before it starts.
+    """
+
+    def __init__(self, starts=(), ends=()):
+        starts = np.asarray(starts)
+        ends = np.asarray(ends)
+        if starts.size == 0 and ends.size == 0:
+            # Do not let the float default of numpy affect the type of
+            # the sets this is combined with.
+            starts = starts.astype(np.int64)
+            ends = ends.astype(np.int64)
+        if starts.shape != ends.shape or starts.ndim != 1:
+            raise ValueError("starts and ends must be one dimensional arrays of the same length")
+        if np.any(ends < starts):
+            raise ValueError("Intervals must not end before they start")
+
+        self._starts, self._ends = _merge(starts, ends)
+
+    @classmethod
+    def from_pairs(cls, pairs):
+        """Build a set from a sequence of ``(start, end)`` pairs."""
+        pairs = list(pairs)
+        return cls([p[0] for p in pairs], [p[1] for p in pairs])
+
+    @classmethod
+    def _from_normalized(cls, starts, ends):
+        ret = cls.__new__(cls)
+        ret._starts = starts
+        ret._ends = ends
+        return ret
+
+    @property
+    def starts(self):
+        return self._starts
+
+    @property
+    def ends(self):
+        return self._ends
+
+    def __len__(self):
+        return len(self._starts)
+
+    def __iter__(self):
+        return zip(self._starts.tolist(), self._ends.tolist())
+
+    def __eq__(self, other):
+        if not isinstance(other, IntervalSet):
+            return NotImplemented
+        return np.array_equal(self._starts, other._starts) and np.array_equal(self._ends, other._ends)
+
+    def __repr__(self):
+        return "IntervalSet({})".format(list(self))
+
+    def total_length(self):
+        """The sum of the lengths of the intervals."""
+        return (self._ends - self._starts).sum()
+
+    def union(self, other):
+        """The points in this set or in ``other``."""
+        return IntervalSet(np.concatenate([self._starts, other._starts]),
+                           np.concatenate([self._ends, other._ends]))
+
+    def intersection(self, other):
+        """The points in both this set and ``other``."""
+        # For every interval of self, the intervals of other that
+        # overlap with it are a contiguous range [lo, hi).
+        lo = np.searchsorted(other._ends, self._starts, side='right')
+        hi = np.searchsorted(other._starts, self._ends, side='left')
+        counts = np.maximum(hi - lo, 0)
+
+        total = counts.sum()
+        self_idx = np.repeat(np.arange(len(self)), counts)
+        # other_idx enumerates lo[i], lo[i] + 1, ..., hi[i] - 1 for every i
+        offsets = np.repeat(np.cumsum(counts) - counts, counts)
+        other_idx = np.repeat(lo, counts) + np.arange(total) - offsets
+
+        starts = np.maximum(self._starts[self_idx], other._starts[other_idx])
+        ends = np.minimum(self._ends[self_idx], other._ends[other_idx])
+        keep = starts < ends
+
+        # Pieces of disjoint sorted intervals are disjoint and sorted,
+        # but two of them can touch, so merge them anyway.
+        return IntervalSet(starts[keep], ends[keep])
+
+    def contains(self, points):
+        """Check which of the given points are in the set.
+
+        Args:
+            points: A point or an array of points
+
+        Returns:
+            A boolean, or an array of booleans
+        """
+        points = np.asarray(points)
+        if len(self) == 0:
+            ret = np.zeros(points.shape, dtype=bool)
+        else:
+            # The last interval starting at or before each point
+            idx = np.searchsorted(self._starts, points, side='right') - 1
+            ret = (idx >= 0) & (points < self._ends[np.maximum(idx, 0)])
+
+        return ret if ret.ndim else bool(ret)
+
+    def overlapping(self, start, end):
+        """The intervals of the set that overlap with ``[start, end)``."""
+        lo = np.searchsorted(self._ends, start, side='right')
+        hi = np.searchsorted(self._starts, end, side='left')
+
+        return IntervalSet._from_normalized(self._starts[lo:hi], self._ends[lo:hi])
+
+
+def _merge(starts, ends):
+    keep = starts < ends
+    starts = starts[keep]
+    ends = ends[keep]
+    if len(starts) == 0:
+        return starts, ends
+
+    order = np.argsort(starts, kind='stable')
+    starts = starts[order]
+    ends = ends[order]
+
+    # reach[i] is the furthest point covered by intervals 0..i. A new
+    # interval begins wherever a start lies beyond the reach of all the
+    # previous intervals.
+    reach = np.maximum.accumulate(ends)
+    first = np.concatenate([[True], starts[1:] > reach[:-1]])
+    last = np.concatenate([first[1:], [True]])
+
+    return starts[first], reach[last]
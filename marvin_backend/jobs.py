@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright MonetDB Solutions B.V. 2018-2019
+"""Background trace ingestion.
+
+Uploaded traces are spooled to a directory and ingested by a pool of
+background threads. The status of every job is kept in a JSON file next
+to the spooled trace, so that it can be reported by any server process
+sharing the directory, not only by the one running the job.
+
+The process owning a job holds a ``flock`` on a lock file of the job
+until the job is finished. Jobs left behind by a process that stopped
+are recovered by the next process using the directory: queued jobs are
+queued again, and the jobs that were being ingested are marked as
+failed, since they may or may not have been stored.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import fcntl
+import glob
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+
+LOGGER = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# Size of the blocks copied from the request to the spool file
+SPOOL_BLOCK_SIZE = 1 << 20
+
+_JOB_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+
+
+class IngestJobs(object):
+    """A queue of trace ingestion jobs.
+
+    Args:
+        spool_dir: The directory holding the spooled traces and the job
+            status files. It is created if it does not exist.
+        ingest: A function taking the path of a spooled trace and
+            returning the number of rows inserted in each table
+        workers: The number of background threads ingesting traces
+    """
+
+    def __init__(self, spool_dir, ingest, workers=1):
+        self._spool_dir = spool_dir
+        self._ingest = ingest
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        # The lock files of the jobs of this process
+        self._owned = dict()
+        self._lock = threading.Lock()
+        # The jobs are recovered by every process once, after it has
+        # been forked.
+        self._recovered_by = None
+        os.makedirs(spool_dir, exist_ok=True)
+
+    def _trace_path(self, job_id):
+        return os.path.join(self._spool_dir, '{}.trace'.format(job_id))
+
+    def _status_path(self, job_id):
+        return os.path.join(self._spool_dir, '{}.json'.format(job_id))
+
+    def _lock_path(self, job_id):
+        return os.path.join(self._spool_dir, '{}.lock'.format(job_id))
+
+    def _claim(self, job_id):
+        """Take the ownership of a job.
+
+        Returns:
+            Whether the job was not owned by another process
+        """
+        fl = open(self._lock_path(job_id), 'a')
+        try:
+            fcntl.flock(fl, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            fl.close()
+            return False
+
+        with self._lock:
+            self._owned[job_id] = fl
+        return True
+
+    def _release(self, job_id):
+        with self._lock:
+            fl = self._owned.pop(job_id)
+        os.remove(self._lock_path(job_id))
+        fl.close()
+
+    def _read_status(self, job_id):
+        try:
+            with open(self._status_path(job_id)) as fl:
+                return json.load(fl)
+        except FileNotFoundError:
+            return None
+
+    def _write_status(self, status):
+        # Write and rename, so that readers never see a partial file.
+        path = self._status_path(status['job_id'])
+        with open(path + '.tmp', 'w') as fl:
+            json.dump(status, fl)
+        os.replace(path + '.tmp', path)
+
+    def submit(self, stream, length):
+        """Spool a trace and queue it for ingestion.
+
+        Args:
+            stream: A file-like object to read the trace from
+            length: The number of bytes to read, or None to read until
+                the end of the stream
+
+        Returns:
+            The status of the new job
+        """
+        self.recover()
+        job_id = uuid.uuid4().hex
+        self._claim(job_id)
+        spooled = 0
+        try:
+            with open(self._trace_path(job_id), 'wb') as fl:
+                while length is None or spooled < length:
+                    size = SPOOL_BLOCK_SIZE if length is None else min(SPOOL_BLOCK_SIZE, length - spooled)
+                    block = stream.read(size)
+                    if not block:
+                        break
+                    fl.write(block)
+                    spooled += len(block)
+        except Exception:
+            if os.path.exists(self._trace_path(job_id)):
+                os.remove(self._trace_path(job_id))
+            self._release(job_id)
+            raise
+
+        status = {
+            'job_id': job_id,
+            'status': QUEUED,
+            'bytes': spooled,
+            'submitted': time.time(),
+        }
+        self._write_status(status)
+        LOGGER.debug("Spooled %d bytes for job %s", spooled, job_id)
+
+        self._executor.submit(self._run, dict(status))
+        return status
+
+    def _run(self, status):
+        job_id = status['job_id']
+        status.update(status=RUNNING, started=time.time())
+        self._write_status(status)
+
+        try:
+            rows = self._ingest(self._trace_path(job_id))
+            status.update(status=DONE, rows=rows)
+            LOGGER.info("Ingested job %s", job_id)
+        except Exception as e:
+            status.update(status=FAILED, error=[str(a) for a in e.args])
+            LOGGER.exception("Ingesting job %s failed", job_id)
+        finally:
+            status['finished'] = time.time()
+            self._write_status(status)
+            os.remove(self._trace_path(job_id))
+            self._release(job_id)
+
+        return status
+
+    def recover(self):
+        """Take over the jobs left behind by the processes that stopped.
+
+        Called once by every process, on its first use of the queue.
+
+        Returns:
+            The number of jobs queued again, and of jobs marked as
+            failed
+        """
+        with self._lock:
+            if self._recovered_by == os.getpid():
+                return 0, 0
+            self._recovered_by = os.getpid()
+
+        queued = failed = 0
+        for path in glob.glob(os.path.join(self._spool_dir, '*.json')):
+            job_id = os.path.basename(path)[:-len('.json')]
+            if not _JOB_ID_RE.match(job_id) or job_id in self._owned:
+                continue
+            status = self._read_status(job_id)
+            if status is None or status['status'] not in (QUEUED, RUNNING):
+                continue
+            if not self._claim(job_id):
+                # Still owned by a running process
+                continue
+
+            # Finished by its owner in the meantime
+            status = self._read_status(job_id)
+            if status['status'] not in (QUEUED, RUNNING):
+                self._release(job_id)
+                continue
+
+            if status['status'] == QUEUED and os.path.exists(self._trace_path(job_id)):
+                LOGGER.info("Queueing job %s again", job_id)
+                self._executor.submit(self._run, status)
+                queued += 1
+                continue
+
+            status.update(status=FAILED, error=["The server stopped before the trace was ingested"],
+                          finished=time.time())
+            self._write_status(status)
+            if os.path.exists(self._trace_path(job_id)):
+                os.remove(self._trace_path(job_id))
+            self._release(job_id)
+            LOGGER.warning("Job %s was interrupted, marked as failed", job_id)
+            failed += 1
+
+        return queued, failed
+
+    def status(self, job_id):
+        """The status of a job.
+
+        Returns:
+            A dictionary, or None if there is no such job
+        """
+        if not _JOB_ID_RE.match(job_id):
+            return None
+
+        self.recover()
+        return self._read_status(job_id)
+
+    def shutdown(self, wait=True):
+        """Stop accepting jobs, optionally waiting for the queued ones."""
+        self._executor.shutdown(wait=wait)
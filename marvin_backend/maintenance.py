@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright MonetDB Solutions B.V. 2018-2019
+"""Maintenance tasks for existing trace databases.
+
+Usage::
+
+    python -m marvin_backend.maintenance --dbpath ./db_path/dev_db backfill-closures
+    python -m marvin_backend.maintenance --dbpath ./db_path/dev_db backfill-rollups
+"""
+import argparse
+import logging
+
+from marvin_backend import closures, rollups
+from marvin_backend.marvin_backend import open_database, open_generation
+
+LOGGER = logging.getLogger(__name__)
+
+
+def backfill_closures(dbm):  # pragma: no coverage
+    count = closures.ExecutionClosures(dbm).backfill()
+    print("Stored the executions of {} queries".format(count))
+
+
+def backfill_rollups(dbm):  # pragma: no coverage
+    count = rollups.CPULoadRollups(dbm).backfill()
+    print("Aggregated the CPU load of {} server sessions".format(count))
+
+
+TASKS = {
+    'backfill-closures': backfill_closures,
+    'backfill-rollups': backfill_rollups,
+}
+
+
+def parse_cli():  # pragma: no coverage
+    parser = argparse.ArgumentParser(description="Maintenance tasks for Marvin trace databases")
+    parser.add_argument('--dbpath',
+                        '-d',
+                        help='Path to the database holding the traces')
+    parser.add_argument('task',
+                        choices=sorted(TASKS),
+                        help='The task to run')
+
+    return parser.parse_args()
+
+
+def main():  # pragma: no coverage
+    arguments = parse_cli()
+    logging.basicConfig(level=logging.INFO)
+    dbm = open_database(arguments.dbpath)
+    dbm.transaction()
+    try:
+        TASKS[arguments.task](dbm)
+    except Exception:
+        dbm.rollback()
+        raise
+    dbm.commit()
+    # Responses computed before the task are stale.
+    open_generation(arguments.dbpath).bump()
+
+
+if __name__ == '__main__':  # pragma: no coverage
+    main()
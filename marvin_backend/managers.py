@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright MonetDB Solutions B.V. 2018-2019
+"""Database managers opened on first use.
+
+The application is built in the gunicorn master process, before the
+workers are forked. A database handle opened there would be inherited,
+and shared, by all the workers. Instead the resources are given a
+:class:`LazyManager`, and every worker opens its own manager after it
+has been forked.
+"""
+import logging
+import os
+import threading
+
+LOGGER = logging.getLogger(__name__)
+
+
+class LazyManager(object):
+    """A stand-in for a database manager, opened on first use.
+
+    Every attribute not defined here is looked up on the manager, so
+    this can be used wherever a
+    :class:`mal_analytics.db_manager.DatabaseManager` is expected.
+
+    Args:
+        factory: A function without arguments returning the manager
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._manager = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self._manager is not None
+
+    def open(self):
+        """Open the manager, if it is not open yet.
+
+        Returns:
+            The manager
+        """
+        if self._manager is None:
+            with self._lock:
+                if self._manager is None:
+                    self._manager = self._factory()
+                    LOGGER.info("Opened the database manager in process %d", os.getpid())
+
+        return self._manager
+
+    def __getattr__(self, name):
+        # Only called for attributes not found on the proxy itself
+        return getattr(self.open(), name)
+
+
+def post_fork(manager):
+    """A gunicorn ``post_fork`` hook opening ``manager`` in each worker.
+
+    Opening the manager right after the fork, instead of on the first
+    request, keeps the cost of opening the database out of the request
+    latencies, and makes failures show up when the worker starts.
+    """
+    def post_fork_impl(server, worker):  # pragma: no coverage
+        manager.open()
+
+    return post_fork_impl
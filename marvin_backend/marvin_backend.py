@@ -9,6 +9,7 @@ import argparse
 import logging
 import os
 from pathlib import Path
+import tempfile
 # import sys
 
 import falcon
@@ -17,25 +18,84 @@ from gunicorn.six import iteritems
 from mal_analytics import db_manager
 
 from marvin_backend import queries, executions, developer, heartbeats, traces
+from marvin_backend import asgi
+from marvin_backend import cache, closures, compression, generations, managers, metrics, rollups, writer
 """Main module."""
 
 LOGGER = logging.getLogger(__name__)
-logging.basicConfig(level=logging.DEBUG)
 
-
-def create_app(manager):
-    api = falcon.API()
+# gunicorn worker classes, see http://docs.gunicorn.org/en/stable/design.html
+WORKER_CLASSES = ('sync', 'gthread', 'gevent')
+LOG_LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR')
+
+
+def create_app(manager=None, spool_dir=None, ingest_workers=1, generation=None,
+               cache_bytes=cache.DEFAULT_MAX_BYTES, manager_factory=None, metrics_dir=None,
+               slow_query_seconds=metrics.DEFAULT_SLOW_QUERY_SECONDS, ingest_lock=None,
+               metrics_registry=None):
+    """Build the application.
+
+    Args:
+        manager: The database manager
+        spool_dir: If given, uploaded traces are spooled to this
+            directory and ingested in the background
+        ingest_workers: The number of background ingest threads
+        generation: The :class:`marvin_backend.generations.Generation`
+            of the database. Defaults to one private to this process.
+        cache_bytes: The size of the response cache
+        manager_factory: Instead of ``manager``, a function opening the
+            database manager. It is called on first use, in the process
+            serving the requests (see :mod:`marvin_backend.managers`).
+        metrics_dir: The directory where the processes serving the
+            application share their metrics. Without it, ``/metrics``
+            only reports the metrics of the process serving it.
+        slow_query_seconds: Log the database calls slower than this to
+            the ``marvin_backend.slow_sql`` logger. None disables the log.
+        ingest_lock: The :class:`marvin_backend.traces.IngestLock` of
+            the database. Defaults to one serializing the ingestions of
+            this process only.
+        metrics_registry: The :class:`marvin_backend.metrics.MetricsRegistry`
+            of the application. Defaults to one sharing its metrics in
+            ``metrics_dir``.
+    """
+    if (manager is None) == (manager_factory is None):
+        raise ValueError("Exactly one of manager and manager_factory is required")
+    if manager is None:
+        manager = managers.LazyManager(manager_factory)
+
+    registry = metrics_registry or metrics.MetricsRegistry(metrics_dir)
+    timings = metrics.RequestTimings()
+    manager = metrics.InstrumentedManager(manager, registry, timings, slow_query_seconds)
+
+    generation = generation or generations.Generation()
+    response_cache = cache.ResponseCache(cache_bytes, generation)
+    cache_middleware = cache.ResponseCacheMiddleware(response_cache)
+
+    api = falcon.API(middleware=[
+        metrics.MetricsMiddleware(registry, timings),
+        generations.ConditionalGetMiddleware(generation),
+        compression.CompressionMiddleware(),
+        cache_middleware,
+    ])
+
+    # The executions of each query, maintained on every trace upload
+    execution_closures = closures.ExecutionClosures(manager)
+    # The CPU load of each heartbeat and time bucket, also maintained on
+    # every trace upload
+    cpuload_rollups = rollups.CPULoadRollups(manager)
 
     # add the endpoints
     # /queries
     all_queries = queries.Queries(manager)
     api.add_route('/queries', all_queries)
 
-    single_query = queries.SingleQuery(manager)
+    single_query = queries.SingleQuery(manager, generation, response_cache)
     api.add_route('/queries/{qid}', single_query)
+    cache_middleware.add(single_query)
 
-    query_executions = queries.QueryExecutions(manager)
+    query_executions = queries.QueryExecutions(manager, closures=execution_closures)
     api.add_route('/queries/{qid}/executions', query_executions)
+    cache_middleware.add(query_executions)
 
     all_executions = executions.Executions(manager)
     api.add_route('/executions', all_executions)
@@ -52,23 +112,40 @@ def create_app(manager):
     server_heartbeats = heartbeats.SingleServerHeartbeats(manager)
     api.add_route('/heartbeats/{sid}', server_heartbeats)
 
-    trace_uploads = traces.Traces(manager)
+    trace_uploads = traces.Traces(manager, hooks=[
+        execution_closures,
+        cpuload_rollups,
+        cache.CacheInvalidation(manager, response_cache, generation),
+    ], lock=ingest_lock)
     api.add_route('/traces', trace_uploads)
 
+    trace_batches = traces.TraceBatches(trace_uploads, manager)
+    api.add_route('/traces/batch', trace_batches)
+
+    if spool_dir is not None:
+        ingest_jobs = trace_uploads.enable_jobs(spool_dir, ingest_workers)
+        api.add_route('/traces/{job_id}', traces.TraceJob(ingest_jobs))
+
     cpu_loads = heartbeats.CPUload(manager)
     api.add_route('/cpuload/{sid}', cpu_loads)
 
-    cpu_loads_per_query = heartbeats.QueryLoad(manager)
+    cpu_loads_per_query = heartbeats.QueryLoad(manager, query_executions)
     api.add_route('/queries/{qid}/load', cpu_loads_per_query)
+    cache_middleware.add(cpu_loads_per_query)
 
     # Mostly for debugging, but could be useful for users as well.
     arbitrary_sql = developer.SQLQuery(manager)
     api.add_route('/developer/query', arbitrary_sql)
 
+    cache_stats = developer.CacheStats(response_cache)
+    api.add_route('/developer/cache', cache_stats)
+
+    api.add_route('/metrics', metrics.MetricsResource(registry))
+
     return api
 
 
-def get_app(database_path=None):  # pragma: no coverage
+def database_location(database_path=None):  # pragma: no coverage
     curr_path = Path().cwd()
     # db_path = database_path or os.environ.get('MARVIN_DB_PATH', './marvin_db')
     # For dev purposes the default db location is at the
@@ -77,12 +154,76 @@ def get_app(database_path=None):  # pragma: no coverage
                                               './db_path/dev_db')
 
     # This works both if db_path is relative, or absolute.
-    actual_path = str((curr_path / db_path).resolve())
+    return str((curr_path / db_path).resolve())
+
+
+def open_database(database_path=None):  # pragma: no coverage
+    actual_path = database_location(database_path)
 
     dbm = db_manager.DatabaseManager(actual_path)
     LOGGER.info('Started db_manager at %s', actual_path)
 
-    return create_app(dbm)
+    return dbm
+
+
+def open_generation(database_path=None):  # pragma: no coverage
+    # Shared by all the processes using the database
+    return generations.Generation(database_location(database_path) + '.generation')
+
+
+def open_ingest_lock(database_path=None):  # pragma: no coverage
+    # Shared by all the processes using the database
+    return traces.IngestLock(database_location(database_path) + '.ingest.lock')
+
+
+def database_factory(database_path=None):  # pragma: no coverage
+    """A function opening the database, and creating the derived tables."""
+    def open_database_impl():
+        dbm = open_database(database_path)
+        closures.ExecutionClosures(dbm).create_table()
+        rollups.CPULoadRollups(dbm).create_tables()
+        return dbm
+
+    return open_database_impl
+
+
+def get_app(database_path=None, spool_dir=None, ingest_workers=1,
+            cache_bytes=cache.DEFAULT_MAX_BYTES):  # pragma: no coverage
+    # The database is opened by the first request of each worker.
+    return create_app(spool_dir=spool_dir,
+                      ingest_workers=ingest_workers,
+                      generation=open_generation(database_path),
+                      cache_bytes=cache_bytes,
+                      manager_factory=database_factory(database_path),
+                      ingest_lock=open_ingest_lock(database_path))
+
+
+def run_writer(ready, arguments, authkey):  # pragma: no coverage
+    """Serve the writes forwarded by the reader workers.
+
+    Args:
+        ready: A :class:`multiprocessing.Event`, set once the writer
+            accepts connections
+        arguments: The command line arguments
+        authkey: The key the readers authenticate with
+    """
+    app = create_app(spool_dir=arguments.spool_dir,
+                     ingest_workers=arguments.ingest_workers,
+                     generation=open_generation(arguments.dbpath),
+                     cache_bytes=0,
+                     manager_factory=database_factory(arguments.dbpath),
+                     metrics_dir=arguments.metrics_dir,
+                     slow_query_seconds=arguments.slow_query_ms / 1000 or None,
+                     ingest_lock=open_ingest_lock(arguments.dbpath))
+
+    if os.path.exists(arguments.writer_socket):
+        os.unlink(arguments.writer_socket)
+    server = writer.WriteServer(app, arguments.writer_socket, authkey)
+    ready.set()
+    try:
+        server.serve_forever()
+    finally:
+        server.close()
 
 
 class Marvin(gunicorn.app.base.BaseApplication):  # pragma: no coverage
@@ -108,6 +249,10 @@ def parse_cli():  # pragma: no coverage
                         '-d',
                         help='Path to the database holding the traces')
 
+    parser.add_argument('--bind',
+                        '-b',
+                        default='127.0.0.1',
+                        help='Address that the server will listen to')
     parser.add_argument('--port',
                         '-p',
                         default='8000',
@@ -117,18 +262,132 @@ def parse_cli():  # pragma: no coverage
                         type=int,
                         default=1,
                         help='Number of workers')
+    parser.add_argument('--worker-class',
+                        choices=WORKER_CLASSES,
+                        default='sync',
+                        help='Type of the workers. gthread serves --threads requests at once in '
+                        'every worker, gevent requires gevent.')
+    parser.add_argument('--threads',
+                        type=int,
+                        default=1,
+                        help='Number of threads of every gthread worker')
+    parser.add_argument('--keepalive',
+                        type=int,
+                        default=2,
+                        help='Seconds to wait for the next request on a keep-alive connection')
+    parser.add_argument('--timeout',
+                        type=int,
+                        default=30,
+                        help='Restart workers silent for more than this many seconds')
+    parser.add_argument('--max-requests',
+                        type=int,
+                        default=0,
+                        help='Restart every worker after this many requests, 0 to never restart')
+    parser.add_argument('--max-requests-jitter',
+                        type=int,
+                        default=0,
+                        help='Add a random number of requests, up to this, to --max-requests, so '
+                        'that the workers do not restart at the same time')
+    parser.add_argument('--preload',
+                        action='store_true',
+                        help='Import the application before forking the workers')
+    parser.add_argument('--log-level',
+                        choices=LOG_LEVELS,
+                        default='INFO',
+                        help='Logging level')
+    parser.add_argument('--spool-dir',
+                        help='Spool uploaded traces to this directory and ingest them in the background')
+    parser.add_argument('--ingest-workers',
+                        type=int,
+                        default=1,
+                        help='Number of background ingest threads per worker')
+    parser.add_argument('--cache-mb',
+                        type=int,
+                        default=cache.DEFAULT_MAX_BYTES >> 20,
+                        help='Size of the response cache of each worker, in MiB')
+    parser.add_argument('--writer-socket',
+                        help='Forward uploads and labels to a dedicated ingest process listening '
+                        'to this UNIX socket, and only serve reads in the workers')
+    parser.add_argument('--metrics-dir',
+                        help='Directory where the workers share their metrics. Defaults to a '
+                        'new temporary directory.')
+    parser.add_argument('--slow-query-ms',
+                        type=float,
+                        default=metrics.DEFAULT_SLOW_QUERY_SECONDS * 1000,
+                        help='Log the SQL statements slower than this many milliseconds, 0 to disable')
+    parser.add_argument('--interface',
+                        choices=['wsgi', 'asgi'],
+                        default='wsgi',
+                        help='Serve with sync WSGI workers, or with ASGI (uvicorn) workers '
+                        'running the requests in a thread pool')
+    parser.add_argument('--asgi-threads',
+                        type=int,
+                        default=asgi.DEFAULT_MAX_WORKERS,
+                        help='Number of requests served at once by each ASGI worker')
 
     return parser.parse_args()
 
 
 def main():  # pragma: no coverage
     arguments = parse_cli()
-    print(arguments)
+    logging.basicConfig(level=getattr(logging, arguments.log_level))
+    LOGGER.debug("Arguments: %s", arguments)
+
+    slow_query_seconds = arguments.slow_query_ms / 1000 or None
+    if arguments.metrics_dir is None:
+        arguments.metrics_dir = tempfile.mkdtemp(prefix='marvin-metrics-')
+    else:
+        metrics.clear_directory(arguments.metrics_dir)
+
+    # Every worker opens its own manager after it has been forked.
+    manager = managers.LazyManager(database_factory(arguments.dbpath))
+    # Flushed by the workers as they exit
+    registry = metrics.MetricsRegistry(arguments.metrics_dir)
+    generation = open_generation(arguments.dbpath)
+    cache_bytes = arguments.cache_mb << 20
+
+    if arguments.writer_socket is None:
+        app = create_app(manager,
+                         spool_dir=arguments.spool_dir,
+                         ingest_workers=arguments.ingest_workers,
+                         generation=generation,
+                         cache_bytes=cache_bytes,
+                         slow_query_seconds=slow_query_seconds,
+                         ingest_lock=open_ingest_lock(arguments.dbpath),
+                         metrics_registry=registry)
+    else:
+        authkey = os.urandom(32)
+        # Started by the gunicorn master, see the hooks below
+        writer_process = writer.WriterProcess(run_writer, (arguments, authkey))
+        app = writer.WriteRouter(create_app(manager, generation=generation, cache_bytes=cache_bytes,
+                                            slow_query_seconds=slow_query_seconds,
+                                            metrics_registry=registry),
+                                 writer.WriterClient(arguments.writer_socket, authkey))
+
     options = {
-        'bind': '%s:%s' % ('127.0.0.1', arguments.port),
-        'workers': arguments.workers
+        'bind': '%s:%s' % (arguments.bind, arguments.port),
+        'workers': arguments.workers,
+        'worker_class': arguments.worker_class,
+        'threads': arguments.threads,
+        'keepalive': arguments.keepalive,
+        'timeout': arguments.timeout,
+        'max_requests': arguments.max_requests,
+        'max_requests_jitter': arguments.max_requests_jitter,
+        'preload_app': arguments.preload,
+        'loglevel': arguments.log_level.lower(),
+        'post_fork': managers.post_fork(manager),
+        'worker_exit': registry.worker_exit,
     }
-    Marvin(get_app(arguments.dbpath), options).run()
+    if arguments.writer_socket is not None:
+        options.update(on_starting=writer_process.on_starting,
+                       when_ready=writer_process.when_ready,
+                       on_exit=writer_process.on_exit)
+    if arguments.interface == 'asgi':
+        # Requires uvicorn
+        app = asgi.WSGIBridge(app, arguments.asgi_threads)
+        options['worker_class'] = 'uvicorn.workers.UvicornWorker'
+
+    Marvin(app, options).run()
 
 
 if __name__ == '__main__':  # pragma: no coverage
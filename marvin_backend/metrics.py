@@ -0,0 +1,541 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright MonetDB Solutions B.V. 2018-2019
+"""Request and database metrics, in the Prometheus text format.
+
+:class:`MetricsMiddleware` counts the requests of every route, their
+latencies, the bytes sent and the requests in flight.
+:class:`InstrumentedManager` times the calls to the database manager.
+Both record into a :class:`MetricsRegistry`, served at ``/metrics``.
+
+The manager also adds up the database time of every request, which the
+middleware reports in a ``Server-Timing`` header next to the time
+spent encoding the response, and logs the statements slower than a
+threshold to the ``marvin_backend.slow_sql`` logger.
+
+Every gunicorn worker has its own registry. When a directory is
+given, each process regularly writes a snapshot of its registry to a
+file of its own there, and ``/metrics`` sums the snapshots of all the
+processes. Use :meth:`MetricsRegistry.worker_exit` as the gunicorn
+hook of the same name, so that the last requests of a worker are not
+lost. The counters of the workers that have exited are added to a file
+of their own, so they never go backwards, even when a new worker gets
+the pid of an exited one; their gauges are dropped.
+"""
+import bisect
+import fcntl
+import glob
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+import falcon
+
+from marvin_backend import serialization
+
+LOGGER = logging.getLogger(__name__)
+SLOW_SQL_LOGGER = logging.getLogger('marvin_backend.slow_sql')
+
+DEFAULT_SLOW_QUERY_SECONDS = 0.5
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# In seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+METRICS = {
+    'marvin_http_requests_total': (COUNTER, 'Requests served, by route, method and status'),
+    'marvin_http_request_duration_seconds': (HISTOGRAM, 'Time to produce the responses, by route and method'),
+    'marvin_http_response_bytes_total': (COUNTER, 'Bytes of the response bodies, by route and method'),
+    'marvin_http_requests_in_flight': (GAUGE, 'Requests being served'),
+    'marvin_db_call_duration_seconds': (HISTOGRAM, 'Duration of the database manager calls, by method'),
+    'marvin_db_call_errors_total': (COUNTER, 'Failed database manager calls, by method'),
+    'marvin_db_slow_calls_total': (COUNTER, 'Database manager calls slower than the threshold, by method'),
+}
+
+_SNAPSHOT_PATTERN = 'metrics-*.json'
+# The counters and histograms of the processes that have exited
+_EXITED_FILE = 'exited.json'
+_LOCK_FILE = 'metrics.lock'
+
+
+def _labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+class MetricsRegistry(object):
+    """The metrics of a process.
+
+    Args:
+        directory: The directory shared by the processes, or None if
+            this process is the only one
+        buckets: The upper bounds of the histogram buckets
+        flush_interval: The minimum number of seconds between two
+            snapshots written to ``directory``
+    """
+
+    def __init__(self, directory=None, buckets=DEFAULT_BUCKETS, flush_interval=1.0):
+        self._directory = directory
+        self._buckets = tuple(buckets)
+        self._flush_interval = flush_interval
+        self._last_flush = 0
+        # The pid of this process once it has written a snapshot, see
+        # flush()
+        self._flushed_by = None
+        self._lock = threading.Lock()
+        self._values = dict((name, dict()) for name in METRICS)
+
+    def inc(self, name, labels=None, value=1):
+        """Increase a counter, or a gauge."""
+        key = _labels_key(labels or {})
+        with self._lock:
+            series = self._values[name]
+            series[key] = series.get(key, 0) + value
+
+    def dec(self, name, labels=None, value=1):
+        self.inc(name, labels, -value)
+
+    def observe(self, name, labels, value):
+        """Add an observation to a histogram."""
+        key = _labels_key(labels)
+        index = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            series = self._values[name]
+            histogram = series.get(key)
+            if histogram is None:
+                # The counts of the buckets and +Inf, and the sum
+                histogram = series[key] = [0] * (len(self._buckets) + 1) + [0.0]
+            histogram[index] += 1
+            histogram[-1] += value
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'pid': os.getpid(),
+                'buckets': list(self._buckets),
+                'values': dict((name, [[list(k), v] for k, v in series.items()])
+                               for name, series in self._values.items()),
+            }
+
+    def flush(self, force=False):
+        """Write the snapshot of this process to the shared directory."""
+        if self._directory is None:
+            return
+
+        now = time.monotonic()
+        if not force and now - self._last_flush < self._flush_interval:
+            return
+        self._last_flush = now
+
+        path = os.path.join(self._directory, 'metrics-{}.json'.format(os.getpid()))
+        if self._flushed_by != os.getpid():
+            # A snapshot with the pid of this process was written by an
+            # exited process
+            with self._locked():
+                self._fold([path])
+            self._flushed_by = os.getpid()
+
+        _write_json(path, self.snapshot())
+
+    def worker_exit(self, server, worker):  # pragma: no coverage
+        self.flush(force=True)
+
+    def _locked(self):
+        """Lock the snapshots of the shared directory."""
+        return _FileLock(os.path.join(self._directory, _LOCK_FILE))
+
+    def _fold(self, paths):
+        """Add the snapshots of exited processes to the exited file, and
+        remove them. The caller holds :meth:`_locked`."""
+        snapshots = [s for s in (_read_json(p) for p in paths) if s is not None]
+        if not snapshots:
+            return
+
+        exited_path = os.path.join(self._directory, _EXITED_FILE)
+        totals = dict((name, dict()) for name in METRICS)
+        exited = _read_json(exited_path)
+        if exited is not None:
+            _merge(totals, exited['values'])
+        for snapshot in snapshots:
+            _merge(totals, snapshot['values'], gauges=False)
+
+        _write_json(exited_path, {
+            'buckets': list(self._buckets),
+            'values': dict((name, [[list(k), v] for k, v in series.items()])
+                           for name, series in totals.items()),
+        })
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def collect(self):
+        """The metrics of all the processes.
+
+        Returns:
+            A dictionary from metric names to dictionaries from label
+            tuples to values
+        """
+        ret = dict((name, dict()) for name in METRICS)
+        if self._directory is None:
+            _merge(ret, self.snapshot()['values'])
+            return ret
+
+        self.flush(force=True)
+        with self._locked():
+            snapshots = list()
+            exited = list()
+            for path in glob.glob(os.path.join(self._directory, _SNAPSHOT_PATTERN)):
+                snapshot = _read_json(path)
+                if snapshot is None:
+                    continue
+                if _is_alive(snapshot['pid']):
+                    snapshots.append(snapshot)
+                else:
+                    exited.append(path)
+            self._fold(exited)
+
+            snapshots.append(_read_json(os.path.join(self._directory, _EXITED_FILE)))
+
+        for snapshot in snapshots:
+            if snapshot is not None:
+                _merge(ret, snapshot['values'])
+
+        return ret
+
+    def render(self):
+        """The metrics of all the processes, in the Prometheus text format."""
+        lines = list()
+        for name, series in sorted(self.collect().items()):
+            kind, description = METRICS[name]
+            lines.append('# HELP {} {}'.format(name, description))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for key, value in sorted(series.items()):
+                if kind == HISTOGRAM:
+                    lines.extend(self._render_histogram(name, key, value))
+                else:
+                    lines.append('{}{} {}'.format(name, _format_labels(key), _format_value(value)))
+
+        return '\n'.join(lines) + '\n'
+
+    def _render_histogram(self, name, key, value):
+        cumulative = 0
+        bounds = [_format_value(b) for b in self._buckets] + ['+Inf']
+        for bound, count in zip(bounds, value[:-1]):
+            cumulative += count
+            labels = _format_labels(key + (('le', bound),))
+            yield '{}_bucket{} {}'.format(name, labels, cumulative)
+        yield '{}_sum{} {}'.format(name, _format_labels(key), _format_value(value[-1]))
+        yield '{}_count{} {}'.format(name, _format_labels(key), cumulative)
+
+
+def clear_directory(directory):
+    """Remove the snapshots left by previous runs."""
+    paths = glob.glob(os.path.join(directory, _SNAPSHOT_PATTERN))
+    paths.extend(os.path.join(directory, name) for name in (_EXITED_FILE, _LOCK_FILE))
+    for path in paths:
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+class _FileLock(object):
+    """An exclusive ``flock`` on a file, as a context manager."""
+
+    def __init__(self, path):
+        self._path = path
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self._path, 'a')
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Closing the file releases the flock
+        self._file.close()
+        self._file = None
+
+
+def _read_json(path):
+    try:
+        with open(path) as fl:
+            return json.load(fl)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError):
+        LOGGER.warning("Could not read the metrics snapshot %s", path)
+        return None
+
+
+def _write_json(path, value):
+    # Write and rename, so that readers never see a partial file.
+    temporary = path + '.tmp'
+    with open(temporary, 'w') as fl:
+        json.dump(value, fl)
+    os.replace(temporary, path)
+
+
+def _merge(totals, values, gauges=True):
+    """Add the values of a snapshot to ``totals``."""
+    for name, series in values.items():
+        if name not in METRICS or (METRICS[name][0] == GAUGE and not gauges):
+            continue
+        for key, value in series:
+            key = tuple(tuple(pair) for pair in key)
+            totals[name][key] = _add(totals[name].get(key), value)
+
+
+def _is_alive(pid):
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+    return True
+
+
+def _add(total, value):
+    if total is None:
+        return list(value) if isinstance(value, list) else value
+    if isinstance(value, list):
+        return [a + b for a, b in zip(total, value)]
+
+    return total + value
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(key):
+    if not key:
+        return ''
+
+    return '{' + ','.join('{}="{}"'.format(k, _escape(v)) for k, v in key) + '}'
+
+
+def _format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+
+    return repr(value)
+
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_PARAMETER = re.compile(r"%\(\w+\)s|%s")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_VALUE_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+_WHITESPACE = re.compile(r"\s+")
+# The statements producing a result set, even an empty one
+_RESULT_SET = re.compile(r"^\s*(?:SELECT|WITH|VALUES)\b", re.IGNORECASE)
+
+
+def normalize_sql(sql):
+    """The text of a statement without its values, so that executions
+    of the same statement with different values can be grouped."""
+    sql = _STRING_LITERAL.sub('?', sql)
+    sql = _PARAMETER.sub('?', sql)
+    sql = _NUMBER.sub('?', sql)
+    sql = _VALUE_LIST.sub('(...)', sql)
+
+    return _WHITESPACE.sub(' ', sql).strip()
+
+
+class RequestTimings(threading.local):
+    """The database calls made by the request served by this thread."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.seconds = 0.0
+        self.calls = 0
+        self.rows = 0
+
+    def add(self, seconds, rows=0):
+        self.seconds += seconds
+        self.calls += 1
+        self.rows += rows
+
+
+def server_timing(timings, serialization_seconds, total_seconds):
+    """The value of the ``Server-Timing`` header of a response."""
+    metrics = ['db;dur={:.2f};desc="{} calls / {} rows"'.format(timings.seconds * 1000, timings.calls, timings.rows)]
+    if serialization_seconds is not None:
+        metrics.append('serialize;dur={:.2f}'.format(serialization_seconds * 1000))
+    metrics.append('total;dur={:.2f}'.format(total_seconds * 1000))
+
+    return ', '.join(metrics)
+
+
+def route_of(req, resource):
+    """The route template of a request, to label its metrics with."""
+    template = getattr(req, 'uri_template', None)
+    if template:
+        return template
+    if resource is not None:
+        # falcon < 2.0 does not record the template
+        return type(resource).__name__
+
+    return 'unmatched'
+
+
+class _CountingStream(object):
+    """Count the bytes of a streamed response as they are sent."""
+
+    def __init__(self, stream, metrics, labels):
+        self._stream = stream
+        self._metrics = metrics
+        self._labels = labels
+
+    def __iter__(self):
+        for block in self._stream:
+            self._metrics.inc('marvin_http_response_bytes_total', self._labels, len(block))
+            yield block
+
+    def close(self):
+        if hasattr(self._stream, 'close'):
+            self._stream.close()
+
+
+class MetricsMiddleware(object):
+    """Record the metrics of every request.
+
+    This must be the first middleware, so that it sees the responses
+    as they are sent, e.g. compressed.
+
+    Args:
+        metrics: The :class:`MetricsRegistry`
+        timings: The :class:`RequestTimings` of the database manager.
+            If given, the responses carry a ``Server-Timing`` header.
+    """
+
+    def __init__(self, metrics, timings=None):
+        self._metrics = metrics
+        self._timings = timings
+
+    def process_request(self, req, resp):
+        req.context['metrics_start'] = time.perf_counter()
+        self._metrics.inc('marvin_http_requests_in_flight')
+        if self._timings is not None:
+            self._timings.reset()
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        start = req.context.get('metrics_start')
+        if start is None:
+            return
+
+        duration = time.perf_counter() - start
+        if self._timings is not None:
+            resp.set_header('Server-Timing',
+                            server_timing(self._timings, req.context.get('serialization_seconds'), duration))
+
+        labels = {'route': route_of(req, resource), 'method': req.method}
+        self._metrics.observe('marvin_http_request_duration_seconds', labels, duration)
+        self._metrics.inc('marvin_http_requests_total', dict(labels, status=resp.status.split(' ', 1)[0]))
+
+        body = resp.body
+        if body is not None:
+            size = len(body.encode('utf-8') if isinstance(body, str) else body)
+            self._metrics.inc('marvin_http_response_bytes_total', labels, size)
+        elif resp.data is not None:
+            self._metrics.inc('marvin_http_response_bytes_total', labels, len(resp.data))
+        elif resp.stream is not None:
+            resp.stream = _CountingStream(resp.stream, self._metrics, labels)
+
+        self._metrics.dec('marvin_http_requests_in_flight')
+        self._metrics.flush()
+
+
+class MetricsResource(object):
+    """The metrics, in the Prometheus text format.
+
+    Args:
+        metrics: The :class:`MetricsRegistry`
+    """
+
+    def __init__(self, metrics):
+        self._metrics = metrics
+
+    def on_get(self, req, resp):
+        resp.content_type = CONTENT_TYPE
+        resp.body = self._metrics.render()
+        resp.status = falcon.HTTP_200
+
+
+class InstrumentedManager(object):
+    """A database manager recording the duration of its calls.
+
+    ``execute_query`` and ``parse_trace`` are timed. Every other
+    attribute is looked up on the wrapped manager.
+
+    Args:
+        manager: The database manager
+        metrics: The :class:`MetricsRegistry`
+        timings: The :class:`RequestTimings` adding up the calls of
+            every request
+        slow_query_seconds: Log the calls taking longer than this. None
+            disables the log.
+    """
+
+    def __init__(self, manager, metrics, timings=None, slow_query_seconds=None):
+        self._manager = manager
+        self._metrics = metrics
+        self._timings = timings
+        self._slow_query_seconds = slow_query_seconds
+
+    def _record(self, method, seconds, rows, describe):
+        labels = {'method': method}
+        self._metrics.observe('marvin_db_call_duration_seconds', labels, seconds)
+        if self._timings is not None:
+            self._timings.add(seconds, rows)
+        if self._slow_query_seconds is not None and seconds >= self._slow_query_seconds:
+            self._metrics.inc('marvin_db_slow_calls_total', labels)
+            SLOW_SQL_LOGGER.warning("%.3f s, %d rows: %s", seconds, rows, describe())
+
+    def execute_query(self, query, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            result = self._manager.execute_query(query, *args, **kwargs)
+        except Exception:
+            self._metrics.inc('marvin_db_call_errors_total', {'method': 'execute_query'})
+            self._record('execute_query', time.perf_counter() - start, 0, lambda: normalize_sql(query))
+            raise
+        seconds = time.perf_counter() - start
+
+        # The manager reports errors by returning None, but the
+        # statements without a result set, e.g. DDL, may return None
+        # as well.
+        if result is None and _RESULT_SET.match(query):
+            self._metrics.inc('marvin_db_call_errors_total', {'method': 'execute_query'})
+        rows = serialization.row_count(result) if result else 0
+        self._record('execute_query', seconds, rows, lambda: normalize_sql(query))
+
+        return result
+
+    def parse_trace(self, trace, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self._manager.parse_trace(trace, *args, **kwargs)
+        except Exception:
+            self._metrics.inc('marvin_db_call_errors_total', {'method': 'parse_trace'})
+            raise
+        finally:
+            self._record('parse_trace', time.perf_counter() - start, 0,
+                         lambda: 'parse_trace of {} characters'.format(len(trace)))
+
+    def __getattr__(self, name):
+        return getattr(self._manager, name)
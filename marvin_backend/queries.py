@@ -8,8 +8,9 @@ import json
 import logging
 
 import falcon
+import numpy as np
 
-from marvin_backend import utils
+from marvin_backend import cache, serialization, utils
 
 LOGGER = logging.getLogger(__name__)
 
@@ -19,20 +20,34 @@ class Queries(object):
         self._db = db
 
     @utils.api_endpoint
-    def on_get(self, req, resp):
-        all_queries_sql = "SELECT * FROM query"
-        all_queries = self._db.execute_query(all_queries_sql)
+    @utils.paginated('query_id')
+    def on_get(self, req, resp, page):
+        all_queries_sql = page.sql('query', 'query_id')
+        all_queries = self._db.execute_query(all_queries_sql, page.params())
 
         return all_queries
 
 
 class SingleQuery(object):
-    def __init__(self, db):
+    """A single query.
+
+    Args:
+        db: The database manager
+        generation: The :class:`marvin_backend.generations.Generation`
+            to bump when a query is labeled
+        response_cache: The :class:`marvin_backend.cache.ResponseCache`
+            holding responses about the query
+    """
+
+    def __init__(self, db, generation=None, response_cache=None):
         self._db = db
+        self._generation = generation
+        self._cache = response_cache
 
     def on_patch(self, req, resp, qid):
-        if req.content_length:
-            doc = json.loads(req.stream.read(req.content_length))
+        body = utils.read_body(req)
+        if body:
+            doc = json.loads(body)
             label = doc.get('label')
             if label is None:
                 # Bad request
@@ -68,6 +83,9 @@ class SingleQuery(object):
 
         add_label_sql = "UPDATE query SET query_label=%(label)s WHERE query_id=%(qid)s"
         self._db.execute_query(add_label_sql, dict([("label", label), ("qid", qid)]))
+        generation = self._generation.bump() if self._generation is not None else None
+        if self._cache is not None:
+            self._cache.invalidate([cache.query_tag(qid)], generation)
 
     @utils.api_endpoint_singleton_result
     @utils.api_endpoint_404_on_empty
@@ -80,33 +98,101 @@ class SingleQuery(object):
         return query
 
 
+# How QueryExecutions walks the execution graph of a query:
+#
+# DATABASE_TRAVERSAL asks the database for the edges leaving the
+# current frontier of the search, one level of the graph at a time,
+# so that only the part of the graph reachable from the query is ever
+# transferred. MonetDB does not support recursive common table
+# expressions, so the recursion happens here.
+#
+# IN_PROCESS_TRAVERSAL fetches all the edges and searches the graph in
+# memory. It is also used as a fallback if the first method fails.
+DATABASE_TRAVERSAL = 'database'
+IN_PROCESS_TRAVERSAL = 'in_process'
+
+
 class QueryExecutions(object):
-    def __init__(self, db):
+    """The executions of a query.
+
+    Args:
+        db: The database manager
+        traversal: How to search the execution graph, either
+            DATABASE_TRAVERSAL or IN_PROCESS_TRAVERSAL
+        closures: A :class:`marvin_backend.closures.ExecutionClosures`
+            to look up the stored executions before searching the graph
+    """
+
+    def __init__(self, db, traversal=DATABASE_TRAVERSAL, closures=None):
         self._db = db
+        self._traversal = traversal
+        self._closures = closures
+
+    def root_execution(self, qid):
+        start_node_sql = "SELECT root_execution_id FROM query WHERE query_id=%(qid)s"
+        start_node = self._db.execute_query(start_node_sql, {'qid': qid})
+
+        if not start_node or len(start_node["root_execution_id"]) == 0 or start_node["root_execution_id"][0] is np.ma.masked:
+            raise Exception("Query {} not found".format(qid))
+
+        return start_node
 
     # TODO Move this method out of this class. Maybe add a layer that handles
     # all the interactions with the DB?
     def gather_executions(self, qid):
-        edges_sql = "SELECT parent_id, child_id FROM initiates_executions"
-        start_node_sql = "SELECT root_execution_id FROM query WHERE query_id=%(qid)s"
-
-        all_nodes = self._db.execute_query("SELECT execution_id FROM mal_execution")
-        exec_graph_edges = self._db.execute_query(edges_sql)
-        start_node = self._db.execute_query(start_node_sql, {'qid': qid})
+        if self._closures is not None:
+            execution_ids = self._closures.lookup(qid)
+            if execution_ids is not None:
+                return execution_ids
 
-        LOGGER.debug("*" * 30)
-        LOGGER.debug("All nodes: %s", all_nodes['execution_id'])
-        LOGGER.debug("All edges: %s", list(zip(exec_graph_edges['parent_id'], exec_graph_edges['child_id'])))
+        start_node = self.root_execution(qid)
         LOGGER.debug("Start node: %s", start_node)
-        LOGGER.debug("Edges data: %s", exec_graph_edges)
-        LOGGER.debug("*" * 30)
 
-        if exec_graph_edges["child_id"].size == 0 or not start_node["root_execution_id"]:
-            raise Exception
+        if self._traversal == DATABASE_TRAVERSAL:
+            execution_ids = self._traverse_in_database(start_node)
+            if execution_ids is not None:
+                return execution_ids
+            LOGGER.warning("Execution graph traversal in the database failed, falling back to in process traversal")
+
+        return self._traverse_in_process(start_node)
+
+    def _traverse_in_database(self, start_node):
+        frontier_sql = "SELECT parent_id, child_id FROM initiates_executions WHERE parent_id IN ({}) ORDER BY initiates_executions_id"
+
+        root = int(start_node['root_execution_id'][0])
+        visited = {root}
+        frontier = [root]
+        edges = {'parent_id': [], 'child_id': []}
+        while frontier:
+            level = self._db.execute_query(frontier_sql.format(utils.sql_int_list(frontier)))
+            if level is None:
+                return None
+
+            children = serialization.column_to_list(level['child_id'])
+            edges['parent_id'].extend(serialization.column_to_list(level['parent_id']))
+            edges['child_id'].extend(children)
+
+            frontier = list()
+            for child in children:
+                if child not in visited:
+                    visited.add(child)
+                    frontier.append(child)
+
+        # The edges gathered are exactly the reachable part of the graph,
+        # so searching them yields the nodes in breadth first order.
+        return utils.find_query_execution_ids(start_node, edges)
+
+    def _traverse_in_process(self, start_node):
+        edges_sql = "SELECT parent_id, child_id FROM initiates_executions"
+        exec_graph_edges = self._db.execute_query(edges_sql)
+
+        if exec_graph_edges is None or exec_graph_edges["child_id"].size == 0:
+            raise Exception("No execution graph edges found")
 
         return utils.find_query_execution_ids(start_node, exec_graph_edges)  # Do we need to abstract this by passing a function to be executed for every visited node?
 
     def on_get(self, req, resp, qid):
+        layout = serialization.requested_layout(req)
 
         try:
             execution_ids = self.gather_executions(qid)
@@ -114,13 +200,17 @@ class QueryExecutions(object):
             resp.status = falcon.HTTP_404
             return
 
-        doc = {
-            'links': {
-                'url': req.url,
-            },
-            'data': execution_ids,
-            'data_length': len(execution_ids),
+        links = {
+            'url': req.url,
         }
+        if layout == serialization.COLUMNAR_LAYOUT:
+            doc = serialization.columnar_document(links, {'execution_id': execution_ids})
+        else:
+            doc = {
+                'links': links,
+                'data': execution_ids,
+                'data_length': len(execution_ids),
+            }
 
         resp.body = json.dumps(doc, ensure_ascii=False, cls=utils.NumpyJSONEncoder)
         resp.status = falcon.HTTP_200
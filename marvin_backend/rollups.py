@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright MonetDB Solutions B.V. 2018-2019
+import logging
+
+import numpy as np
+
+from marvin_backend import serialization
+
+LOGGER = logging.getLogger(__name__)
+
+# ctime is measured in microseconds
+SECOND = 1000000
+MINUTE = 60 * SECOND
+HOUR = 60 * MINUTE
+
+# The widths of the time buckets of the coarser rollup levels
+RESOLUTIONS = (MINUTE, HOUR)
+
+# The average load of every heartbeat over all the cores, and the
+# number of cores it was averaged over.
+CREATE_HEARTBEAT_TABLE_SQL = """CREATE TABLE IF NOT EXISTS heartbeat_cpuload (
+    heartbeat_id bigint NOT NULL,
+    server_session char(36) NOT NULL,
+    ctime bigint,
+    cpuload double,
+    cores int,
+
+    CONSTRAINT pk_heartbeat_cpuload PRIMARY KEY (heartbeat_id)
+)"""
+
+# The sum of the per core loads, the number of loads summed and the
+# number of heartbeats in time buckets of a given resolution. Sums are
+# kept instead of averages so that buckets can be recomputed and
+# combined exactly.
+CREATE_ROLLUP_TABLE_SQL = """CREATE TABLE IF NOT EXISTS cpuload_rollup (
+    resolution bigint NOT NULL,
+    server_session char(36) NOT NULL,
+    ctime bigint NOT NULL,
+    load_sum double,
+    samples bigint,
+    heartbeats bigint,
+
+    CONSTRAINT pk_cpuload_rollup PRIMARY KEY (resolution, server_session, ctime)
+)"""
+
+
+def resolution_for(bucket):
+    """The coarsest rollup level that can be aggregated into ``bucket``.
+
+    Returns:
+        The resolution of the level, or None if the buckets should be
+        computed from the per heartbeat level.
+    """
+    usable = [r for r in RESOLUTIONS if r <= bucket and bucket % r == 0]
+    return max(usable) if usable else None
+
+
+class CPULoadRollups(object):
+    """Maintain the CPU load rollup tables.
+
+    The CPU load endpoints only need the average load of each heartbeat
+    or of a time bucket, so instead of aggregating the ``cpuload``
+    table on every request we aggregate it once, when the heartbeats
+    are ingested.
+
+    Args:
+        db: The database manager
+    """
+
+    def __init__(self, db):
+        self._db = db
+
+    def create_tables(self):
+        self._db.execute_query(CREATE_HEARTBEAT_TABLE_SQL)
+        self._db.execute_query(CREATE_ROLLUP_TABLE_SQL)
+
+    def before_ingest(self):
+        """Record the last heartbeat before a trace is ingested."""
+        result = self._db.execute_query("SELECT max(heartbeat_id) AS max_heartbeat_id FROM heartbeat")
+
+        if not result or len(result['max_heartbeat_id']) == 0 or result['max_heartbeat_id'][0] is np.ma.masked:
+            return {'max_heartbeat_id': 0}
+        return {'max_heartbeat_id': int(result['max_heartbeat_id'][0])}
+
+    def after_ingest(self, limits):
+        """Aggregate the heartbeats ingested since :meth:`before_ingest`."""
+        self.update(limits['max_heartbeat_id'])
+
+    def update(self, max_heartbeat_id):
+        """Aggregate the heartbeats after ``max_heartbeat_id``.
+
+        Returns:
+            The number of server sessions with new heartbeats
+        """
+        heartbeats_sql = ("INSERT INTO heartbeat_cpuload "
+                          "SELECT h.heartbeat_id, h.server_session, h.ctime, avg(c.val), count(c.val) "
+                          "FROM heartbeat AS h JOIN cpuload AS c ON c.heartbeat_id=h.heartbeat_id "
+                          "WHERE h.heartbeat_id > %(max_heartbeat_id)s "
+                          "GROUP BY h.heartbeat_id, h.server_session, h.ctime")
+        ranges_sql = ("SELECT server_session, min(ctime) AS start_t, max(ctime) AS end_t FROM heartbeat "
+                      "WHERE heartbeat_id > %(max_heartbeat_id)s GROUP BY server_session")
+
+        params = {'max_heartbeat_id': max_heartbeat_id}
+        self._db.execute_query(heartbeats_sql, params)
+
+        ranges = self._db.execute_query(ranges_sql, params)
+        if not ranges:
+            return 0
+
+        sessions = serialization.column_to_list(ranges['server_session'])
+        for sid, start_t, end_t in zip(sessions,
+                                       serialization.column_to_list(ranges['start_t']),
+                                       serialization.column_to_list(ranges['end_t'])):
+            if start_t is None or end_t is None:
+                # None of the new heartbeats has a ctime
+                LOGGER.warning("No ctime in the heartbeats of server session %s, not rolled up", sid)
+                continue
+            for resolution in RESOLUTIONS:
+                self._refresh_buckets(resolution, sid, start_t, end_t)
+
+        LOGGER.info("Updated the CPU load rollups of %d server sessions", len(sessions))
+        return len(sessions)
+
+    def _refresh_buckets(self, resolution, sid, start_t, end_t):
+        # The first and the last bucket may already contain heartbeats
+        # from earlier traces, so all the buckets in the range are
+        # recomputed from the per heartbeat level.
+        delete_sql = ("DELETE FROM cpuload_rollup WHERE resolution=%(resolution)s AND server_session=%(sid)s "
+                      "AND ctime>=%(first_bucket)s AND ctime<=%(last_bucket)s")
+        insert_sql = ("INSERT INTO cpuload_rollup "
+                      "SELECT %(resolution)s, b.server_session, b.ctime, sum(b.cpuload * b.cores), sum(b.cores), count(*) "
+                      "FROM (SELECT server_session, (ctime / %(resolution)s) * %(resolution)s AS ctime, cpuload, cores "
+                      "FROM heartbeat_cpuload WHERE server_session=%(sid)s "
+                      "AND ctime>=%(first_bucket)s AND ctime<%(end_bucket)s) AS b "
+                      "GROUP BY b.server_session, b.ctime")
+
+        first_bucket = (start_t // resolution) * resolution
+        last_bucket = (end_t // resolution) * resolution
+        params = {
+            'resolution': resolution,
+            'sid': sid,
+            'first_bucket': first_bucket,
+            'last_bucket': last_bucket,
+            'end_bucket': last_bucket + resolution,
+        }
+        self._db.execute_query(delete_sql, params)
+        self._db.execute_query(insert_sql, params)
+
+    def backfill(self):
+        """Aggregate all the heartbeats in the database.
+
+        Returns:
+            The number of server sessions aggregated
+        """
+        self.create_tables()
+        self._db.execute_query("DELETE FROM heartbeat_cpuload")
+        self._db.execute_query("DELETE FROM cpuload_rollup")
+
+        return self.update(-1)
@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright MonetDB Solutions B.V. 2018-2019
+from collections.abc import Sequence
+import json
+import logging
+import os
+
+import falcon
+import numpy as np
+
+try:
+    import orjson
+except ImportError:  # pragma: no coverage
+    orjson = None
+
+try:
+    import ujson
+except ImportError:  # pragma: no coverage
+    ujson = None
+
+try:
+    import pyarrow
+except ImportError:  # pragma: no coverage
+    pyarrow = None
+
+LOGGER = logging.getLogger(__name__)
+
+# The layouts a client can request with the ``layout`` parameter. The
+# default ``rows`` layout returns a list of objects under ``data``,
+# while ``columnar`` returns an object of lists under ``columns``, the
+# way the database hands the results to us.
+ROWS_LAYOUT = 'rows'
+COLUMNAR_LAYOUT = 'columnar'
+LAYOUTS = (ROWS_LAYOUT, COLUMNAR_LAYOUT)
+
+# The media types a response can be encoded in. Apache Arrow IPC
+# streams are only available if pyarrow is installed.
+JSON_MEDIA_TYPE = 'application/json'
+ARROW_STREAM_MEDIA_TYPE = 'application/vnd.apache.arrow.stream'
+
+# Number of rows in each record batch of an Arrow stream.
+ARROW_BATCH_ROWS = 65536
+
+# Results with more rows than this are streamed to the client instead
+# of being encoded in one go.
+STREAMING_THRESHOLD = 10000
+
+# Number of rows encoded at a time when streaming a result.
+CHUNK_ROWS = 1000
+
+
+def row_count(dl):
+    """The number of rows in a dict of lists (or arrays)."""
+    for column in dl.values():
+        return len(column)
+
+    return 0
+
+
+def column_to_list(column):
+    """Turn a (numpy) column into a list of Python objects.
+
+    Numpy arrays are converted in bulk with ``tolist``, which also turns
+    the masked elements of masked arrays into ``None``. Plain lists are
+    only copied, converting any numpy scalars they contain.
+    """
+    if hasattr(column, 'tolist'):
+        return column.tolist()
+
+    return [v.item() if isinstance(v, np.generic) else v for v in column]
+
+
+def encode_columns(dl):
+    """Convert all the columns of a result to lists of Python objects.
+
+    After this, the result can be encoded by any JSON library without
+    falling back to Python code for every value.
+    """
+    return dict((k, column_to_list(v)) for k, v in dl.items())
+
+
+# JSON backends: functions that turn a document into UTF-8 encoded
+# bytes. The documents handed to them have already gone through
+# encode_columns, so they only need to handle Python types. numpy
+# values that reach them anyway (e.g. in hand built documents) are
+# handled by _numpy_default, when the library supports a fallback.
+def _numpy_default(obj):
+    if isinstance(obj, np.generic):
+        return obj.item()
+    elif isinstance(obj, np.ndarray):
+        return obj.tolist()
+    raise TypeError("Object of type {} is not JSON serializable".format(type(obj).__name__))
+
+
+def _json_dumps(obj):
+    return json.dumps(obj, ensure_ascii=False, default=_numpy_default).encode('utf-8')
+
+
+def _orjson_dumps(obj):
+    return orjson.dumps(obj, default=_numpy_default)
+
+
+def _ujson_dumps(obj):
+    return ujson.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+
+JSON_BACKENDS = {
+    'json': _json_dumps,
+}
+if orjson is not None:  # pragma: no coverage
+    JSON_BACKENDS['orjson'] = _orjson_dumps
+if ujson is not None:  # pragma: no coverage
+    JSON_BACKENDS['ujson'] = _ujson_dumps
+
+_json_backend = _json_dumps
+
+
+def register_json_backend(name, dumps):
+    """Make a new JSON backend available.
+
+    Args:
+        name: The name of the backend
+        dumps: A function turning a document into UTF-8 encoded bytes
+    """
+    JSON_BACKENDS[name] = dumps
+
+
+def set_json_backend(name):
+    """Select the JSON backend used to encode the responses.
+
+    Args:
+        name: One of the keys of :data:`JSON_BACKENDS`
+    """
+    global _json_backend
+    try:
+        _json_backend = JSON_BACKENDS[name]
+    except KeyError:
+        raise ValueError("Unknown JSON backend {} (available: {})".format(name, ', '.join(sorted(JSON_BACKENDS))))
+
+    LOGGER.info("Using JSON backend %s", name)
+
+
+if os.environ.get('MARVIN_JSON_BACKEND'):  # pragma: no coverage
+    set_json_backend(os.environ['MARVIN_JSON_BACKEND'])
+
+
+def dumps(obj):
+    """Encode a document with the selected JSON backend.
+
+    Returns:
+        The document as UTF-8 encoded bytes
+    """
+    return _json_backend(obj)
+
+
+def requested_layout(req):
+    """The document layout requested with the ``layout`` parameter."""
+    layout = req.get_param('layout') or ROWS_LAYOUT
+    if layout not in LAYOUTS:
+        msg = 'The value must be one of {}.'.format(', '.join(LAYOUTS))
+        raise falcon.HTTPInvalidParam(msg, 'layout')
+
+    return layout
+
+
+def requested_media_type(req):
+    """Negotiate the media type of the response with the client.
+
+    JSON is used unless the client explicitly asks for an Arrow stream
+    in the ``Accept`` header.
+
+    Raises:
+        falcon.HTTPNotAcceptable: If an Arrow stream is requested but
+            pyarrow is not installed.
+    """
+    # The last media type is preferred when the client accepts anything.
+    preferred = req.client_prefers([ARROW_STREAM_MEDIA_TYPE, JSON_MEDIA_TYPE])
+    if preferred != ARROW_STREAM_MEDIA_TYPE:
+        return JSON_MEDIA_TYPE
+
+    if pyarrow is None:
+        raise falcon.HTTPNotAcceptable('Arrow streams are not supported by this server (pyarrow is not installed).')
+
+    return ARROW_STREAM_MEDIA_TYPE
+
+
+def _arrow_array(column):
+    # numpy arrays of fixed width types are handed over to Arrow without
+    # copying. The mask of a masked array becomes the validity bitmap.
+    if isinstance(column, np.ma.MaskedArray):
+        return pyarrow.array(column.data, mask=np.ma.getmaskarray(column))
+
+    return pyarrow.array(column)
+
+
+def arrow_stream(dl, metadata=None):
+    """Encode a result as an Apache Arrow IPC stream.
+
+    Args:
+        dl: The result as a dictionary of lists
+        metadata: A dictionary of strings attached to the schema
+
+    Returns:
+        The stream as bytes
+    """
+    length = row_count(dl)
+    names = list(dl)
+    arrays = [_arrow_array(dl[k]) for k in names]
+    table = pyarrow.Table.from_arrays(arrays, names=names, metadata=metadata)
+
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+        if length > 0:
+            writer.write_table(table, max_chunksize=ARROW_BATCH_ROWS)
+
+    return sink.getvalue().to_pybytes()
+
+
+def columnar_document(links, dl):
+    """Build a document holding a result in the columnar layout.
+
+    Every column is converted in one go, and the keys appear once in
+    the document instead of once per row.
+
+    Args:
+        links: The links of the document
+        dl: The result as a dictionary of lists
+
+    Returns:
+        A dictionary ready to be encoded as JSON
+    """
+    return {
+        'links': links,
+        'columns': encode_columns(dl),
+        'data_length': row_count(dl),
+    }
+
+
+def rows_document(links, dl):
+    """Build a document holding a result in the rows layout.
+
+    The columns are converted to Python objects before the transpose,
+    so that the individual values do not need any special handling by
+    the JSON backend.
+
+    Args:
+        links: The links of the document
+        dl: The result as a dictionary of lists
+
+    Returns:
+        A dictionary ready to be encoded as JSON
+    """
+    columns = encode_columns(dl)
+    rows = [dict(zip(columns, t)) for t in zip(*columns.values())]
+
+    return {
+        'links': links,
+        'data': rows,
+        'data_length': len(rows),
+    }
+
+
+class Rows(Sequence):
+    """A row oriented view over a column oriented result.
+
+    This behaves like the list returned by
+    :func:`marvin_backend.utils.DLtoLD`, but rows are only built when
+    they are accessed.
+
+    Args:
+        dl: A dictionary of lists
+    """
+
+    def __init__(self, dl):
+        self._dl = dl
+
+    def __len__(self):
+        return row_count(self._dl)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+
+        return dict((k, v[idx]) for k, v in self._dl.items())
+
+
+def iter_json_document(links, dl, chunk_rows=None):
+    """Encode a result as a JSON document, a chunk of rows at a time.
+
+    The document has the same shape as the one built by
+    :func:`marvin_backend.utils.api_endpoint`, but it is produced
+    directly from the columns, so that at no point the whole result
+    exists as a list of rows or as a single string.
+
+    Args:
+        links: The links of the document
+        dl: The result as a dictionary of lists
+        chunk_rows: The number of rows encoded at a time. Defaults to
+            :data:`CHUNK_ROWS`.
+
+    Yields:
+        Parts of the document as UTF-8 encoded bytes
+    """
+    chunk_rows = chunk_rows or CHUNK_ROWS
+    length = row_count(dl)
+    keys = list(dl)
+
+    yield b'{"links": ' + dumps(links) + b', "data": ['
+    for start in range(0, length, chunk_rows):
+        columns = [column_to_list(dl[k][start:start + chunk_rows]) for k in keys]
+        rows = [dict(zip(keys, t)) for t in zip(*columns)]
+
+        # Strip the brackets so that the chunks form a single list.
+        chunk = dumps(rows)[1:-1]
+        if start > 0:
+            chunk = b', ' + chunk
+        yield chunk
+    yield '], "data_length": {}}}'.format(length).encode('utf-8')
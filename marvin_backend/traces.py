@@ -4,29 +4,189 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 #
 # Copyright MonetDB Solutions B.V. 2018-2019
+import codecs
+import fcntl
 import json
 import logging
+import tarfile
+import threading
 
 import falcon
+from mal_analytics import trace_reader
+
+from marvin_backend import jobs, serialization, utils
 
 LOGGER = logging.getLogger(__name__)
 
+# Bodies larger than this, or sent with chunked transfer encoding, are
+# parsed while they are read instead of being read in one go.
+STREAMING_INGEST_THRESHOLD = 8 << 20
+
+# Size of the blocks read from the request
+READ_BLOCK_SIZE = 64 << 10
+
+# Number of events parsed and inserted at a time when streaming
+BATCH_EVENTS = 10000
+
+# The tables of the trace parser that it reads back while parsing, and
+# that are kept whole when streaming
+PARSER_LOOKUP_TABLES = ('mal_execution',)
+
+# The envelopes accepted by the batch upload endpoint
+TAR_MEDIA_TYPE = 'application/x-tar'
+NDJSON_MEDIA_TYPE = 'application/x-ndjson'
+BATCH_MEDIA_TYPES = (TAR_MEDIA_TYPE, NDJSON_MEDIA_TYPE)
+
+
+class IngestLock(object):
+    """A lock serializing the ingestions into a database.
+
+    Args:
+        path: A file locked with ``flock`` during every ingestion, to
+            serialize the ingestions of all the processes using the
+            same file. Without it, only the ingestions of this process
+            are serialized.
+    """
+
+    def __init__(self, path=None):
+        self._path = path
+        self._lock = threading.Lock()
+        self._file = None
+
+    def __enter__(self):
+        self._lock.acquire()
+        if self._path is not None:
+            try:
+                self._file = open(self._path, 'a')
+                fcntl.flock(self._file, fcntl.LOCK_EX)
+            except Exception:
+                self._release()
+                raise
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._release()
+
+    def _release(self):
+        if self._file is not None:
+            # Closing the file releases the flock
+            self._file.close()
+            self._file = None
+        self._lock.release()
+
 
 class Traces(object):
-    def __init__(self, db):
+    """Trace uploads.
+
+    By default a trace is ingested during the request. After
+    :meth:`enable_jobs` the trace is only spooled, and the response is
+    ``202 Accepted`` with the job that will ingest it, whose status is
+    served by :class:`TraceJob`.
+
+    Args:
+        db: The database manager
+        hooks: Objects maintaining data derived from the traces. Each
+            hook's ``before_ingest`` method is called before a trace is
+            parsed, and its result is passed to ``after_ingest`` once
+            the trace has been stored.
+        lock: The :class:`IngestLock` of the database. The hooks
+            record the state of the database before a trace is
+            ingested, so ingestions must not overlap. Defaults to a
+            lock serializing the ingestions of this process only.
+    """
+
+    def __init__(self, db, hooks=None, lock=None):
         self._db = db
+        self._hooks = list(hooks or [])
+        self._jobs = None
+        self._ingest_lock = lock or IngestLock()
+
+    @property
+    def jobs(self):
+        return self._jobs
+
+    def enable_jobs(self, spool_dir, workers=1):
+        """Ingest the uploaded traces in the background.
+
+        Args:
+            spool_dir: The directory to spool the traces to
+            workers: The number of background ingest threads
+
+        Returns:
+            The :class:`marvin_backend.jobs.IngestJobs` queue
+        """
+        self._jobs = jobs.IngestJobs(spool_dir, self.ingest_file, workers)
+        return self._jobs
+
+    def ingest(self, parse):
+        """Store a trace, running the hooks around it.
+
+        Args:
+            parse: A function storing the trace in the database
+
+        Returns:
+            The result of ``parse``
+        """
+        with self._ingest_lock:
+            states = [hook.before_ingest() for hook in self._hooks]
+            result = parse()
+
+            # The trace is in the database at this point, so failing to
+            # update the derived data is not an error of the request.
+            for hook, state in zip(self._hooks, states):
+                try:
+                    hook.after_ingest(state)
+                except Exception:
+                    LOGGER.exception("Ingest hook %s failed", type(hook).__name__)
+
+        return result
+
+    def ingest_file(self, path):
+        """Store a trace file.
+
+        Returns:
+            The number of rows inserted in each table
+        """
+        return self.ingest(lambda: load_trace_file(self._db, path))
 
     def on_post(self, req, resp):
-        # If Content-Length happens to be 0, or the header is missing
-        # altogether, this will not block.
-        req_body_bytes = req.stream.read(req.content_length or 0)
+        length = utils.body_length(req)
 
-        LOGGER.debug("Incoming data length %d", len(req_body_bytes))
+        if self._jobs is not None:
+            job = self._jobs.submit(req.stream, length)
+            doc = {
+                'links': {
+                    'status': '{}/traces/{}'.format(req.prefix, job['job_id']),
+                },
+                'data': job,
+            }
+            resp.body = json.dumps(doc)
+            resp.location = doc['links']['status']
+            resp.status = falcon.HTTP_ACCEPTED
+            return
+
+        if length is None or length > STREAMING_INGEST_THRESHOLD:
+            LOGGER.debug("Streaming incoming data, length %s", length)
+
+            def parse():
+                return load_trace_stream(self._db, iter_events(read_blocks(req.stream, length)))
+        else:
+            # If Content-Length happens to be 0, or the header is missing
+            # altogether, this will not block.
+            req_body_bytes = req.stream.read(length)
+            LOGGER.debug("Incoming data length %d", len(req_body_bytes))
+
+            def parse():
+                return self._db.parse_trace(req_body_bytes.decode("utf-8"))
 
         try:
-            self._db.parse_trace(req_body_bytes.decode("utf-8"))
+            self.ingest(parse)
             resp.status = falcon.HTTP_CREATED
             resp.body = None
+        except falcon.HTTPError:
+            # e.g. a decompressed body too large
+            raise
         except Exception as e:
             doc = {
                 'links': {
@@ -35,3 +195,344 @@ class Traces(object):
             }
             resp.body = json.dumps(doc)
             resp.status = falcon.HTTP_BAD_REQUEST
+
+
+class TraceBatches(object):
+    """Upload many traces in one request.
+
+    The body is either a tar archive (``Content-Type:
+    application/x-tar``, optionally compressed), with one trace per
+    file, or newline delimited JSON (``Content-Type:
+    application/x-ndjson``) with one object per trace, holding its
+    ``name`` and either its ``events`` as a list or its ``trace`` as a
+    string in the profiler format.
+
+    All the traces are ingested in a single transaction, with one bulk
+    insert per table. Traces that are not valid JSON are skipped, and
+    reported as failed in the response.
+
+    Args:
+        traces: The :class:`Traces` resource, whose hooks are run
+            around the batch
+        db: The database manager
+    """
+
+    def __init__(self, traces, db):
+        self._traces = traces
+        self._db = db
+
+    def on_post(self, req, resp):
+        content_type = (req.content_type or '').split(';')[0].strip()
+        if content_type not in BATCH_MEDIA_TYPES:
+            raise falcon.HTTPUnsupportedMediaType(
+                'Batches must be sent as one of {}.'.format(', '.join(BATCH_MEDIA_TYPES)))
+
+        blocks = read_blocks(req.stream, utils.body_length(req))
+        if content_type == TAR_MEDIA_TYPE:
+            batch = iter_tar_traces(blocks)
+        else:
+            batch = iter_ndjson_traces(blocks)
+
+        try:
+            results = self._traces.ingest(lambda: load_trace_batch(self._db, batch))
+        except falcon.HTTPError:
+            raise
+        except Exception as e:
+            doc = {
+                'links': {
+                },
+                'error': [str(a) for a in e.args]
+            }
+            resp.body = json.dumps(doc)
+            resp.status = falcon.HTTP_BAD_REQUEST
+            return
+
+        doc = {
+            'links': {
+                'url': req.url,
+            },
+            'data': results,
+            'data_length': len(results),
+        }
+        resp.body = json.dumps(doc)
+        resp.status = falcon.HTTP_CREATED
+
+
+class TraceJob(object):
+    """The status of a background trace ingestion job.
+
+    Args:
+        jobs: The :class:`marvin_backend.jobs.IngestJobs` queue
+    """
+
+    def __init__(self, jobs):
+        self._jobs = jobs
+
+    def on_get(self, req, resp, job_id):
+        status = self._jobs.status(job_id)
+        if status is None:
+            resp.status = falcon.HTTP_404
+            return
+
+        doc = {
+            'links': {
+                'url': req.url,
+            },
+            'data': status,
+        }
+        resp.body = json.dumps(doc)
+        resp.status = falcon.HTTP_200
+
+
+def read_blocks(stream, length=None, block_size=READ_BLOCK_SIZE):
+    """Read a stream in blocks of at most ``block_size`` bytes.
+
+    Args:
+        stream: A file-like object
+        length: The number of bytes to read, or None to read until the
+            end of the stream
+
+    Yields:
+        The blocks, as bytes
+    """
+    remaining = length
+    while remaining is None or remaining > 0:
+        size = block_size if remaining is None else min(block_size, remaining)
+        block = stream.read(size)
+        if not block:
+            break
+        if remaining is not None:
+            remaining -= len(block)
+        yield block
+
+
+def iter_events(blocks):
+    """Split a trace into its events.
+
+    Events are JSON objects, either one per line or spread over several
+    lines, ending with a line that ends in ``}``: the format of the
+    MonetDB profiler, also read by :mod:`mal_analytics.trace_reader`.
+
+    Args:
+        blocks: An iterable of bytes, or of already decoded strings, in
+            arbitrary pieces
+
+    Yields:
+        The events, as dictionaries
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    carry = ''
+    lines = list()
+
+    for block in blocks:
+        text = carry + (decoder.decode(block) if isinstance(block, bytes) else block)
+        pieces = text.split('\n')
+        carry = pieces.pop()
+        for line in pieces:
+            lines.append(line)
+            if line.rstrip().endswith('}'):
+                yield json.loads('\n'.join(lines))
+                lines = list()
+
+    lines.append(carry + decoder.decode(b'', final=True))
+    rest = '\n'.join(lines)
+    if rest.strip():
+        yield json.loads(rest)
+
+
+def _batches(iterable, size):
+    batch = list()
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = list()
+    if batch:
+        yield batch
+
+
+def load_trace_stream(db, events, batch_events=None):
+    """Parse and store a stream of trace events in a single transaction.
+
+    The events are parsed and inserted a batch at a time, so only one
+    batch is held in memory, however long the stream.
+
+    Args:
+        db: The database manager
+        events: An iterable of trace events, as dictionaries
+        batch_events: The number of events in each batch. Defaults to
+            :data:`BATCH_EVENTS`.
+
+    Returns:
+        The number of rows inserted in each table
+    """
+    batch_events = batch_events or BATCH_EVENTS
+    parser = db.create_parser()
+    rows = dict()
+    # The number of rows of every table of the parser already inserted
+    inserted = dict()
+    # The parser only deduplicates the variables of each batch.
+    stored_variables = set()
+
+    db.transaction()
+    try:
+        db.drop_constraints()
+        for batch in _batches(events, batch_events):
+            parser.parse_trace_stream(batch)
+            for table, columns in parser.get_data().items():
+                start = inserted.get(table, 0)
+                new_rows = dict((name, column[start:]) for name, column in columns.items())
+                if table == 'mal_variable':
+                    new_rows = _new_variables(new_rows, stored_variables)
+
+                count = serialization.row_count(new_rows)
+                if count:
+                    db.insert_data(table, new_rows)
+                rows[table] = rows.get(table, 0) + count
+
+                # Drop the inserted rows, so that only one batch is
+                # held in memory. The parser looks up the executions
+                # it has seen in their table, so that one is kept.
+                if table not in PARSER_LOOKUP_TABLES:
+                    for column in columns.values():
+                        del column[:]
+                inserted[table] = serialization.row_count(columns)
+        db.add_constraints()
+    except Exception:
+        db.rollback()
+        raise
+    db.commit()
+
+    return rows
+
+
+def _new_variables(variables, stored_variables):
+    keep = list()
+    for i, vid in enumerate(variables['variable_id']):
+        if vid not in stored_variables:
+            stored_variables.add(vid)
+            keep.append(i)
+    if len(keep) == len(variables['variable_id']):
+        return variables
+
+    return dict((k, [v[i] for i in keep]) for k, v in variables.items())
+
+
+class _BlockReader(object):
+    """A minimal file-like object over an iterable of bytes."""
+
+    def __init__(self, blocks):
+        self._blocks = iter(blocks)
+        self._buffer = b''
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            block = next(self._blocks, None)
+            if block is None:
+                break
+            self._buffer += block
+
+        if size < 0:
+            size = len(self._buffer)
+        ret, self._buffer = self._buffer[:size], self._buffer[size:]
+        return ret
+
+
+def _read_trace(name, blocks):
+    try:
+        return name, list(iter_events(blocks))
+    except ValueError as e:
+        return name, e
+
+
+def iter_tar_traces(blocks):
+    """Read the traces in a tar archive, in the order they are stored.
+
+    Yields:
+        ``(name, events)`` pairs, with the exception raised while
+        decoding instead of the events if the trace is not valid
+    """
+    with tarfile.open(fileobj=_BlockReader(blocks), mode='r|*') as archive:
+        for member in archive:
+            if member.isfile():
+                yield _read_trace(member.name, read_blocks(archive.extractfile(member)))
+
+
+def iter_ndjson_traces(blocks):
+    """Read the traces in a newline delimited JSON envelope.
+
+    Yields:
+        ``(name, events)`` pairs, with the exception raised while
+        decoding instead of the events if the trace is not valid
+    """
+    for idx, envelope in enumerate(iter_events(blocks)):
+        name = envelope.get('name', str(idx))
+        if 'events' in envelope:
+            yield name, envelope['events']
+        else:
+            yield _read_trace(name, [envelope.get('trace', '')])
+
+
+def load_trace_batch(db, traces):
+    """Parse and store many traces in a single transaction.
+
+    All the traces go through one parser, so that identifiers are
+    assigned consistently, and the data is inserted with one call per
+    table at the end.
+
+    Args:
+        db: The database manager
+        traces: An iterable of ``(name, events)`` pairs. Pairs holding
+            an exception instead of the events are reported as failed.
+
+    Returns:
+        A list with the name, status, and the number of rows of every
+        trace, or its error
+    """
+    parser = db.create_parser()
+    results = list()
+
+    for name, events in traces:
+        if isinstance(events, Exception):
+            results.append({'name': name, 'status': 'failed', 'error': [str(a) for a in events.args]})
+            continue
+
+        before = dict((table, serialization.row_count(columns)) for table, columns in parser.get_data().items())
+        parser.parse_trace_stream(events)
+        rows = dict((table, serialization.row_count(columns) - before.get(table, 0))
+                    for table, columns in parser.get_data().items())
+        results.append({'name': name, 'status': 'ok', 'rows': rows})
+
+    data = parser.get_data()
+    if 'mal_variable' in data:
+        data['mal_variable'] = _new_variables(data['mal_variable'], set())
+
+    db.transaction()
+    try:
+        db.drop_constraints()
+        for table, columns in data.items():
+            if serialization.row_count(columns):
+                db.insert_data(table, columns)
+        db.add_constraints()
+    except Exception:
+        db.rollback()
+        raise
+    db.commit()
+    parser.clear_internal_state()
+
+    return results
+
+
+def load_trace_file(db, path):
+    """Parse a trace file and store it in a single transaction.
+
+    Args:
+        db: The database manager
+        path: The path of the trace, optionally compressed with gzip or
+            bzip2
+
+    Returns:
+        The number of rows inserted in each table
+    """
+    with trace_reader.abstract_open(path) as fl:
+        return load_trace_stream(db, iter_events(fl))
@@ -8,10 +8,14 @@ from collections import deque
 import functools
 import json
 import logging
+import time
+from urllib.parse import urlencode
 import numpy as np
 
 import falcon
 
+from marvin_backend import serialization
+
 LOGGER = logging.getLogger(__name__)
 
 
@@ -75,8 +79,11 @@ def LDtoDL(ld):
 
 
 # numpy types are not JSON serializable, so we need to convert
-# everything to a normal python type. Unfortunately this does not work
-# with ujson, and this might create a performance issue down the line.
+# everything to a normal python type. This is called once for every
+# numpy value in the document, so the endpoints returning query results
+# convert whole columns up front instead (see
+# marvin_backend.serialization), which also allows using faster JSON
+# libraries.
 class NumpyJSONEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, (np.int_, np.intc, np.intp, np.int8,
@@ -97,63 +104,297 @@ class NumpyJSONEncoder(json.JSONEncoder):
 # query we need to traverse the execution graph starting at the
 # root_exeqution_id of the query.
 
-# The representation of the graph is just a list of edges. Edges are
-# represented by a pair of numbers, that are taken to mean nodes. That
-# is if (1, 2) is in the list of edges, then there is an edge from
-# node 1 to node 2.
+# The graph is given as two arrays of the same length, the tails and
+# the heads of the edges: if tails[i] == 1 and heads[i] == 2, then
+# there is an edge from node 1 to node 2. Nodes are (not necessarily
+# consecutive) integers, namely execution ids.
+#
+# In order to find the neighbors of a node without scanning all the
+# edges, the edges are sorted by their tail once, when the graph is
+# built (a compressed sparse row representation). The neighbors of a
+# node are then a contiguous range of the heads array, that we locate
+# with a binary search.
 class SimpleGraph(object):
-    def __init__(self, edges):
-        self._edges = edges
+    def __init__(self, tails, heads):
+        tails = np.asarray(tails, dtype=np.int64)
+        heads = np.asarray(heads, dtype=np.int64)
+
+        # A stable sort keeps the neighbors of each node in the order
+        # the edges were given.
+        order = np.argsort(tails, kind='stable')
+        self._tails = tails[order]
+        self._heads = heads[order]
+
+    @classmethod
+    def from_edges(cls, edges):
+        """Build a graph from a list of (tail, head) pairs."""
+        edges = list(edges)
+        return cls([e[0] for e in edges], [e[1] for e in edges])
+
+    def neighbors(self, node):
+        """The heads of the edges starting at ``node``, as an array."""
+        start = np.searchsorted(self._tails, node, side='left')
+        end = np.searchsorted(self._tails, node, side='right')
+        return self._heads[start:end]
 
     def bfs(self, start_node):
-        ret = list()
-        q = deque()
-        q.append(start_node)
+        """The nodes reachable from ``start_node`` in breadth first order."""
+        start_node = int(start_node)
+        ret = [start_node]
+        visited = {start_node}
+        q = deque(ret)
 
-        while len(q) != 0:
-            LOGGER.debug(q)
+        while q:
             n = q.popleft()
-            ret.append(n)
-            neighbors = [self._head(e) for e in self._edges if self._tail(e) == n and self._head(e) not in ret]
-            LOGGER.debug("%d->%s", n, neighbors)
-            q.extend(neighbors)
+            for m in self.neighbors(n).tolist():
+                if m not in visited:
+                    visited.add(m)
+                    ret.append(m)
+                    q.append(m)
 
         return ret
 
-    def _head(self, edge):
-        return edge[1]
 
-    def _tail(self, edge):
-        # edge is a dict with 2 keys: parent_id and child_id. The edge
-        # is in the sense parent->child.
-        return edge[0]
+def sql_int_list(values):
+    """Format integers as the contents of an SQL ``IN`` list.
+
+    The values are converted to ``int`` first, so the result is safe
+    to include in the text of a query.
+
+    Examples:
+        >>> sql_int_list([3, 1, 2])
+        '3, 1, 2'
+    """
+    return ", ".join(str(int(v)) for v in values)
 
 
 # The interface of the graph tools to the rest of the system.
 def find_query_execution_ids(query_root_execution, execution_relation):
-    g = SimpleGraph(list(zip(execution_relation['parent_id'], execution_relation['child_id'])))
+    g = SimpleGraph(execution_relation['parent_id'], execution_relation['child_id'])
     return g.bfs(query_root_execution['root_execution_id'][0])
 
 
+# Size of the blocks read from a request body of unknown length
+READ_BLOCK_SIZE = 64 << 10
+
+
+def body_length(req):
+    """The length of the body of a request.
+
+    Returns:
+        The number of bytes to read, or None if the body is sent with
+        chunked transfer encoding, or decompressed while it is read,
+        and must be read to the end.
+    """
+    if 'chunked' in (req.get_header('Transfer-Encoding') or '').lower():
+        return None
+    if req.context.get('decompressed'):
+        return None
+
+    return req.content_length or 0
+
+
+def read_body(req):
+    """Read the whole body of a request.
+
+    Returns:
+        The body, as bytes
+    """
+    length = body_length(req)
+    if length is not None:
+        return req.stream.read(length)
+
+    return b''.join(iter(lambda: req.stream.read(READ_BLOCK_SIZE), b''))
+
+
+def int_param(req, name, minimum=None, maximum=None):
+    """Read an optional integer parameter of a request.
+
+    Args:
+        req: The request
+        name: The name of the parameter
+        minimum: The smallest acceptable value, if any
+        maximum: The largest acceptable value, if any
+
+    Returns:
+        The value of the parameter, or None if it is missing
+
+    Raises:
+        falcon.HTTPInvalidParam: If the value is not an integer or is
+            out of bounds.
+    """
+    value = req.get_param_as_int(name)
+    if value is None:
+        return None
+
+    if (minimum is not None and value < minimum) or (maximum is not None and value > maximum):
+        if maximum is None:
+            msg = 'The value must be at least {}.'.format(minimum)
+        elif minimum is None:
+            msg = 'The value must be at most {}.'.format(maximum)
+        else:
+            msg = 'The value must be between {} and {}.'.format(minimum, maximum)
+        raise falcon.HTTPInvalidParam(msg, name)
+
+    return value
+
+
+# Keyset pagination: instead of using OFFSET, that forces the database
+# to produce and discard all the rows before the requested page, every
+# page starts right after the last key of the previous one. This way
+# the cost of fetching a page does not depend on its position in the
+# table.
+DEFAULT_PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 10000
+
+
+class Page(object):
+    """The window of a result set requested by a client.
+
+    Args:
+        limit: The maximum number of rows in the page
+        after: The key after which the page starts, or None for the first page
+    """
+
+    def __init__(self, limit=DEFAULT_PAGE_SIZE, after=None):
+        self.limit = limit
+        self.after = after
+
+    @classmethod
+    def from_request(cls, req):
+        """Read the ``limit`` and ``after`` parameters of a request."""
+        limit = int_param(req, 'limit', 1, MAX_PAGE_SIZE)
+        if limit is None:
+            limit = DEFAULT_PAGE_SIZE
+
+        return cls(limit, req.get_param_as_int('after'))
+
+    def sql(self, table, key, conditions=None):
+        """Build the query fetching this page of ``table``.
+
+        One more row than the limit is requested, so that we know if
+        there is a next page without issuing a second query.
+
+        Args:
+            table: The name of the table
+            key: A unique column of the table to paginate on
+            conditions: A list of additional SQL conditions for the rows
+
+        Returns:
+            The text of the query
+        """
+        conditions = list(conditions or [])
+        if self.after is not None:
+            conditions.append("{} > %(after)s".format(key))
+
+        sql = "SELECT * FROM {}".format(table)
+        if conditions:
+            sql += " WHERE {}".format(" AND ".join(conditions))
+
+        return sql + " ORDER BY {} LIMIT %(limit)s".format(key)
+
+    def params(self, params=None):
+        """The parameters for the query built by :meth:`sql`."""
+        ret = dict(params or {})
+        ret['limit'] = self.limit + 1
+        if self.after is not None:
+            ret['after'] = self.after
+
+        return ret
+
+
+def next_page_url(req, after):
+    """The URL of the page starting after the key ``after``."""
+    params = dict(req.params)
+    params['after'] = after
+    return '{}{}?{}'.format(req.prefix, req.path, urlencode(params, doseq=True))
+
+
+def paginated(key):
+    """Paginate the result of an endpoint on the column ``key``.
+
+    The decorated responder receives a :class:`Page` as the keyword
+    argument ``page``, and should return the result of the query built
+    by it. The extra row, if present, is dropped and the URL of the
+    next page is recorded for :func:`api_endpoint`.
+    """
+    def paginated_decorator(func):
+        @functools.wraps(func)
+        def paginated_impl(cls, req, resp, *args, **kwargs):
+            page = Page.from_request(req)
+            result = func(cls, req, resp, *args, page=page, **kwargs)
+
+            if result and len(result[key]) > page.limit:
+                result = {k: v[:page.limit] for k, v in result.items()}
+                req.context['next_page'] = next_page_url(req, result[key][-1])
+
+            return result
+
+        return paginated_impl
+
+    return paginated_decorator
+
+
+def _send_result(req, resp, result, layout, media_type):
+    """Encode the result of an endpoint in the response."""
+    links = {
+        'url': req.url,
+    }
+    if req.context.get('next_page'):
+        links['next'] = req.context['next_page']
+
+    # Binary columnar encoding: the links that would be part of the
+    # JSON document are sent as headers and schema metadata.
+    if media_type == serialization.ARROW_STREAM_MEDIA_TYPE:
+        if 'next' in links:
+            resp.append_header('Link', '<{}>; rel="next"'.format(links['next']))
+        resp.content_type = media_type
+        resp.data = serialization.arrow_stream(result, dict((k, str(v)) for k, v in links.items()))
+        resp.status = falcon.HTTP_200
+
+        return serialization.Rows(result)
+
+    if layout == serialization.COLUMNAR_LAYOUT:
+        doc = serialization.columnar_document(links, result)
+        resp.data = serialization.dumps(doc)
+        resp.status = falcon.HTTP_200
+
+        return serialization.Rows(result)
+
+    # Large results are encoded while they are being sent, so that
+    # we never hold the whole document in memory.
+    if serialization.row_count(result) > serialization.STREAMING_THRESHOLD:
+        resp.stream = serialization.iter_json_document(links, result)
+        resp.status = falcon.HTTP_200
+
+        return serialization.Rows(result)
+
+    doc = serialization.rows_document(links, result)
+    result = doc['data']
+
+    LOGGER.debug("%s returned %d rows", req.path, len(result))
+    resp.data = serialization.dumps(doc)
+    resp.status = falcon.HTTP_200
+
+    return result
+
+
 def api_endpoint(func):
     @functools.wraps(func)
     def api_endpoint_impl(cls, req, resp, *args, **kwargs):
-        result = DLtoLD(func(cls, req, resp, *args, **kwargs))
-
-        print("API DECORATOR", result)
-        doc = {
-            'links': {
-                'url': req.url,
-            },
-            'data': result,
-            'data_length': len(result),
-        }
-
-        # TODO: pagination
-        resp.body = json.dumps(doc, ensure_ascii=False, cls=NumpyJSONEncoder)
-        resp.status = falcon.HTTP_200
+        layout = serialization.requested_layout(req)
+        media_type = serialization.requested_media_type(req)
+        result = func(cls, req, resp, *args, **kwargs)
 
-        return result
+        # Reported in the Server-Timing header. Streamed responses are
+        # encoded while they are sent, after the header, so their
+        # encoding time is not reported.
+        start = time.perf_counter()
+        try:
+            return _send_result(req, resp, result, layout, media_type)
+        finally:
+            if resp.stream is None:
+                req.context['serialization_seconds'] = time.perf_counter() - start
 
     return api_endpoint_impl
 
@@ -163,10 +404,13 @@ def api_endpoint_404_on_empty(func):
     def api_endpoint_404_on_empty_impl(cls, req, resp, *args, **kwargs):
         result = func(cls, req, resp, *args, **kwargs)
 
-        print("EMPTY DECORATOR", result)
         if not result:
             resp.status = falcon.HTTP_404
+            # The result may have been encoded as an Arrow stream
+            resp.content_type = serialization.JSON_MEDIA_TYPE
             resp.body = None
+            resp.data = None
+            resp.stream = None
 
         return result
 
@@ -178,7 +422,6 @@ def api_endpoint_singleton_result(func):
     def api_endpoint_singleton_result_impl(cls, req, resp, *args, **kwargs):
         result = func(cls, req, resp, *args, **kwargs)
 
-        print("SINGLETON DECORATOR", result)
         if result and len(result) > 1:
             msg = "Expecting single result, but got {}.".format(len(result))
             doc = {
@@ -189,7 +432,10 @@ def api_endpoint_singleton_result(func):
             }
 
             resp.status = falcon.HTTP_500
+            resp.content_type = serialization.JSON_MEDIA_TYPE
             resp.body = json.dumps(doc)
+            resp.data = None
+            resp.stream = None
 
         return result
 
@@ -0,0 +1,402 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright MonetDB Solutions B.V. 2018-2019
+"""A single writer process.
+
+The embedded database effectively allows one writer. In the split
+deployment the gunicorn workers only serve reads, and every request
+that writes to the database (trace uploads, query labels) is forwarded
+over a local socket to a dedicated writer process, which runs its own
+copy of the application. Heavy ingestion then never occupies the
+workers serving the dashboards.
+
+Requests are forwarded at the WSGI level: the reader sends the method,
+path, headers and the raw body, in blocks, and streams back the status,
+headers and body produced by the writer. The writer bumps the shared
+database generation, so the readers notice its writes.
+
+The writer process is a child of the gunicorn master, started and
+restarted by :class:`WriterProcess` from the gunicorn server hooks.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+from multiprocessing.connection import Client, Listener
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+READ_BLOCK_SIZE = 64 << 10
+
+# Seconds the readers keep trying to connect to a writer that is
+# (re)starting
+DEFAULT_CONNECT_TIMEOUT = 5.0
+
+WRITE_METHODS = ('POST', 'PUT', 'PATCH', 'DELETE')
+# The ingest jobs are only known to the writer
+WRITER_PATHS = ('/traces',)
+
+# The request headers are forwarded, as well as these CGI variables
+_FORWARDED_ENVIRON = ('CONTENT_TYPE', 'CONTENT_LENGTH')
+
+
+def is_write(method, path):
+    """Whether a request must be served by the writer."""
+    if method in WRITE_METHODS:
+        return True
+
+    return any(path == p or path.startswith(p + '/') for p in WRITER_PATHS)
+
+
+def _body_blocks(environ):
+    stream = environ['wsgi.input']
+    length = environ.get('CONTENT_LENGTH')
+    if length:
+        remaining = int(length)
+        while remaining > 0:
+            block = stream.read(min(READ_BLOCK_SIZE, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            yield block
+    elif 'chunked' in environ.get('HTTP_TRANSFER_ENCODING', '').lower():
+        # The server has removed the chunked encoding
+        block = stream.read(READ_BLOCK_SIZE)
+        while block:
+            yield block
+            block = stream.read(READ_BLOCK_SIZE)
+
+
+class _ConnectionReader(object):
+    """A file-like object reading the blocks sent over a connection,
+    until an empty one."""
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._buffer = b''
+        self._eof = False
+
+    def _fill(self):
+        block = self._conn.recv_bytes()
+        if not block:
+            self._eof = True
+        self._buffer += block
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            while not self._eof:
+                self._fill()
+            size = len(self._buffer)
+
+        while len(self._buffer) < size and not self._eof:
+            self._fill()
+
+        ret, self._buffer = self._buffer[:size], self._buffer[size:]
+        return ret
+
+    def drain(self):
+        """Skip the rest of the body."""
+        self._buffer = b''
+        while not self._eof:
+            self._eof = not self._conn.recv_bytes()
+
+
+class WriteServer(object):
+    """Serve the requests forwarded by :class:`WriteRouter`.
+
+    Every forwarded request is handled in a thread of its own, so
+    status requests are not queued behind a long upload. The
+    application itself serializes the ingestion.
+
+    Args:
+        app: The WSGI application of the writer
+        address: The address to listen to, e.g. a UNIX socket path
+        authkey: The key the readers authenticate with
+        threads: The maximum number of requests handled at once
+    """
+
+    def __init__(self, app, address, authkey, threads=4):
+        self._app = app
+        self._authkey = authkey
+        self._listener = Listener(address, authkey=authkey)
+        self._executor = ThreadPoolExecutor(max_workers=threads)
+        self._serving = False
+        self._closed = False
+
+    @property
+    def address(self):
+        return self._listener.address
+
+    def serve_forever(self):
+        LOGGER.info("Serving writes at %s", self.address)
+        self._serving = True
+        try:
+            while not self._closed:
+                try:
+                    conn = self._listener.accept()
+                except multiprocessing.AuthenticationError:
+                    LOGGER.warning("Rejected a connection with a wrong key")
+                    continue
+
+                if self._closed:
+                    conn.close()
+                    break
+                self._executor.submit(self._handle, conn)
+        finally:
+            self._serving = False
+
+    def close(self):
+        """Stop serving, and wait for the requests being served."""
+        self._closed = True
+        if self._serving:
+            # Closing the listener does not interrupt accept()
+            Client(self.address, authkey=self._authkey).close()
+        self._listener.close()
+        self._executor.shutdown(wait=True)
+
+    def _handle(self, conn):
+        try:
+            request = conn.recv()
+            body = _ConnectionReader(conn)
+            self._respond(conn, request, body)
+        except (EOFError, OSError):
+            LOGGER.warning("The reader closed the connection")
+        except Exception:
+            LOGGER.exception("Failed to serve a forwarded request")
+        finally:
+            conn.close()
+
+    def _respond(self, conn, request, body):
+        environ = {
+            'REQUEST_METHOD': request['method'],
+            'SCRIPT_NAME': '',
+            'PATH_INFO': request['path'],
+            'QUERY_STRING': request['query_string'],
+            'SERVER_NAME': 'marvin-writer',
+            'SERVER_PORT': '0',
+            'SERVER_PROTOCOL': 'HTTP/1.1',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': request['url_scheme'],
+            'wsgi.input': body,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        environ.update(request['headers'])
+
+        started = dict()
+
+        def start_response(status, headers, exc_info=None):
+            started.update(status=status, headers=headers)
+
+        result = self._app(environ, start_response)
+        try:
+            body.drain()
+            conn.send((started['status'], started['headers']))
+            for block in result:
+                if block:
+                    conn.send_bytes(block)
+            conn.send_bytes(b'')
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+
+class WriterClient(object):
+    """Forward requests to a :class:`WriteServer`.
+
+    Args:
+        address: The address of the writer
+        authkey: The key shared with the writer
+        connect_timeout: The number of seconds to keep trying to
+            connect to a writer that is not listening yet
+    """
+
+    def __init__(self, address, authkey, connect_timeout=DEFAULT_CONNECT_TIMEOUT):
+        self._address = address
+        self._authkey = authkey
+        self._connect_timeout = connect_timeout
+
+    def _connect(self):
+        deadline = time.monotonic() + self._connect_timeout
+        while True:
+            try:
+                return Client(self._address, authkey=self._authkey)
+            except (FileNotFoundError, ConnectionRefusedError):
+                # The writer is starting, or restarting
+                if time.monotonic() >= deadline:
+                    raise
+                time.sleep(0.1)
+
+    def forward(self, environ):
+        """Send a request to the writer.
+
+        Returns:
+            The status, the headers and an iterator over the body of
+            the response
+        """
+        headers = dict((k, v) for k, v in environ.items()
+                       if k.startswith('HTTP_') or k in _FORWARDED_ENVIRON)
+        request = {
+            'method': environ['REQUEST_METHOD'],
+            'path': environ.get('PATH_INFO', '/'),
+            'query_string': environ.get('QUERY_STRING', ''),
+            'url_scheme': environ.get('wsgi.url_scheme', 'http'),
+            'headers': headers,
+        }
+
+        conn = self._connect()
+        try:
+            conn.send(request)
+            for block in _body_blocks(environ):
+                conn.send_bytes(block)
+            conn.send_bytes(b'')
+            status, response_headers = conn.recv()
+        except Exception:
+            conn.close()
+            raise
+
+        return status, response_headers, self._response_blocks(conn)
+
+    @staticmethod
+    def _response_blocks(conn):
+        try:
+            block = conn.recv_bytes()
+            while block:
+                yield block
+                block = conn.recv_bytes()
+        finally:
+            conn.close()
+
+
+class WriteRouter(object):
+    """A WSGI application sending the writes to the writer process, and
+    the reads to the application of this worker.
+
+    Args:
+        app: The WSGI application serving the reads
+        client: The :class:`WriterClient`
+    """
+
+    def __init__(self, app, client):
+        self._app = app
+        self._client = client
+
+    def __call__(self, environ, start_response):
+        if not is_write(environ['REQUEST_METHOD'], environ.get('PATH_INFO', '/')):
+            return self._app(environ, start_response)
+
+        try:
+            status, headers, body = self._client.forward(environ)
+        except (EOFError, OSError) as e:
+            LOGGER.error("Could not forward the request to the writer: %s", e)
+            error = {
+                'title': '503 Service Unavailable',
+                'description': 'The ingest process is not available',
+            }
+            data = json.dumps(error).encode('utf-8')
+            start_response('503 Service Unavailable', [
+                ('Content-Type', 'application/json'),
+                ('Content-Length', str(len(data))),
+            ])
+            return [data]
+
+        start_response(status, headers)
+        return body
+
+
+class WriterProcess(object):
+    """Run the writer in a child process of the gunicorn master, and
+    restart it whenever it exits.
+
+    The gunicorn master reaps every child process, so whether the
+    writer is running is checked by its pid rather than by waiting for
+    it. Use :meth:`on_starting`, :meth:`when_ready` and :meth:`on_exit`
+    as the gunicorn server hooks of the same names.
+
+    Args:
+        target: The function serving the writes. It is called with a
+            :class:`multiprocessing.Event`, to set once the writer
+            accepts connections, followed by ``args``.
+        args: The other arguments of ``target``
+        start_timeout: The number of seconds to wait for the writer to
+            accept connections
+        check_interval: The number of seconds between two checks of
+            the writer process
+    """
+
+    def __init__(self, target, args=(), start_timeout=60.0, check_interval=1.0):
+        self._target = target
+        self._args = tuple(args)
+        self._start_timeout = start_timeout
+        self._check_interval = check_interval
+        self._process = None
+        self._stopping = threading.Event()
+        self._supervisor = None
+        self.restarts = 0
+
+    def start(self):
+        """Start the writer, and wait until it accepts connections.
+
+        Returns:
+            Whether the writer is ready
+        """
+        ready = multiprocessing.Event()
+        self._process = multiprocessing.Process(target=self._target,
+                                                args=(ready,) + self._args,
+                                                name='marvin-writer',
+                                                daemon=True)
+        self._process.start()
+        LOGGER.info("Started the writer process %d", self._process.pid)
+
+        if not ready.wait(self._start_timeout):
+            LOGGER.error("The writer process is not ready after %s seconds", self._start_timeout)
+            return False
+        return True
+
+    def is_alive(self):
+        if self._process is None or not self._process.is_alive():
+            return False
+
+        # The process may have been reaped by the gunicorn master
+        try:
+            os.kill(self._process.pid, 0)
+        except ProcessLookupError:
+            return False
+        return True
+
+    def supervise(self):
+        """Restart the writer whenever it exits, until :meth:`stop`."""
+        while not self._stopping.wait(self._check_interval):
+            if not self.is_alive():
+                LOGGER.error("The writer process %d exited, restarting it", self._process.pid)
+                self.restarts += 1
+                self.start()
+
+    def stop(self):
+        """Stop supervising the writer, and terminate it."""
+        self._stopping.set()
+        if self._supervisor is not None:
+            self._supervisor.join()
+        if self.is_alive():
+            self._process.terminate()
+            self._process.join(self._start_timeout)
+
+    def on_starting(self, server):  # pragma: no coverage
+        # Before the workers are started, so that they find the writer
+        self.start()
+
+    def when_ready(self, server):  # pragma: no coverage
+        self._supervisor = threading.Thread(target=self.supervise, name='marvin-writer-supervisor', daemon=True)
+        self._supervisor.start()
+
+    def on_exit(self, server):  # pragma: no coverage
+        self.stop()
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright MonetDB Solutions B.V. 2018-2019
+import asyncio
+import json
+
+from numpy import array
+import pytest
+
+from marvin_backend import asgi, marvin_backend
+
+
+def http_scope(method, path, query_string=b'', headers=()):
+    return {
+        'type': 'http',
+        'method': method,
+        'path': path,
+        'query_string': query_string,
+        'headers': list(headers),
+        'http_version': '1.1',
+        'scheme': 'http',
+        'server': ('testserver', 80),
+        'client': ('127.0.0.1', 12345),
+    }
+
+
+def call(app, scope, messages=({'type': 'http.request', 'body': b''},)):
+    """Run an ASGI application, and collect the messages it sends."""
+    incoming = list(messages)
+    sent = list()
+
+    async def receive():
+        return incoming.pop(0) if incoming else {'type': 'http.disconnect'}
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(app(scope, receive, send))
+    return sent
+
+
+@pytest.fixture
+def bridge(mock_db):
+    return asgi.WSGIBridge(marvin_backend.create_app(mock_db), max_workers=2)
+
+
+class TestWSGIBridge(object):
+    def test_get(self, bridge, mock_db):
+        mock_db.execute_query.return_value = {'query_id': array([1, 2])}
+
+        sent = call(bridge, http_scope('GET', '/queries'))
+
+        assert sent[0]['type'] == 'http.response.start'
+        assert sent[0]['status'] == 200
+        assert dict(sent[0]['headers'])[b'content-type'].startswith(b'application/json')
+        body = b''.join(m.get('body', b'') for m in sent[1:])
+        assert json.loads(body)['data_length'] == 2
+        assert not sent[-1].get('more_body', False)
+
+    def test_body_in_parts(self, bridge, mock_db):
+        body = b'{"label": "new"}'
+        messages = [
+            {'type': 'http.request', 'body': body[:5], 'more_body': True},
+            {'type': 'http.request', 'body': body[5:]},
+        ]
+        headers = [(b'content-length', str(len(body)).encode())]
+
+        sent = call(bridge, http_scope('PATCH', '/queries/3', headers=headers), messages)
+
+        assert sent[0]['status'] == 200
+        mock_db.execute_query.assert_called_once_with(
+            "UPDATE query SET query_label=%(label)s WHERE query_id=%(qid)s", {'label': 'new', 'qid': '3'})
+
+    def test_query_string_and_errors(self, bridge, mock_db):
+        sent = call(bridge, http_scope('GET', '/cpuload/s1', query_string=b'from=abc'))
+
+        assert sent[0]['status'] == 400
+
+    def test_lifespan(self, bridge):
+        messages = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+
+        sent = call(bridge, {'type': 'lifespan'}, messages)
+
+        assert [m['type'] for m in sent] == ['lifespan.startup.complete', 'lifespan.shutdown.complete']
+
+
+class TestBuildEnviron(object):
+    def test_headers(self):
+        scope = http_scope('POST', '/traces', headers=[
+            (b'content-type', b'application/json'),
+            (b'content-length', b'10'),
+            (b'x-custom', b'a'),
+            (b'x-custom', b'b'),
+        ])
+
+        environ = asgi.build_environ(scope, None)
+
+        assert environ['CONTENT_TYPE'] == 'application/json'
+        assert environ['CONTENT_LENGTH'] == '10'
+        assert environ['HTTP_X_CUSTOM'] == 'a,b'
+        assert environ['REMOTE_ADDR'] == '127.0.0.1'
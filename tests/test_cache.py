@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright MonetDB Solutions B.V. 2018-2019
+import gzip
+import json
+
+import falcon
+from numpy import array
+
+from marvin_backend import cache, generations
+
+
+def entry(size, tags=()):
+    return cache.CacheEntry(b'x' * size, 'application/json', {}, frozenset(tags))
+
+
+class TestResponseCache(object):
+    def test_lru_eviction(self):
+        response_cache = cache.ResponseCache(max_bytes=30)
+        response_cache.put('a', entry(10))
+        response_cache.put('b', entry(10))
+        response_cache.put('c', entry(10))
+        # a becomes the most recently used
+        assert response_cache.get('a') is not None
+        response_cache.put('d', entry(10))
+
+        assert response_cache.get('b') is None
+        assert response_cache.get('a') is not None
+        stats = response_cache.stats()
+        assert stats['evictions'] == 1
+        assert stats['bytes'] == 30
+        assert stats['entries'] == 3
+
+    def test_too_large(self):
+        response_cache = cache.ResponseCache(max_bytes=5)
+        response_cache.put('a', entry(10))
+
+        assert response_cache.get('a') is None
+        assert response_cache.stats()['bytes'] == 0
+
+    def test_invalidate(self):
+        response_cache = cache.ResponseCache()
+        response_cache.put('a', entry(1, [cache.query_tag(1)]))
+        response_cache.put('b', entry(1, [cache.query_tag(2), cache.server_tag('s1')]))
+        response_cache.put('c', entry(1, [cache.query_tag(3)]))
+
+        assert response_cache.invalidate([cache.query_tag('1'), cache.server_tag('s1')]) == 2
+        assert response_cache.get('a') is None
+        assert response_cache.get('b') is None
+        assert response_cache.get('c') is not None
+
+    def test_generation(self):
+        generation = generations.Generation()
+        response_cache = cache.ResponseCache(generation=generation)
+        response_cache.put('a', entry(1, [cache.query_tag(1)]))
+        response_cache.put('b', entry(1, [cache.query_tag(2)]))
+
+        # A write by this process only drops the affected entries
+        response_cache.invalidate([cache.query_tag(1)], generation.bump())
+        assert response_cache.get('b') is not None
+
+        # A write by another process clears the cache
+        generation.bump()
+        assert response_cache.get('b') is None
+        assert response_cache.stats()['clears'] == 1
+
+    def test_writes_of_other_processes(self, tmp_path):
+        path = str(tmp_path / 'generation')
+        worker_a = generations.Generation(path)
+        worker_b = generations.Generation(path)
+        response_cache = cache.ResponseCache(generation=worker_a)
+        response_cache.put('q1', entry(1, [cache.query_tag(1)]))
+        response_cache.put('q2', entry(1, [cache.query_tag(2)]))
+
+        # Worker B ingests a trace of query 2, then worker A one of
+        # query 1, before worker A looks at its cache again.
+        worker_b.bump()
+        response_cache.invalidate([cache.query_tag(1)], worker_a.bump())
+
+        assert response_cache.get('q2') is None
+
+    def test_stale_put(self):
+        generation = generations.Generation()
+        response_cache = cache.ResponseCache(generation=generation)
+
+        # A response computed from the data before a write
+        version = response_cache.version()
+        response_cache.invalidate([cache.query_tag(1)], generation.bump())
+        response_cache.put('a', entry(1, [cache.query_tag(1)]), version)
+
+        assert response_cache.get('a') is None
+        assert response_cache.stats()['stale_stores'] == 1
+        response_cache.put('a', entry(1, [cache.query_tag(1)]), response_cache.version())
+        assert response_cache.get('a') is not None
+
+
+class TestResponseCacheMiddleware(object):
+    def test_cached_executions(self, client, mock_db):
+        mock_db.execute_query.return_value = {'execution_id': array([1, 2])}
+
+        first = client.simulate_get('/queries/1/executions')
+        second = client.simulate_get('/queries/1/executions')
+
+        assert mock_db.execute_query.call_count == 1
+        assert first.json == second.json
+        assert second.headers['content-type'].startswith('application/json')
+        assert second.headers['etag'] == first.headers['etag']
+
+        # Other queries are not served from the cache
+        client.simulate_get('/queries/2/executions')
+        assert mock_db.execute_query.call_count == 2
+
+    def test_cached_response_is_compressed(self, client, mock_db):
+        mock_db.execute_query.return_value = {'execution_id': array(range(500))}
+
+        client.simulate_get('/queries/1/executions')
+        response = client.simulate_get('/queries/1/executions', headers={'Accept-Encoding': 'gzip'})
+
+        assert mock_db.execute_query.call_count == 1
+        assert response.headers['content-encoding'] == 'gzip'
+        assert json.loads(gzip.decompress(response.content))['data_length'] == 500
+
+    def test_uncached_resources(self, client, mock_db):
+        mock_db.execute_query.return_value = {'query_id': array([1])}
+
+        client.simulate_get('/queries')
+        client.simulate_get('/queries')
+
+        assert mock_db.execute_query.call_count == 2
+
+    def test_errors_are_not_cached(self, client, mock_db):
+        mock_db.execute_query.return_value = {'query_id': array([])}
+
+        assert client.simulate_get('/queries/1').status == falcon.HTTP_NOT_FOUND
+        client.simulate_get('/queries/1')
+
+        assert mock_db.execute_query.call_count == 2
+
+    def test_label_invalidates(self, client, mock_db):
+        mock_db.execute_query.return_value = {'query_id': array([1]), 'query_label': array(['old'])}
+        client.simulate_get('/queries/1')
+        client.simulate_get('/queries/2')
+
+        client.simulate_patch('/queries/1', body='{"label": "new"}')
+        mock_db.execute_query.reset_mock()
+        mock_db.execute_query.return_value = {'query_id': array([1]), 'query_label': array(['new'])}
+
+        assert client.simulate_get('/queries/1').json['data'][0]['query_label'] == 'new'
+        client.simulate_get('/queries/2')
+        # Only the labeled query was fetched again
+        assert mock_db.execute_query.call_count == 1
+
+    def test_ingest_invalidates(self, client, mock_db):
+        mock_db.execute_query.return_value = {'execution_id': array([1])}
+        client.simulate_get('/queries/1/executions')
+        client.simulate_get('/queries/2/executions')
+
+        mock_db.execute_query.return_value = {
+            'max_query_id': array([2]),
+            'max_initiates_id': array([1]),
+            'max_heartbeat_id': array([1]),
+            'max_execution_id': array([1]),
+            'query_id': array([2]),
+            'server_session': array([]),
+            'start_t': array([]),
+            'end_t': array([]),
+            'execution_id': array([1]),
+            'root_execution_id': array([1]),
+            'parent_id': array([]),
+            'child_id': array([]),
+        }
+        client.simulate_post('/traces', body=b'{}')
+        mock_db.execute_query.assert_any_call(
+            "SELECT DISTINCT query_id FROM query_execution WHERE execution_id > %(max_execution_id)s",
+            {'max_execution_id': 1, 'max_heartbeat_id': 1})
+
+        mock_db.execute_query.reset_mock()
+        client.simulate_get('/queries/1/executions')
+        assert mock_db.execute_query.call_count == 0
+        client.simulate_get('/queries/2/executions')
+        assert mock_db.execute_query.call_count == 1
+
+    def test_stats(self, client, mock_db):
+        mock_db.execute_query.return_value = {'execution_id': array([1])}
+        client.simulate_get('/queries/1/executions')
+        client.simulate_get('/queries/1/executions')
+
+        stats = client.simulate_get('/developer/cache').json['data']
+
+        assert stats['hits'] == 1
+        assert stats['misses'] == 1
+        assert stats['entries'] == 1
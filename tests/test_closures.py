@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright MonetDB Solutions B.V. 2018-2019
+from unittest.mock import call
+
+from numpy import array
+from numpy.ma import masked_array
+
+from marvin_backend import closures
+
+
+class TestExecutionClosures(object):
+    def test_before_ingest(self, mock_db):
+        mock_db.execute_query.return_value = {
+            'max_query_id': array([12]),
+            'max_initiates_id': masked_array(data=[0], mask=[True]),
+        }
+
+        limits = closures.ExecutionClosures(mock_db).before_ingest()
+        assert limits == {'max_query_id': 12, 'max_initiates_id': 0}
+
+    def test_after_ingest(self, mock_db):
+        frontier_sql = "SELECT parent_id, child_id FROM initiates_executions WHERE parent_id IN ({}) ORDER BY initiates_executions_id"
+        db_results = {
+            # New queries
+            "SELECT query_id FROM query WHERE query_id > %(max_query_id)s": {
+                'query_id': array([3])
+            },
+            # Stored queries with new edges
+            "SELECT DISTINCT query_id FROM query_execution WHERE execution_id IN (SELECT parent_id FROM initiates_executions WHERE initiates_executions_id > %(max_initiates_id)s)": {
+                'query_id': array([1, 3])
+            },
+            "SELECT root_execution_id FROM query WHERE query_id=%(qid)s": {
+                'root_execution_id': array([10])
+            },
+            frontier_sql.format("10"): {
+                'parent_id': array([10]),
+                'child_id': array([11])
+            },
+            frontier_sql.format("11"): {
+                'parent_id': array([]),
+                'child_id': array([])
+            },
+        }
+        mock_db.execute_query.side_effect = lambda sql, params=None: db_results.get(sql)
+
+        qids = closures.ExecutionClosures(mock_db).after_ingest({'max_query_id': 2, 'max_initiates_id': 7})
+
+        assert qids == [1, 3]
+        mock_db.execute_query.assert_any_call("DELETE FROM query_execution WHERE query_id=%(qid)s", {'qid': 1})
+        mock_db.execute_query.assert_any_call("DELETE FROM query_execution WHERE query_id=%(qid)s", {'qid': 3})
+        mock_db.insert_data.assert_has_calls([
+            call('query_execution', {'query_id': [1, 1], 'execution_id': [10, 11], 'execution_order': [0, 1]}),
+            call('query_execution', {'query_id': [3, 3], 'execution_id': [10, 11], 'execution_order': [0, 1]}),
+        ])
+
+    def test_backfill(self, mock_db):
+        db_results = [
+            None,  # CREATE TABLE
+            {
+                'query_id': array([1, 2]),
+                'root_execution_id': array([1, 5])
+            },
+            {
+                'parent_id': array([1, 1, 2, 5]),
+                'child_id': array([1, 2, 3, 6])
+            },
+        ] + [None] * 2  # DELETE
+
+        mock_db.execute_query.side_effect = db_results
+
+        assert closures.ExecutionClosures(mock_db).backfill() == 2
+        mock_db.insert_data.assert_has_calls([
+            call('query_execution', {'query_id': [1, 1, 1], 'execution_id': [1, 2, 3], 'execution_order': [0, 1, 2]}),
+            call('query_execution', {'query_id': [2, 2], 'execution_id': [5, 6], 'execution_order': [0, 1]}),
+        ])
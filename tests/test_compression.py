@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright MonetDB Solutions B.V. 2018-2019
+import gzip
+import io
+import json
+
+import falcon
+from numpy import arange
+import pytest
+import zstandard
+
+from marvin_backend import compression, serialization
+
+
+class TestNegotiation(object):
+    def test_accepted_encodings(self):
+        assert compression.accepted_encodings('gzip, zstd;q=0.5, br;q=abc') == {'gzip': 1.0, 'zstd': 0.5, 'br': 0.0}
+        assert compression.accepted_encodings(None) == {}
+
+    def test_negotiate_encoding(self):
+        assert compression.negotiate_encoding('gzip, deflate') == 'gzip'
+        assert compression.negotiate_encoding('gzip, zstd') == 'zstd'
+        assert compression.negotiate_encoding('gzip;q=1.0, zstd;q=0.1') == 'gzip'
+        assert compression.negotiate_encoding('*') == 'zstd'
+        assert compression.negotiate_encoding('*, zstd;q=0') == 'gzip'
+        assert compression.negotiate_encoding('identity') is None
+        assert compression.negotiate_encoding(None) is None
+
+
+class TestResponseCompression(object):
+    def large_result(self, mock_db):
+        mock_db.execute_query.return_value = {
+            'query_id': arange(500),
+        }
+
+    def test_small_response(self, client, mock_db):
+        mock_db.execute_query.return_value = {'query_id': arange(1)}
+
+        response = client.simulate_get('/queries', headers={'Accept-Encoding': 'gzip'})
+
+        assert 'content-encoding' not in response.headers
+        assert response.json['data_length'] == 1
+
+    def test_gzip(self, client, mock_db):
+        self.large_result(mock_db)
+
+        response = client.simulate_get('/queries', headers={'Accept-Encoding': 'gzip'})
+
+        assert response.headers['content-encoding'] == 'gzip'
+        assert response.headers['vary'] == 'Accept-Encoding'
+        assert json.loads(gzip.decompress(response.content))['data_length'] == 500
+
+    def test_zstd(self, client, mock_db):
+        self.large_result(mock_db)
+
+        response = client.simulate_get('/queries', headers={'Accept-Encoding': 'gzip, zstd'})
+
+        assert response.headers['content-encoding'] == 'zstd'
+        content = zstandard.ZstdDecompressor().decompressobj().decompress(response.content)
+        assert json.loads(content)['data_length'] == 500
+
+    def test_uncompressed(self, client, mock_db):
+        self.large_result(mock_db)
+
+        response = client.simulate_get('/queries')
+
+        assert 'content-encoding' not in response.headers
+        assert response.json['data_length'] == 500
+
+    def test_streamed_response(self, client, mock_db, monkeypatch):
+        monkeypatch.setattr(serialization, 'STREAMING_THRESHOLD', 10)
+        self.large_result(mock_db)
+
+        response = client.simulate_get('/queries', headers={'Accept-Encoding': 'gzip'})
+
+        assert response.headers['content-encoding'] == 'gzip'
+        assert json.loads(gzip.decompress(response.content))['data_length'] == 500
+
+
+class TestRequestDecompression(object):
+    @pytest.mark.parametrize('encoding, compress', [
+        ('gzip', gzip.compress),
+        ('zstd', lambda data: zstandard.ZstdCompressor().compress(data)),
+    ])
+    def test_compressed_upload(self, client, mock_db, encoding, compress):
+        mock_db.execute_query.return_value = None
+        trace = b'{"event": 1}\n{"event": 2}\n'
+
+        response = client.simulate_post('/traces', body=compress(trace), headers={'Content-Encoding': encoding})
+
+        assert response.status == falcon.HTTP_CREATED
+        mock_db.create_parser.return_value.parse_trace_stream.assert_called_with([{'event': 1}, {'event': 2}])
+
+    def test_compressed_label(self, client, mock_db):
+        label = 'x' * 200
+        body = gzip.compress(json.dumps({'label': label}).encode('utf-8'))
+
+        response = client.simulate_patch('/queries/1', body=body, headers={'Content-Encoding': 'gzip'})
+
+        assert response.status == falcon.HTTP_OK
+        mock_db.execute_query.assert_called_once_with(
+            "UPDATE query SET query_label=%(label)s WHERE query_id=%(qid)s", {'label': label, 'qid': '1'})
+
+    def test_decompressed_size_limit(self):
+        body = gzip.compress(b'x' * 100000)
+        stream = compression.DecompressingStream(io.BytesIO(body), len(body), compression._decompressor('gzip'),
+                                                 max_bytes=50000)
+
+        with pytest.raises(falcon.HTTPError) as error:
+            stream.read()
+        assert error.value.status == falcon.HTTP_413
+
+    def test_corrupt_upload(self, client, mock_db):
+        mock_db.execute_query.return_value = None
+
+        response = client.simulate_post('/traces', body=b'not gzip', headers={'Content-Encoding': 'gzip'})
+
+        assert response.status == falcon.HTTP_BAD_REQUEST
+
+    def test_unsupported_encoding(self, client, mock_db):
+        response = client.simulate_post('/traces', body=b'x', headers={'Content-Encoding': 'br'})
+
+        assert response.status == falcon.HTTP_UNSUPPORTED_MEDIA_TYPE
+        mock_db.parse_trace.assert_not_called()
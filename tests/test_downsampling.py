@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright MonetDB Solutions B.V. 2018-2019
+import numpy as np
+
+from marvin_backend.downsampling import lttb
+
+
+class TestDownsampling(object):
+    def test_short_series_are_kept(self):
+        assert list(lttb([1, 2, 3], [1, 2, 3], 10)) == [0, 1, 2]
+
+    def test_lttb(self):
+        x = np.arange(1000)
+        y = np.sin(x / 50.0)
+        y[500] = 10  # a spike
+
+        keep = lttb(x, y, 50)
+
+        assert len(keep) == 50
+        assert keep[0] == 0
+        assert keep[-1] == 999
+        assert np.all(np.diff(keep) > 0)
+        assert 500 in keep
+
+    def test_lttb_one_point_per_bucket(self):
+        x = np.arange(10)
+        y = np.array([0, 5, 0, 5, 0, 5, 0, 5, 0, 5])
+
+        keep = lttb(x, y, 9)
+
+        assert len(keep) == 9
+        assert len(set(keep)) == 9
@@ -47,7 +47,9 @@ class TestExecutionEndpoints(object):
         response = client.simulate_get('/executions')
         result_doc = response.json
 
-        mock_db.execute_query.assert_called_with("SELECT * FROM mal_execution")
+        mock_db.execute_query.assert_called_with(
+            "SELECT * FROM mal_execution ORDER BY execution_id LIMIT %(limit)s",
+            {'limit': 1001})
         assert result_doc == doc
         assert response.status == falcon.HTTP_OK
 
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright MonetDB Solutions B.V. 2018-2019
+import falcon
+from numpy import array
+
+from marvin_backend import generations
+
+
+class TestGeneration(object):
+    def test_in_memory(self):
+        generation = generations.Generation()
+        assert generation.current() == 0
+        assert generation.bump() == 1
+        assert generation.current() == 1
+        assert generation.epoch != generations.Generation().epoch
+
+    def test_file_backed(self, tmp_path):
+        path = str(tmp_path / 'db.generation')
+        first = generations.Generation(path)
+        second = generations.Generation(path)
+
+        assert first.current() == 0
+        first.bump()
+        second.bump()
+        assert first.current() == second.current() == 2
+
+
+class TestConditionalGet(object):
+    def test_etag(self, client, mock_db):
+        mock_db.execute_query.return_value = {'query_id': array([1])}
+
+        response = client.simulate_get('/queries')
+        etag = response.headers['etag']
+
+        response = client.simulate_get('/queries', headers={'If-None-Match': etag})
+
+        assert response.status == falcon.HTTP_NOT_MODIFIED
+        assert response.headers['etag'] == etag
+        # The second request did not reach the database
+        assert mock_db.execute_query.call_count == 1
+
+    def test_etag_depends_on_request(self, client, mock_db):
+        mock_db.execute_query.return_value = {'query_id': array([1]), 'execution_id': array([1])}
+
+        etags = set()
+        for query_string in ['', 'limit=1', 'layout=columnar']:
+            etags.add(client.simulate_get('/queries', query_string=query_string).headers['etag'])
+        etags.add(client.simulate_get('/executions').headers['etag'])
+
+        assert len(etags) == 4
+
+    def test_weak_and_multiple_etags(self, client, mock_db):
+        mock_db.execute_query.return_value = {'query_id': array([1])}
+        etag = client.simulate_get('/queries').headers['etag']
+
+        response = client.simulate_get('/queries', headers={'If-None-Match': '"other", W/{}'.format(etag)})
+
+        assert response.status == falcon.HTTP_NOT_MODIFIED
+
+    def test_upload_changes_etag(self, client, mock_db):
+        mock_db.execute_query.return_value = {'query_id': array([1])}
+        etag = client.simulate_get('/queries').headers['etag']
+
+        mock_db.execute_query.return_value = None
+        client.simulate_post('/traces', body=b'{}')
+        mock_db.execute_query.return_value = {'query_id': array([1, 2])}
+
+        response = client.simulate_get('/queries', headers={'If-None-Match': etag})
+
+        assert response.status == falcon.HTTP_OK
+        assert response.headers['etag'] != etag
+
+    def test_failed_upload_keeps_etag(self, client, mock_db):
+        mock_db.execute_query.return_value = {'query_id': array([1])}
+        etag = client.simulate_get('/queries').headers['etag']
+
+        mock_db.parse_trace.side_effect = Exception
+        client.simulate_post('/traces', body=b'{}')
+
+        response = client.simulate_get('/queries', headers={'If-None-Match': etag})
+
+        assert response.status == falcon.HTTP_NOT_MODIFIED
+
+    def test_label_changes_etag(self, client, mock_db):
+        mock_db.execute_query.return_value = {'query_id': array([1])}
+        etag = client.simulate_get('/queries').headers['etag']
+
+        client.simulate_patch('/queries/1', body='{"label": "new"}')
+        response = client.simulate_get('/queries', headers={'If-None-Match': etag})
+
+        assert response.status == falcon.HTTP_OK
+
+    def test_no_etag_for_errors(self, client, mock_db):
+        mock_db.execute_query.return_value = {'query_id': array([])}
+
+        response = client.simulate_get('/queries/1')
+
+        assert response.status == falcon.HTTP_NOT_FOUND
+        assert 'etag' not in response.headers
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright MonetDB Solutions B.V. 2018-2019
+import falcon
+from numpy import arange, array
+
+
+class TestHeartbeatEndpoints(object):
+    def test_query_load(self, client, mock_db):
+        times_sql = "SELECT m.server_session AS server, i.mal_execution_id, min(i.astart_time) AS start_t, max(i.aend_time) AS end_t FROM instructions AS i JOIN mal_execution AS m ON i.mal_execution_id=m.execution_id WHERE i.mal_execution_id IN (1, 2, 3) GROUP BY m.server_session, i.mal_execution_id"
+        cpuload_sql = "SELECT server_session, heartbeat_id, ctime, cpuload FROM heartbeat_cpuload WHERE server_session=%(sid)s AND ({}) ORDER BY ctime"
+        db_results = {
+            "SELECT execution_id FROM query_execution WHERE query_id=%(qid)s ORDER BY execution_order": {
+                "execution_id": array([1, 2, 3])
+            },
+            times_sql: {
+                "server": array(["s1", "s1", "s2"]),
+                "mal_execution_id": array([1, 2, 3]),
+                "start_t": array([10, 50, 15]),
+                "end_t": array([20, 60, 25]),
+            },
+            cpuload_sql.format("(ctime>=%(start_time_0)s AND ctime<%(end_time_0)s) OR (ctime>=%(start_time_1)s AND ctime<%(end_time_1)s)"): {
+                "server_session": array(["s1", "s1"]),
+                "heartbeat_id": array([1, 5]),
+                "ctime": array([12, 55]),
+                "cpuload": array([0.5, 0.25]),
+            },
+            cpuload_sql.format("(ctime>=%(start_time_0)s AND ctime<%(end_time_0)s)"): {
+                "server_session": array(["s2"]),
+                "heartbeat_id": array([2]),
+                "ctime": array([16]),
+                "cpuload": array([0.75]),
+            },
+        }
+        mock_db.execute_query.side_effect = lambda sql, params=None: db_results[sql]
+
+        response = client.simulate_get('/queries/1/load')
+
+        mock_db.execute_query.assert_any_call(
+            cpuload_sql.format("(ctime>=%(start_time_0)s AND ctime<%(end_time_0)s) OR (ctime>=%(start_time_1)s AND ctime<%(end_time_1)s)"),
+            {"sid": "s1", "start_time_0": 10, "end_time_0": 20, "start_time_1": 50, "end_time_1": 60})
+        # One query for the executions, one for their times and one per server
+        assert mock_db.execute_query.call_count == 4
+        assert sorted(response.json['data'], key=lambda r: r['heartbeat_id']) == [
+            {"server_session": "s1", "heartbeat_id": 1, "ctime": 12, "cpuload": 0.5},
+            {"server_session": "s2", "heartbeat_id": 2, "ctime": 16, "cpuload": 0.75},
+            {"server_session": "s1", "heartbeat_id": 5, "ctime": 55, "cpuload": 0.25},
+        ]
+        assert response.status == falcon.HTTP_OK
+
+    def test_query_load_without_rollups(self, client, mock_db):
+        db_results = [
+            {
+                "execution_id": array([1])
+            },
+            {
+                "server": array(["s1"]),
+                "mal_execution_id": array([1]),
+                "start_t": array([10]),
+                "end_t": array([20]),
+            },
+            # The rollup table does not exist
+            None,
+            {
+                "server_session": array(["s1"]),
+                "heartbeat_id": array([1]),
+                "ctime": array([12]),
+                "cpuload": array([0.5]),
+            },
+        ]
+        mock_db.execute_query.side_effect = db_results
+
+        response = client.simulate_get('/queries/1/load')
+
+        mock_db.execute_query.assert_called_with(
+            "SELECT h.server_session, h.heartbeat_id, h.ctime, avg(c.val) AS cpuload FROM cpuload AS c JOIN heartbeat AS h ON c.heartbeat_id=h.heartbeat_id WHERE h.server_session=%(sid)s AND ((h.ctime>=%(start_time_0)s AND h.ctime<%(end_time_0)s)) GROUP BY h.heartbeat_id, h.ctime, h.server_session ORDER BY h.ctime",
+            {"sid": "s1", "start_time_0": 10, "end_time_0": 20})
+        assert response.json['data_length'] == 1
+
+    def test_query_load_contained_execution(self, client, mock_db):
+        db_results = [
+            {
+                "execution_id": array([1, 2])
+            },
+            {
+                "server": array(["s1", "s1"]),
+                "mal_execution_id": array([1, 2]),
+                "start_t": array([10, 20]),
+                "end_t": array([100, 30]),
+            },
+            {
+                "server_session": array(["s1"]),
+                "heartbeat_id": array([1]),
+                "ctime": array([50]),
+                "cpuload": array([0.5]),
+            },
+        ]
+        mock_db.execute_query.side_effect = db_results
+
+        response = client.simulate_get('/queries/1/load')
+
+        # The second execution is contained in the first one, so it must
+        # not shorten the timeline.
+        assert mock_db.execute_query.call_args[0][1] == {"sid": "s1", "start_time_0": 10, "end_time_0": 100}
+        assert response.json['data_length'] == 1
+
+    def test_cpuload(self, client, mock_db):
+        mock_db.execute_query.return_value = {
+            "heartbeat_id": array([1, 2]),
+            "ctime": array([100, 200]),
+            "cpuload": array([0.5, 0.25]),
+        }
+
+        response = client.simulate_get('/cpuload/s1', query_string='from=100&to=300')
+
+        mock_db.execute_query.assert_called_with(
+            "SELECT heartbeat_id, ctime, cpuload FROM heartbeat_cpuload WHERE server_session=%(sid)s AND ctime>=%(start_time)s AND ctime<%(end_time)s ORDER BY ctime",
+            {"sid": "s1", "start_time": 100, "end_time": 300})
+        assert response.json['data_length'] == 2
+        assert response.status == falcon.HTTP_OK
+
+    def test_cpuload_buckets(self, client, mock_db):
+        mock_db.execute_query.return_value = {
+            "ctime": array([0, 60]),
+            "cpuload": array([0.5, 0.25]),
+            "heartbeats": array([6, 6]),
+        }
+
+        response = client.simulate_get('/cpuload/s1', query_string='bucket=60')
+
+        # Smaller than a minute, so computed from the heartbeats
+        mock_db.execute_query.assert_called_with(
+            "SELECT b.ctime, sum(b.cpuload * b.cores) / sum(b.cores) AS cpuload, count(*) AS heartbeats FROM (SELECT (ctime / %(bucket)s) * %(bucket)s AS ctime, cpuload, cores FROM heartbeat_cpuload WHERE server_session=%(sid)s) AS b GROUP BY b.ctime ORDER BY b.ctime",
+            {"sid": "s1", "bucket": 60})
+        assert response.json['data'] == [
+            {"ctime": 0, "cpuload": 0.5, "heartbeats": 6},
+            {"ctime": 60, "cpuload": 0.25, "heartbeats": 6},
+        ]
+
+    def test_cpuload_rollup_buckets(self, client, mock_db):
+        mock_db.execute_query.return_value = {
+            "ctime": array([0, 7200000000]),
+            "cpuload": array([0.5, 0.25]),
+            "heartbeats": array([720, 720]),
+        }
+
+        response = client.simulate_get('/cpuload/s1', query_string='bucket=7200000000&from=0&to=14400000000')
+
+        # Two hour buckets are combined from the hour rollup
+        mock_db.execute_query.assert_called_with(
+            "SELECT b.ctime, sum(b.load_sum) / sum(b.samples) AS cpuload, sum(b.heartbeats) AS heartbeats FROM (SELECT (ctime / %(bucket)s) * %(bucket)s AS ctime, load_sum, samples, heartbeats FROM cpuload_rollup WHERE resolution=%(resolution)s AND server_session=%(sid)s AND ctime>=%(start_time)s AND ctime<%(end_time)s) AS b GROUP BY b.ctime ORDER BY b.ctime",
+            {"sid": "s1", "bucket": 7200000000, "start_time": 0, "end_time": 14400000000, "resolution": 3600000000})
+        assert response.json['data_length'] == 2
+
+    def test_cpuload_unaligned_range(self, client, mock_db):
+        mock_db.execute_query.return_value = {
+            "ctime": array([0]),
+            "cpuload": array([0.5]),
+            "heartbeats": array([60]),
+        }
+
+        client.simulate_get('/cpuload/s1', query_string='bucket=60000000&from=30000000')
+
+        # The first minute is only partly in the range
+        assert "FROM heartbeat_cpuload" in mock_db.execute_query.call_args[0][0]
+
+    def test_cpuload_without_rollups(self, client, mock_db):
+        mock_db.execute_query.side_effect = [
+            None,
+            {
+                "heartbeat_id": array([1]),
+                "ctime": array([100]),
+                "cpuload": array([0.5]),
+            },
+        ]
+
+        response = client.simulate_get('/cpuload/s1')
+
+        mock_db.execute_query.assert_called_with(
+            "SELECT h.heartbeat_id, h.ctime, avg(c.val) AS cpuload FROM cpuload AS c JOIN heartbeat AS h ON c.heartbeat_id=h.heartbeat_id WHERE h.server_session=%(sid)s GROUP BY h.heartbeat_id, h.ctime ORDER BY h.ctime",
+            {"sid": "s1"})
+        assert response.json['data_length'] == 1
+
+    def test_cpuload_before_rollups(self, client, mock_db):
+        mock_db.execute_query.side_effect = [
+            # The heartbeats were ingested before the rollup tables
+            # were created
+            {
+                "heartbeat_id": array([]),
+                "ctime": array([]),
+                "cpuload": array([]),
+            },
+            {
+                "heartbeat_id": array([1]),
+                "ctime": array([100]),
+                "cpuload": array([0.5]),
+            },
+        ]
+
+        response = client.simulate_get('/cpuload/s1')
+
+        assert "FROM cpuload AS c" in mock_db.execute_query.call_args[0][0]
+        assert response.json['data_length'] == 1
+
+    def test_cpuload_max_points(self, client, mock_db):
+        mock_db.execute_query.return_value = {
+            "heartbeat_id": arange(100),
+            "ctime": arange(100) * 10,
+            "cpuload": (arange(100) % 7) / 7.0,
+        }
+
+        response = client.simulate_get('/cpuload/s1', query_string='max_points=20')
+
+        data = response.json['data']
+        assert len(data) == 20
+        assert data[0]['ctime'] == 0
+        assert data[-1]['ctime'] == 990
+
+    def test_cpuload_bad_parameters(self, client, mock_db):
+        for query_string in ['bucket=0', 'max_points=2', 'from=abc']:
+            response = client.simulate_get('/cpuload/s1', query_string=query_string)
+            assert response.status == falcon.HTTP_BAD_REQUEST
+
+        mock_db.execute_query.assert_not_called()
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright MonetDB Solutions B.V. 2018-2019
+from hypothesis import given
+from hypothesis import strategies as st
+import pytest
+
+from marvin_backend.intervals import IntervalSet
+
+# Intervals on a small range of integers, so that the sets can be
+# checked point by point.
+interval = st.tuples(st.integers(0, 60), st.integers(0, 20)).map(lambda t: (t[0], t[0] + t[1]))
+interval_lists = st.lists(interval, max_size=20)
+
+
+def points(pairs):
+    return set(p for s, e in pairs for p in range(s, e))
+
+
+class TestIntervals(object):
+    def test_merge(self):
+        iset = IntervalSet.from_pairs([[50, 60], [10, 20], [15, 25], [30, 40], [32, 35], [40, 45], [70, 70]])
+
+        # Overlapping, contained and adjacent intervals are merged and
+        # empty ones are dropped.
+        assert list(iset) == [(10, 25), (30, 45), (50, 60)]
+
+    def test_contained_interval_does_not_shrink(self):
+        assert list(IntervalSet([0, 5], [100, 10])) == [(0, 100)]
+
+    def test_bad_interval(self):
+        with pytest.raises(ValueError):
+            IntervalSet([10], [5])
+
+    def test_contains(self):
+        iset = IntervalSet.from_pairs([(10, 20), (30, 40)])
+
+        assert iset.contains(10)
+        assert not iset.contains(20)
+        assert list(iset.contains([5, 15, 25, 35, 45])) == [False, True, False, True, False]
+        assert not IntervalSet().contains(1)
+
+    def test_overlapping(self):
+        iset = IntervalSet.from_pairs([(10, 20), (30, 40), (50, 60)])
+
+        assert list(iset.overlapping(15, 31)) == [(10, 20), (30, 40)]
+        assert list(iset.overlapping(20, 30)) == []
+
+    @given(interval_lists)
+    def test_normalized(self, pairs):
+        result = list(IntervalSet.from_pairs(pairs))
+
+        assert points(result) == points(pairs)
+        assert all(s < e for s, e in result)
+        # sorted, with gaps between consecutive intervals
+        assert all(a[1] < b[0] for a, b in zip(result, result[1:]))
+
+    @given(interval_lists, interval_lists)
+    def test_union(self, a, b):
+        result = IntervalSet.from_pairs(a).union(IntervalSet.from_pairs(b))
+
+        assert points(result) == points(a) | points(b)
+        assert result == IntervalSet.from_pairs(a + b)
+
+    @given(interval_lists, interval_lists)
+    def test_intersection(self, a, b):
+        result = IntervalSet.from_pairs(a).intersection(IntervalSet.from_pairs(b))
+
+        assert points(result) == points(a) & points(b)
+        assert result == IntervalSet.from_pairs(list(result))
+
+    @given(interval_lists, st.lists(st.integers(-5, 90)))
+    def test_contains_points(self, pairs, pts):
+        iset = IntervalSet.from_pairs(pairs)
+        covered = points(pairs)
+
+        assert list(iset.contains(pts)) == [p in covered for p in pts]
+
+    @given(interval_lists, interval)
+    def test_overlapping_range(self, pairs, rng):
+        iset = IntervalSet.from_pairs(pairs)
+
+        expected = [(s, e) for s, e in iset if s < rng[1] and rng[0] < e]
+        assert list(iset.overlapping(*rng)) == expected
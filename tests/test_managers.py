@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright MonetDB Solutions B.V. 2018-2019
+from unittest.mock import MagicMock
+
+from falcon import testing
+from numpy import array
+import pytest
+
+from marvin_backend import managers, marvin_backend
+
+
+class TestLazyManager(object):
+    def test_opened_on_first_use(self):
+        mock_db = MagicMock()
+        factory = MagicMock(return_value=mock_db)
+        manager = managers.LazyManager(factory)
+
+        assert not manager.is_open
+        factory.assert_not_called()
+
+        manager.execute_query("SELECT 1")
+        manager.execute_query("SELECT 2")
+
+        assert manager.is_open
+        factory.assert_called_once_with()
+        assert mock_db.execute_query.call_count == 2
+
+    def test_post_fork(self):
+        factory = MagicMock()
+        manager = managers.LazyManager(factory)
+
+        managers.post_fork(manager)(None, None)
+        managers.post_fork(manager)(None, None)
+
+        factory.assert_called_once_with()
+
+
+class TestCreateApp(object):
+    def test_manager_factory(self):
+        mock_db = MagicMock()
+        mock_db.execute_query.return_value = {'query_id': array([1])}
+        factory = MagicMock(return_value=mock_db)
+        client = testing.TestClient(marvin_backend.create_app(manager_factory=factory))
+
+        # Building the application does not open the database
+        factory.assert_not_called()
+
+        client.simulate_get('/queries')
+        client.simulate_get('/queries')
+
+        factory.assert_called_once_with()
+        assert mock_db.execute_query.call_count == 2
+
+    def test_manager_or_factory(self):
+        with pytest.raises(ValueError):
+            marvin_backend.create_app()
+        with pytest.raises(ValueError):
+            marvin_backend.create_app(MagicMock(), manager_factory=MagicMock())
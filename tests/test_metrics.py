@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright MonetDB Solutions B.V. 2018-2019
+import json
+import logging
+import os
+
+import falcon
+from numpy import array
+import pytest
+
+from marvin_backend import metrics
+
+
+def sample(text, line_start):
+    """The value of the sample starting with ``line_start``."""
+    for line in text.splitlines():
+        if line.startswith(line_start + ' '):
+            return float(line.rsplit(' ', 1)[1])
+
+    raise KeyError(line_start)
+
+
+class TestMetricsRegistry(object):
+    def test_render(self):
+        registry = metrics.MetricsRegistry(buckets=(0.1, 1.0))
+        labels = {'route': '/queries', 'method': 'GET'}
+        registry.observe('marvin_http_request_duration_seconds', labels, 0.05)
+        registry.observe('marvin_http_request_duration_seconds', labels, 0.5)
+        registry.observe('marvin_http_request_duration_seconds', labels, 5)
+        registry.inc('marvin_http_requests_total', dict(labels, status='200'), 3)
+
+        text = registry.render()
+
+        assert '# TYPE marvin_http_request_duration_seconds histogram' in text
+        series = 'marvin_http_request_duration_seconds_bucket{method="GET",route="/queries",le="%s"}'
+        assert sample(text, series % '0.1') == 1
+        assert sample(text, series % '1') == 2
+        assert sample(text, series % '+Inf') == 3
+        assert sample(text, 'marvin_http_request_duration_seconds_count{method="GET",route="/queries"}') == 3
+        assert sample(text, 'marvin_http_request_duration_seconds_sum{method="GET",route="/queries"}') == 5.55
+        assert sample(text, 'marvin_http_requests_total{method="GET",route="/queries",status="200"}') == 3
+
+    def test_label_escaping(self):
+        registry = metrics.MetricsRegistry()
+        registry.inc('marvin_db_call_errors_total', {'method': 'a"b\\c'})
+
+        assert 'marvin_db_call_errors_total{method="a\\"b\\\\c"} 1' in registry.render()
+
+    def test_processes_are_aggregated(self, tmp_path):
+        registry = metrics.MetricsRegistry(str(tmp_path))
+        registry.inc('marvin_http_requests_total', {'route': '/queries', 'method': 'GET', 'status': '200'}, 2)
+        registry.inc('marvin_http_requests_in_flight', value=1)
+
+        # The snapshot of another worker, that has exited
+        other = {
+            'pid': 2 ** 22 + 1,
+            'buckets': list(metrics.DEFAULT_BUCKETS),
+            'values': {
+                'marvin_http_requests_total': [[[['method', 'GET'], ['route', '/queries'], ['status', '200']], 5]],
+                'marvin_http_requests_in_flight': [[[], 4]],
+            },
+        }
+        with open(os.path.join(str(tmp_path), 'metrics-{}.json'.format(other['pid'])), 'w') as fl:
+            json.dump(other, fl)
+
+        text = registry.render()
+
+        assert sample(text, 'marvin_http_requests_total{method="GET",route="/queries",status="200"}') == 7
+        # Only the gauges of live processes count
+        assert sample(text, 'marvin_http_requests_in_flight') == 1
+
+        # The counters of the exited worker are kept
+        registry.inc('marvin_http_requests_total', {'route': '/queries', 'method': 'GET', 'status': '200'})
+        text = registry.render()
+        assert sample(text, 'marvin_http_requests_total{method="GET",route="/queries",status="200"}') == 8
+        assert not os.path.exists(os.path.join(str(tmp_path), 'metrics-{}.json'.format(other['pid'])))
+
+        metrics.clear_directory(str(tmp_path))
+        assert os.listdir(str(tmp_path)) == []
+
+    def test_reused_pid(self, tmp_path):
+        labels = {'route': '/queries', 'method': 'GET', 'status': '200'}
+        exited = metrics.MetricsRegistry(str(tmp_path))
+        exited.inc('marvin_http_requests_total', labels, 5)
+        exited.inc('marvin_http_requests_in_flight')
+        exited.flush(force=True)
+
+        # A new worker with the same pid
+        registry = metrics.MetricsRegistry(str(tmp_path))
+        registry.inc('marvin_http_requests_total', labels, 2)
+        registry.flush(force=True)
+
+        text = registry.render()
+        assert sample(text, 'marvin_http_requests_total{method="GET",route="/queries",status="200"}') == 7
+        # The gauges of the exited worker are dropped
+        with pytest.raises(KeyError):
+            sample(text, 'marvin_http_requests_in_flight')
+
+
+class TestInstrumentedManager(object):
+    def test_timing_and_errors(self, mock_db):
+        registry = metrics.MetricsRegistry()
+        manager = metrics.InstrumentedManager(mock_db, registry)
+
+        mock_db.execute_query.return_value = None
+        assert manager.execute_query("SELECT 1") is None
+        # Statements without a result set
+        assert manager.execute_query("CREATE TABLE IF NOT EXISTS t (i int)") is None
+        assert manager.execute_query("  delete FROM t") is None
+        mock_db.parse_trace.side_effect = ValueError("bad trace")
+        with pytest.raises(ValueError):
+            manager.parse_trace("{}")
+        manager.commit()
+
+        mock_db.commit.assert_called_once_with()
+        text = registry.render()
+        assert sample(text, 'marvin_db_call_duration_seconds_count{method="execute_query"}') == 3
+        assert sample(text, 'marvin_db_call_errors_total{method="execute_query"}') == 1
+        assert sample(text, 'marvin_db_call_errors_total{method="parse_trace"}') == 1
+
+    def test_raised_errors(self, mock_db):
+        registry = metrics.MetricsRegistry()
+        manager = metrics.InstrumentedManager(mock_db, registry)
+        mock_db.execute_query.side_effect = RuntimeError("connection lost")
+
+        with pytest.raises(RuntimeError):
+            manager.execute_query("INSERT INTO t VALUES (1)")
+
+        text = registry.render()
+        assert sample(text, 'marvin_db_call_errors_total{method="execute_query"}') == 1
+        assert sample(text, 'marvin_db_call_duration_seconds_count{method="execute_query"}') == 1
+
+    def test_slow_query_log(self, mock_db, caplog):
+        registry = metrics.MetricsRegistry()
+        timings = metrics.RequestTimings()
+        manager = metrics.InstrumentedManager(mock_db, registry, timings, slow_query_seconds=0)
+        mock_db.execute_query.return_value = {'query_id': array([1, 2, 3])}
+
+        with caplog.at_level(logging.WARNING, logger='marvin_backend.slow_sql'):
+            manager.execute_query("SELECT * FROM query WHERE query_id=%(qid)s", {'qid': 1})
+
+        assert timings.calls == 1
+        assert timings.rows == 3
+        assert "3 rows: SELECT * FROM query WHERE query_id=?" in caplog.text
+        assert 'marvin_db_slow_calls_total{method="execute_query"} 1' in registry.render()
+
+    def test_fast_queries_are_not_logged(self, mock_db, caplog):
+        manager = metrics.InstrumentedManager(mock_db, metrics.MetricsRegistry(), slow_query_seconds=60)
+
+        with caplog.at_level(logging.WARNING, logger='marvin_backend.slow_sql'):
+            manager.execute_query("SELECT 1")
+
+        assert caplog.records == []
+
+
+class TestNormalizeSQL(object):
+    def test_values(self):
+        sql = """SELECT parent_id, child_id
+                 FROM initiates_executions
+                 WHERE parent_id IN (1, 2, 3) AND t1.label = 'it''s' AND x > 1.5 AND y = %(y)s"""
+
+        assert metrics.normalize_sql(sql) == ("SELECT parent_id, child_id FROM initiates_executions "
+                                              "WHERE parent_id IN (...) AND t1.label = ? AND x > ? AND y = ?")
+
+
+class TestMetricsEndpoint(object):
+    def test_requests_are_counted(self, client, mock_db):
+        mock_db.execute_query.return_value = {'query_id': array([1, 2])}
+        client.simulate_get('/queries')
+        client.simulate_get('/queries')
+        client.simulate_get('/executions/1/missing')
+
+        response = client.simulate_get('/metrics')
+
+        assert response.status == falcon.HTTP_OK
+        assert response.headers['content-type'] == metrics.CONTENT_TYPE
+        text = response.text
+        assert sample(text, 'marvin_http_requests_total{method="GET",route="/queries",status="200"}') == 2
+        assert sample(text, 'marvin_http_requests_total{method="GET",route="unmatched",status="404"}') == 1
+        assert sample(text, 'marvin_http_request_duration_seconds_count{method="GET",route="/queries"}') == 2
+        assert sample(text, 'marvin_http_response_bytes_total{method="GET",route="/queries"}') > 0
+        assert sample(text, 'marvin_db_call_duration_seconds_count{method="execute_query"}') == 2
+        # The request for the metrics is still being served
+        assert sample(text, 'marvin_http_requests_in_flight') == 1
+
+    def test_streamed_bytes(self, client, mock_db):
+        mock_db.execute_query.return_value = {'query_id': array(range(20000))}
+        body = client.simulate_get('/queries', headers={'Accept-Encoding': 'identity'}).content
+
+        text = client.simulate_get('/metrics').text
+
+        assert sample(text, 'marvin_http_response_bytes_total{method="GET",route="/queries"}') == len(body)
+
+    def test_server_timing(self, client, mock_db):
+        mock_db.execute_query.return_value = {'query_id': array([1, 2])}
+
+        header = client.simulate_get('/queries').headers['server-timing']
+
+        timings = dict(m.strip().split(';', 1) for m in header.split(','))
+        assert set(timings) == {'db', 'serialize', 'total'}
+        assert timings['db'].endswith('desc="1 calls / 2 rows"')
+
+    def test_streamed_server_timing(self, client, mock_db):
+        mock_db.execute_query.return_value = {'mal_execution_id': array(range(20000))}
+
+        header = client.simulate_get('/executions/1/statements').headers['server-timing']
+
+        # The response is encoded after the header is sent
+        timings = dict(m.strip().split(';', 1) for m in header.split(','))
+        assert set(timings) == {'db', 'total'}
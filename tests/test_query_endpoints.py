@@ -48,10 +48,74 @@ class TestQueryEndpoints(object):
         response = client.simulate_get('/queries')
         result_doc = response.json
 
-        mock_db.execute_query.assert_called_with("SELECT * FROM query")
+        mock_db.execute_query.assert_called_with(
+            "SELECT * FROM query ORDER BY query_id LIMIT %(limit)s",
+            {'limit': 1001})
         assert result_doc == doc
         assert response.status == falcon.HTTP_OK
 
+    def test_queries_next_page(self, client, mock_db):
+        query_result = {
+            "query_id": array([3, 4, 5]),
+            "query_text": array(["SELECT 3;", "SELECT 4;", "SELECT 5;"]),
+            "query_label": masked_array(data=["", "", ""],
+                                        mask=[True, True, True]),
+            "root_execution_id": array([3, 4, 5])
+        }
+        mock_db.execute_query.return_value = query_result
+
+        response = client.simulate_get('/queries',
+                                       query_string='limit=2&after=2')
+        result_doc = response.json
+
+        mock_db.execute_query.assert_called_with(
+            "SELECT * FROM query WHERE query_id > %(after)s ORDER BY query_id LIMIT %(limit)s",
+            {'limit': 3, 'after': 2})
+        assert [q['query_id'] for q in result_doc['data']] == [3, 4]
+        assert result_doc['data_length'] == 2
+        assert result_doc['links']['next'] == "http://falconframework.org/queries?limit=2&after=4"
+        assert response.status == falcon.HTTP_OK
+
+    def test_queries_bad_limit(self, client, mock_db):
+        response = client.simulate_get('/queries', query_string='limit=0')
+
+        mock_db.execute_query.assert_not_called()
+        assert response.status == falcon.HTTP_BAD_REQUEST
+
+    def test_queries_columnar(self, client, mock_db):
+        query_result = {
+            "query_id": array([1, 2]),
+            "query_text": array(["SELECT * FROM foo;", "SELECT * FROM bar;"]),
+            "query_label": masked_array(data=["null label", "non null label"],
+                                        mask=[True, False]),
+            "root_execution_id": array([1, 40])
+        }
+        mock_db.execute_query.return_value = query_result
+
+        doc = {
+            "columns": {
+                "query_id": [1, 2],
+                "query_text": ["SELECT * FROM foo;", "SELECT * FROM bar;"],
+                "query_label": [None, "non null label"],
+                "root_execution_id": [1, 40]
+            },
+            "data_length": 2,
+            "links": {
+                "url": "http://falconframework.org/queries?layout=columnar"
+            }
+        }
+
+        response = client.simulate_get('/queries', query_string='layout=columnar')
+
+        assert response.json == doc
+        assert response.status == falcon.HTTP_OK
+
+    def test_queries_bad_layout(self, client, mock_db):
+        response = client.simulate_get('/queries', query_string='layout=foo')
+
+        mock_db.execute_query.assert_not_called()
+        assert response.status == falcon.HTTP_BAD_REQUEST
+
     def test_single_query(self, client, mock_db):
         query_result = {
             "query_id": array([1]),
@@ -131,18 +195,30 @@ class TestQueryEndpoints(object):
 
     def test_get_executions(self, client, mock_db):
         db_results = [
-            # run a query that gives back the call graph nodes
+            # Nothing stored in query_execution
             {
-                'execution_id': array([1, 2, 3, 4, 5])
+                "execution_id": array([])
             },
-            # result of a query that gets the edges
             {
-                "parent_id": array([1, 1, 2, 3, 5]),
-                "child_id": array([1, 2, 3, 4, 5])
+                "root_execution_id": array([1])
             },
+            # The edges leaving each level of the execution graph
             {
-                "root_execution_id": array([1])
-            }
+                "parent_id": array([1, 1]),
+                "child_id": array([1, 2])
+            },
+            {
+                "parent_id": array([2]),
+                "child_id": array([3])
+            },
+            {
+                "parent_id": array([3]),
+                "child_id": array([4])
+            },
+            {
+                "parent_id": array([]),
+                "child_id": array([])
+            },
         ]
 
         mock_db.execute_query.side_effect = db_results
@@ -156,47 +232,115 @@ class TestQueryEndpoints(object):
             }
         }
 
+        frontier_sql = "SELECT parent_id, child_id FROM initiates_executions WHERE parent_id IN ({}) ORDER BY initiates_executions_id"
         calls = [
-            call("SELECT execution_id FROM mal_execution"),
-            call("SELECT parent_id, child_id FROM initiates_executions"),
+            call(
+                "SELECT execution_id FROM query_execution WHERE query_id=%(qid)s ORDER BY execution_order",
+                {"qid": "1"}),
             call(
                 """SELECT root_execution_id FROM query WHERE query_id=%(qid)s""",
-                {"qid": "1"})
+                {"qid": "1"}),
+            call(frontier_sql.format("1")),
+            call(frontier_sql.format("2")),
+            call(frontier_sql.format("3")),
+            call(frontier_sql.format("4")),
         ]
 
         mock_db.execute_query.assert_has_calls(calls)
-        assert mock_db.execute_query.call_count == 3
+        assert mock_db.execute_query.call_count == 6
         assert response.json == doc
         assert response.status == falcon.HTTP_OK
 
-    def test_get_executions_bad_qid(self, client, mock_db):
+    def test_get_executions_in_process_fallback(self, client, mock_db):
         db_results = [
-            # run a query that gives back the call graph nodes
+            # Nothing stored in query_execution
             {
-                'execution_id': array([1, 2, 3, 4, 5])
+                "execution_id": array([])
             },
-            # result of a query that gets the edges
             {
-                "parent_id": array([]),
-                "child_id": array([])
+                "root_execution_id": array([1])
             },
+            # The frontier query fails
+            None,
+            {
+                "parent_id": array([1, 1, 2, 3, 5]),
+                "child_id": array([1, 2, 3, 4, 5])
+            },
+        ]
+
+        mock_db.execute_query.side_effect = db_results
+        response = client.simulate_get("/queries/1/executions")
+
+        mock_db.execute_query.assert_called_with(
+            "SELECT parent_id, child_id FROM initiates_executions")
+        assert mock_db.execute_query.call_count == 4
+        assert response.json["data"] == [1, 2, 3, 4]
+        assert response.status == falcon.HTTP_OK
+
+    def test_get_executions_columnar(self, client, mock_db):
+        db_results = [
+            # Nothing stored in query_execution
             {
                 "execution_id": array([])
-            }
+            },
+            {
+                "root_execution_id": array([1])
+            },
+            {
+                "parent_id": array([1, 1]),
+                "child_id": array([1, 2])
+            },
+            {
+                "parent_id": array([]),
+                "child_id": array([])
+            },
         ]
 
         mock_db.execute_query.side_effect = db_results
-        response = client.simulate_get("/queries/8/executions")
+        response = client.simulate_get("/queries/1/executions",
+                                       query_string="layout=columnar")
 
-        calls = [
-            call("SELECT execution_id FROM mal_execution"),
-            call("SELECT parent_id, child_id FROM initiates_executions"),
-            call(
-                """SELECT root_execution_id FROM query WHERE query_id=%(qid)s""",
-                {"qid": "8"})
+        doc = {
+            "columns": {
+                "execution_id": [1, 2]
+            },
+            "data_length": 2,
+            "links": {
+                "url": "http://falconframework.org/queries/1/executions?layout=columnar"
+            }
+        }
+
+        assert response.json == doc
+        assert response.status == falcon.HTTP_OK
+
+    def test_get_stored_executions(self, client, mock_db):
+        mock_db.execute_query.return_value = {
+            "execution_id": array([1, 2, 3, 4])
+        }
+
+        response = client.simulate_get("/queries/1/executions")
+
+        mock_db.execute_query.assert_called_once_with(
+            "SELECT execution_id FROM query_execution WHERE query_id=%(qid)s ORDER BY execution_order",
+            {"qid": "1"})
+        assert response.json["data"] == [1, 2, 3, 4]
+        assert response.status == falcon.HTTP_OK
+
+    def test_get_executions_bad_qid(self, client, mock_db):
+        db_results = [
+            {
+                "execution_id": array([])
+            },
+            {
+                "root_execution_id": array([])
+            },
         ]
+        mock_db.execute_query.side_effect = db_results
 
-        mock_db.execute_query.assert_has_calls(calls)
+        response = client.simulate_get("/queries/8/executions")
 
-        assert mock_db.execute_query.call_count == 3
+        mock_db.execute_query.assert_called_with(
+            """SELECT root_execution_id FROM query WHERE query_id=%(qid)s""",
+            {"qid": "8"})
+        assert mock_db.execute_query.call_count == 2
         assert response.status == falcon.HTTP_NOT_FOUND
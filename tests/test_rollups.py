@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright MonetDB Solutions B.V. 2018-2019
+from numpy import array
+from numpy.ma import masked_array
+
+from marvin_backend import rollups
+
+
+class TestCPULoadRollups(object):
+    def test_resolution_for(self):
+        assert rollups.resolution_for(rollups.SECOND) is None
+        assert rollups.resolution_for(90 * rollups.SECOND) is None
+        assert rollups.resolution_for(5 * rollups.MINUTE) == rollups.MINUTE
+        assert rollups.resolution_for(90 * rollups.MINUTE) == rollups.MINUTE
+        assert rollups.resolution_for(24 * rollups.HOUR) == rollups.HOUR
+
+    def test_before_ingest(self, mock_db):
+        mock_db.execute_query.return_value = {
+            'max_heartbeat_id': masked_array(data=[0], mask=[True]),
+        }
+
+        limits = rollups.CPULoadRollups(mock_db).before_ingest()
+        assert limits == {'max_heartbeat_id': 0}
+
+    def test_after_ingest(self, mock_db):
+        mock_db.execute_query.return_value = {
+            'server_session': array(['s1']),
+            'start_t': array([59 * rollups.SECOND]),
+            'end_t': array([61 * rollups.SECOND]),
+        }
+
+        rollups.CPULoadRollups(mock_db).after_ingest({'max_heartbeat_id': 30})
+
+        calls = [c[0] for c in mock_db.execute_query.call_args_list]
+        assert calls[0][0].startswith("INSERT INTO heartbeat_cpuload ")
+        assert calls[0][1] == {'max_heartbeat_id': 30}
+
+        # The new heartbeats span two minute buckets and one hour bucket
+        deletes = [c[1] for c in calls if c[0].startswith("DELETE FROM cpuload_rollup")]
+        assert deletes == [
+            {'resolution': rollups.MINUTE, 'sid': 's1', 'first_bucket': 0,
+             'last_bucket': rollups.MINUTE, 'end_bucket': 2 * rollups.MINUTE},
+            {'resolution': rollups.HOUR, 'sid': 's1', 'first_bucket': 0,
+             'last_bucket': 0, 'end_bucket': rollups.HOUR},
+        ]
+        inserts = [c for c in calls if c[0].startswith("INSERT INTO cpuload_rollup")]
+        assert len(inserts) == 2
+
+    def test_after_ingest_without_heartbeats(self, mock_db):
+        mock_db.execute_query.return_value = {
+            'server_session': array([]),
+            'start_t': array([]),
+            'end_t': array([]),
+        }
+
+        rollups.CPULoadRollups(mock_db).after_ingest({'max_heartbeat_id': 30})
+
+        # Only the per heartbeat insert and the ranges query
+        assert mock_db.execute_query.call_count == 2
+
+    def test_after_ingest_without_ctime(self, mock_db):
+        mock_db.execute_query.return_value = {
+            'server_session': array(['s1']),
+            'start_t': masked_array([0], mask=[True]),
+            'end_t': masked_array([0], mask=[True]),
+        }
+
+        rollups.CPULoadRollups(mock_db).after_ingest({'max_heartbeat_id': 30})
+
+        # No bucket to refresh
+        assert mock_db.execute_query.call_count == 2
+
+    def test_backfill(self, mock_db):
+        mock_db.execute_query.return_value = {
+            'server_session': array(['s1', 's2']),
+            'start_t': array([0, 0]),
+            'end_t': array([10, 10]),
+        }
+
+        count = rollups.CPULoadRollups(mock_db).backfill()
+
+        assert count == 2
+        mock_db.execute_query.assert_any_call("DELETE FROM heartbeat_cpuload")
+        mock_db.execute_query.assert_any_call("DELETE FROM cpuload_rollup")
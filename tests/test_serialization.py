@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright MonetDB Solutions B.V. 2018-2019
+import json
+
+import falcon
+from numpy import array, int64
+from numpy.ma import masked_array
+import pytest
+
+from marvin_backend import serialization
+
+
+class TestSerialization(object):
+    def test_rows(self):
+        rows = serialization.Rows({'key1': [1, 2], 'key2': ['a', 'b']})
+
+        assert len(rows) == 2
+        assert list(rows) == [{'key1': 1, 'key2': 'a'}, {'key1': 2, 'key2': 'b'}]
+        assert rows[1:] == [{'key1': 2, 'key2': 'b'}]
+
+    def test_encode_columns(self):
+        dl = {
+            'id': array([1, 2]),
+            'label': masked_array(data=['a', 'b'], mask=[True, False]),
+            'listed': [int64(3), 'c'],
+        }
+
+        columns = serialization.encode_columns(dl)
+        assert columns == {'id': [1, 2], 'label': [None, 'b'], 'listed': [3, 'c']}
+        assert type(columns['id'][0]) is int
+        assert type(columns['listed'][0]) is int
+
+    @pytest.mark.parametrize('backend', sorted(serialization.JSON_BACKENDS))
+    def test_json_backends(self, backend, monkeypatch):
+        monkeypatch.setattr(serialization, '_json_backend', serialization._json_backend)
+        serialization.set_json_backend(backend)
+        dl = {
+            'id': array([1, 2]),
+            'text': array(['ascii', 'ελληνικά']),
+            'label': masked_array(data=['a', 'b'], mask=[False, True]),
+            'val': array([0.25, 1.5]),
+        }
+
+        encoded = serialization.dumps(serialization.rows_document({'url': 'u'}, dl))
+        assert json.loads(encoded.decode('utf-8')) == {
+            'links': {'url': 'u'},
+            'data': [
+                {'id': 1, 'text': 'ascii', 'label': 'a', 'val': 0.25},
+                {'id': 2, 'text': 'ελληνικά', 'label': None, 'val': 1.5},
+            ],
+            'data_length': 2,
+        }
+
+    def test_unknown_json_backend(self):
+        with pytest.raises(ValueError):
+            serialization.set_json_backend('no such backend')
+
+    def test_iter_json_document(self):
+        dl = {
+            'id': array([1, 2, 3, 4, 5]),
+            'label': masked_array(data=['a', 'b', 'c', 'd', 'e'],
+                                  mask=[False, True, False, False, True]),
+            'val': array([0.5, 1.5, 2.5, 3.5, 4.5]),
+        }
+        links = {'url': 'http://localhost/foo'}
+
+        chunks = list(serialization.iter_json_document(links, dl, chunk_rows=2))
+        doc = json.loads(b''.join(chunks).decode('utf-8'))
+
+        # header, 3 chunks of rows and footer
+        assert len(chunks) == 5
+        assert doc == {
+            'links': links,
+            'data': [
+                {'id': 1, 'label': 'a', 'val': 0.5},
+                {'id': 2, 'label': None, 'val': 1.5},
+                {'id': 3, 'label': 'c', 'val': 2.5},
+                {'id': 4, 'label': 'd', 'val': 3.5},
+                {'id': 5, 'label': None, 'val': 4.5},
+            ],
+            'data_length': 5,
+        }
+
+    def test_iter_json_document_empty(self):
+        chunks = serialization.iter_json_document({}, {})
+        doc = json.loads(b''.join(chunks).decode('utf-8'))
+
+        assert doc == {'links': {}, 'data': [], 'data_length': 0}
+
+    def test_large_results_are_streamed(self, client, mock_db, monkeypatch):
+        query_result = {
+            'execution_id': array([1, 2, 3]),
+            'tag': array([7, 8, 9]),
+        }
+        mock_db.execute_query.return_value = query_result
+
+        expected = client.simulate_get('/executions/1/statements').json
+
+        monkeypatch.setattr(serialization, 'STREAMING_THRESHOLD', 2)
+        monkeypatch.setattr(serialization, 'CHUNK_ROWS', 2)
+        response = client.simulate_get('/executions/1/statements')
+
+        assert response.json == expected
+        assert response.status == falcon.HTTP_OK
+
+    def test_arrow_stream(self, client, mock_db):
+        pyarrow = pytest.importorskip('pyarrow')
+        query_result = {
+            'pc': array([1, 2, 3]),
+            'short_statement': array(['X_1:=inst_a(x, y)', 'X_2:=inst_b(z)', 'X_3:=inst_c()'], dtype=object),
+            'mal_module': masked_array(data=['mod_a', 'mod_a', 'mod_c'],
+                                       mask=[False, True, False]),
+        }
+        mock_db.execute_query.return_value = query_result
+
+        response = client.simulate_get('/executions/1/statements',
+                                       headers={'Accept': serialization.ARROW_STREAM_MEDIA_TYPE})
+
+        table = pyarrow.ipc.open_stream(response.content).read_all()
+        assert response.status == falcon.HTTP_OK
+        assert response.headers['content-type'] == serialization.ARROW_STREAM_MEDIA_TYPE
+        assert table.to_pydict() == {
+            'pc': [1, 2, 3],
+            'short_statement': ['X_1:=inst_a(x, y)', 'X_2:=inst_b(z)', 'X_3:=inst_c()'],
+            'mal_module': ['mod_a', None, 'mod_c'],
+        }
+        assert table.schema.metadata[b'url'] == b'http://falconframework.org/executions/1/statements'
+
+    def test_arrow_stream_next_page(self, client, mock_db):
+        pyarrow = pytest.importorskip('pyarrow')
+        mock_db.execute_query.return_value = {
+            'query_id': array([1, 2, 3]),
+        }
+
+        response = client.simulate_get('/queries', query_string='limit=2',
+                                        headers={'Accept': serialization.ARROW_STREAM_MEDIA_TYPE})
+
+        table = pyarrow.ipc.open_stream(response.content).read_all()
+        assert table.to_pydict() == {'query_id': [1, 2]}
+        assert response.headers['link'] == '<http://falconframework.org/queries?limit=2&after=2>; rel="next"'
+
+    def test_arrow_stream_not_found(self, client, mock_db):
+        mock_db.execute_query.return_value = {'pc': array([], dtype=int)}
+
+        response = client.simulate_get('/executions/1/statements',
+                                       headers={'Accept': serialization.ARROW_STREAM_MEDIA_TYPE})
+
+        assert response.status == falcon.HTTP_NOT_FOUND
+        assert response.headers['content-type'] == serialization.JSON_MEDIA_TYPE
+
+    def test_arrow_stream_several_results(self, client, mock_db):
+        pytest.importorskip('pyarrow')
+        mock_db.execute_query.return_value = {'query_id': array([1, 1])}
+
+        response = client.simulate_get('/queries/1', headers={'Accept': serialization.ARROW_STREAM_MEDIA_TYPE})
+
+        assert response.status == falcon.HTTP_INTERNAL_SERVER_ERROR
+        assert response.headers['content-type'] == serialization.JSON_MEDIA_TYPE
+        assert response.json['error'] == "Expecting single result, but got 2."
+
+    def test_json_is_the_default(self, client, mock_db):
+        mock_db.execute_query.return_value = {'query_id': array([1])}
+
+        response = client.simulate_get('/queries', headers={'Accept': '*/*'})
+
+        assert response.json['data'] == [{'query_id': 1}]
+
+    def test_arrow_stream_unavailable(self, client, mock_db, monkeypatch):
+        monkeypatch.setattr(serialization, 'pyarrow', None)
+
+        response = client.simulate_get('/executions/1/statements',
+                                       headers={'Accept': serialization.ARROW_STREAM_MEDIA_TYPE})
+
+        mock_db.execute_query.assert_not_called()
+        assert response.status == falcon.HTTP_NOT_ACCEPTABLE
@@ -4,9 +4,21 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 #
 # Copyright MonetDB Solutions B.V. 2018-2019
+import fcntl
+import io
+import json
+import tarfile
+import threading
+import time
 from unittest.mock import call
 
 import falcon
+from falcon import testing
+from mal_analytics.profiler_parser import ProfilerObjectParser
+from numpy import array
+import pytest
+
+from marvin_backend import marvin_backend, traces
 
 
 class TestTraceEndpoints(object):
@@ -47,3 +59,328 @@ class TestTraceEndpoints(object):
 
         mock_db.parse_trace.assert_called_with("")
         assert response.status == falcon.HTTP_BAD_REQUEST
+
+    def test_upload_updates_closures(self, client, mock_db):
+        mock_db.execute_query.return_value = {
+            'max_query_id': array([4]),
+            'max_initiates_id': array([9]),
+            'max_heartbeat_id': array([30]),
+            'max_execution_id': array([50]),
+            'query_id': array([]),
+            'server_session': array([]),
+            'start_t': array([]),
+            'end_t': array([]),
+        }
+
+        response = client.simulate_post('/traces', body=b'{}')
+
+        mock_db.execute_query.assert_any_call(
+            "SELECT query_id FROM query WHERE query_id > %(max_query_id)s",
+            {'max_query_id': 4, 'max_initiates_id': 9})
+        assert response.status == falcon.HTTP_CREATED
+
+    def test_upload_updates_rollups(self, client, mock_db):
+        mock_db.execute_query.return_value = {
+            'max_query_id': array([4]),
+            'max_initiates_id': array([9]),
+            'max_heartbeat_id': array([30]),
+            'max_execution_id': array([50]),
+            'query_id': array([]),
+            'server_session': array(['s1']),
+            'start_t': array([59000000]),
+            'end_t': array([61000000]),
+        }
+
+        response = client.simulate_post('/traces', body=b'{}')
+
+        mock_db.execute_query.assert_any_call(
+            "SELECT server_session, min(ctime) AS start_t, max(ctime) AS end_t FROM heartbeat WHERE heartbeat_id > %(max_heartbeat_id)s GROUP BY server_session",
+            {'max_heartbeat_id': 30})
+        assert response.status == falcon.HTTP_CREATED
+
+    def test_failed_upload_does_not_update_closures(self, client, mock_db):
+        mock_db.parse_trace.side_effect = Exception
+        mock_db.execute_query.return_value = {
+            'max_query_id': array([4]),
+            'max_initiates_id': array([9]),
+            'max_heartbeat_id': array([30]),
+            'max_execution_id': array([50]),
+        }
+
+        response = client.simulate_post('/traces', body=b'{}')
+
+        # Only the limits of every hook before parsing were queried
+        assert mock_db.execute_query.call_count == 3
+        assert response.status == falcon.HTTP_BAD_REQUEST
+
+
+class TestAsyncTraceEndpoints(object):
+    @pytest.fixture
+    def async_client(self, mock_db, tmp_path):
+        api = marvin_backend.create_app(mock_db, spool_dir=str(tmp_path))
+        return testing.TestClient(api)
+
+    def wait_for(self, client, url):
+        for _ in range(100):
+            response = client.simulate_get(url)
+            if response.json['data']['status'] in ('done', 'failed'):
+                return response
+            time.sleep(0.05)
+        raise AssertionError("The job did not finish")
+
+    def test_upload_trace(self, async_client, mock_db, tmp_path):
+        trace = b'{\n"event": 1\n}\n{\n"event": 2\n}\n'
+        mock_db.create_parser.return_value.get_data.return_value = {
+            'heartbeat': {'heartbeat_id': [1, 2], 'ctime': [10, 20]},
+            'cpuload': {'cpuload_id': [1], 'val': [0.5]},
+        }
+
+        response = async_client.simulate_post('/traces', body=trace)
+
+        assert response.status == falcon.HTTP_ACCEPTED
+        job_id = response.json['data']['job_id']
+        assert response.headers['location'] == response.json['links']['status']
+        assert response.headers['location'].endswith('/traces/{}'.format(job_id))
+        assert response.json['data']['bytes'] == len(trace)
+
+        status = self.wait_for(async_client, '/traces/{}'.format(job_id))
+        assert status.json['data']['status'] == 'done'
+        assert status.json['data']['rows'] == {'heartbeat': 2, 'cpuload': 1}
+        mock_db.create_parser.return_value.parse_trace_stream.assert_called_with([{'event': 1}, {'event': 2}])
+        mock_db.insert_data.assert_has_calls([
+            call('heartbeat', {'heartbeat_id': [1, 2], 'ctime': [10, 20]}),
+            call('cpuload', {'cpuload_id': [1], 'val': [0.5]}),
+        ], any_order=True)
+        mock_db.commit.assert_called_once_with()
+        # The spooled trace is removed, the status is kept
+        assert [p.name for p in tmp_path.iterdir()] == ['{}.json'.format(job_id)]
+
+    def test_upload_wrong_trace(self, async_client, mock_db):
+        mock_db.create_parser.return_value.get_data.return_value = {'heartbeat': {'heartbeat_id': [1]}}
+        mock_db.insert_data.side_effect = Exception("bad trace")
+
+        response = async_client.simulate_post('/traces', body=b'{\n"event": 1\n}\n')
+        status = self.wait_for(async_client, '/traces/{}'.format(response.json['data']['job_id']))
+
+        assert status.json['data']['status'] == 'failed'
+        assert status.json['data']['error'] == ['bad trace']
+        mock_db.rollback.assert_called_once_with()
+        mock_db.commit.assert_not_called()
+
+    def test_jobs_left_behind(self, mock_db, tmp_path):
+        queued, running = 'a' * 32, 'b' * 32
+        for job_id, status in [(queued, 'queued'), (running, 'running')]:
+            (tmp_path / '{}.json'.format(job_id)).write_text(json.dumps({'job_id': job_id, 'status': status}))
+            (tmp_path / '{}.trace'.format(job_id)).write_bytes(b'{"event": 1}\n')
+        mock_db.create_parser.return_value.get_data.return_value = {'heartbeat': {'heartbeat_id': [1]}}
+        client = testing.TestClient(marvin_backend.create_app(mock_db, spool_dir=str(tmp_path)))
+
+        # The queued job is ingested, the interrupted one has failed
+        assert self.wait_for(client, '/traces/{}'.format(queued)).json['data']['status'] == 'done'
+        status = client.simulate_get('/traces/{}'.format(running)).json['data']
+        assert status['status'] == 'failed'
+        assert sorted(p.name for p in tmp_path.iterdir()) == ['{}.json'.format(queued), '{}.json'.format(running)]
+
+    def test_jobs_of_running_processes(self, mock_db, tmp_path):
+        job_id = 'a' * 32
+        (tmp_path / '{}.json'.format(job_id)).write_text(json.dumps({'job_id': job_id, 'status': 'queued'}))
+        (tmp_path / '{}.trace'.format(job_id)).write_bytes(b'{"event": 1}\n')
+        # Another process owns the job
+        with open(str(tmp_path / '{}.lock'.format(job_id)), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            client = testing.TestClient(marvin_backend.create_app(mock_db, spool_dir=str(tmp_path)))
+
+            assert client.simulate_get('/traces/{}'.format(job_id)).json['data']['status'] == 'queued'
+        mock_db.create_parser.assert_not_called()
+
+    def test_unknown_job(self, async_client):
+        for job_id in ['0' * 32, '..']:
+            response = async_client.simulate_get('/traces/{}'.format(job_id))
+            assert response.status == falcon.HTTP_NOT_FOUND
+
+
+class TestStreamingIngest(object):
+    def test_iter_events(self):
+        trace = '{"a": 1}\n{\n"b": "éè"\n}\n{"c": 3}'.encode('utf-8')
+        # Split in every possible way, including inside multi-byte characters
+        for size in range(1, len(trace) + 1):
+            blocks = [trace[i:i + size] for i in range(0, len(trace), size)]
+            assert list(traces.iter_events(blocks)) == [{"a": 1}, {"b": "éè"}, {"c": 3}]
+
+    def test_read_blocks(self):
+        stream = io.BytesIO(b'x' * 10)
+        assert list(traces.read_blocks(stream, 7, block_size=3)) == [b'xxx', b'xxx', b'x']
+        stream = io.BytesIO(b'x' * 10)
+        assert list(traces.read_blocks(stream, None, block_size=4)) == [b'xxxx', b'xxxx', b'xx']
+
+    def test_load_trace_stream_batches(self, mock_db):
+        parser = mock_db.create_parser.return_value
+        batches = list()
+        parser.parse_trace_stream.side_effect = lambda batch: batches.append(batch)
+        # The same variable is seen again in the second batch
+        parser.get_data.side_effect = [
+            {'mal_variable': {'variable_id': [1, 2], 'name': ['X_1', 'X_2']}},
+            {'mal_variable': {'variable_id': [2, 3], 'name': ['X_2', 'X_3']}},
+        ]
+
+        rows = traces.load_trace_stream(mock_db, ({'event': i} for i in range(3)), batch_events=2)
+
+        assert batches == [[{'event': 0}, {'event': 1}], [{'event': 2}]]
+        mock_db.insert_data.assert_has_calls([
+            call('mal_variable', {'variable_id': [1, 2], 'name': ['X_1', 'X_2']}),
+            call('mal_variable', {'variable_id': [3], 'name': ['X_3']}),
+        ])
+        assert rows == {'mal_variable': 3}
+        mock_db.drop_constraints.assert_called_once_with()
+        mock_db.add_constraints.assert_called_once_with()
+        mock_db.commit.assert_called_once_with()
+
+    def test_load_trace_stream_across_batches(self, mock_db):
+        def event(pc, function, short):
+            module, instruction = function.split('.')
+            return {'source': 'trace', 'session': 's1', 'tag': 1, 'pc': pc, 'state': 'start',
+                    'function': 'user.main', 'module': module, 'instruction': instruction,
+                    'short': short, 'prereq': []}
+
+        # The call of user.s1_0 refers to the execution of the first
+        # batch
+        events = [
+            event(1, 'querylog.define', 'define("select 1;":str, "default_pipe":str, 10:int);'),
+            event(2, 'sql.mvc', 'X_1:int := sql.mvc();'),
+            event(3, 'user.s1_0', 'user.s1_0();'),
+        ]
+        mock_db.create_parser.return_value = ProfilerObjectParser()
+        inserted = dict()
+        mock_db.insert_data.side_effect = lambda table, data: inserted.setdefault(table, []).extend(
+            data[next(iter(data))])
+
+        rows = traces.load_trace_stream(mock_db, events, batch_events=2)
+
+        assert rows['mal_execution'] == 1
+        assert rows['profiler_event'] == 3
+        assert rows['query'] == 1
+        assert inserted['mal_execution'] == [1]
+        assert inserted['profiler_event'] == [1, 2, 3]
+        mock_db.commit.assert_called_once_with()
+
+    def test_chunked_upload(self, client, mock_db):
+        mock_db.create_parser.return_value.get_data.return_value = {'heartbeat': {'heartbeat_id': [1]}}
+        mock_db.execute_query.return_value = None
+
+        response = client.simulate_post(
+            '/traces',
+            body=b'{"event": 1}\n{"event": 2}\n',
+            headers={'Transfer-Encoding': 'chunked'}
+        )
+
+        mock_db.parse_trace.assert_not_called()
+        mock_db.create_parser.return_value.parse_trace_stream.assert_called_with([{'event': 1}, {'event': 2}])
+        mock_db.insert_data.assert_called_with('heartbeat', {'heartbeat_id': [1]})
+        assert response.status == falcon.HTTP_CREATED
+
+    def test_chunked_upload_bad_json(self, client, mock_db):
+        mock_db.execute_query.return_value = None
+
+        response = client.simulate_post(
+            '/traces',
+            body=b'{"event": 1}\n{"event": }\n',
+            headers={'Transfer-Encoding': 'chunked'}
+        )
+
+        mock_db.rollback.assert_called_once_with()
+        mock_db.commit.assert_not_called()
+        assert response.status == falcon.HTTP_BAD_REQUEST
+
+
+class TestIngestLock(object):
+    def test_processes_are_serialized(self, tmp_path):
+        path = str(tmp_path / 'ingest.lock')
+        # Two processes, as far as flock is concerned
+        first, second = traces.IngestLock(path), traces.IngestLock(path)
+        events = list()
+
+        def ingest():
+            with second:
+                events.append('second')
+
+        with first:
+            thread = threading.Thread(target=ingest)
+            thread.start()
+            thread.join(0.2)
+            events.append('first')
+        thread.join()
+
+        assert events == ['first', 'second']
+
+
+class TestBatchTraceEndpoints(object):
+    def tar_archive(self, files):
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode='w:gz') as archive:
+            for name, content in files:
+                info = tarfile.TarInfo(name)
+                info.size = len(content)
+                archive.addfile(info, io.BytesIO(content))
+        return buf.getvalue()
+
+    def mock_parser(self, mock_db):
+        # Every trace adds one row per event to the event table
+        data = {'profiler_event': {'event_id': []}}
+        parser = mock_db.create_parser.return_value
+        parser.get_data.return_value = data
+        parser.parse_trace_stream.side_effect = lambda events: data['profiler_event']['event_id'].extend(range(len(events)))
+        mock_db.execute_query.return_value = None
+        return parser
+
+    def test_upload_tar(self, client, mock_db):
+        parser = self.mock_parser(mock_db)
+        body = self.tar_archive([
+            ('first.json', b'{"event": 1}\n{"event": 2}\n'),
+            ('broken.json', b'{"event": \n'),
+            ('second.json', b'{\n"event": 3\n}\n'),
+        ])
+
+        response = client.simulate_post('/traces/batch', body=body, headers={'content-type': 'application/x-tar'})
+
+        assert response.status == falcon.HTTP_CREATED
+        assert parser.parse_trace_stream.call_args_list == [
+            call([{'event': 1}, {'event': 2}]),
+            call([{'event': 3}]),
+        ]
+        results = response.json['data']
+        assert [r['name'] for r in results] == ['first.json', 'broken.json', 'second.json']
+        assert [r['status'] for r in results] == ['ok', 'failed', 'ok']
+        assert results[0]['rows'] == {'profiler_event': 2}
+        assert results[2]['rows'] == {'profiler_event': 1}
+        # One bulk insert for the whole batch
+        mock_db.insert_data.assert_called_once_with('profiler_event', {'event_id': [0, 1, 0]})
+        mock_db.commit.assert_called_once_with()
+
+    def test_upload_ndjson(self, client, mock_db):
+        parser = self.mock_parser(mock_db)
+        body = b'{"name": "a", "events": [{"event": 1}]}\n{"name": "b", "trace": "{\\"event\\": 2}\\n"}\n'
+
+        response = client.simulate_post('/traces/batch', body=body, headers={'content-type': 'application/x-ndjson'})
+
+        assert response.status == falcon.HTTP_CREATED
+        assert parser.parse_trace_stream.call_args_list == [
+            call([{'event': 1}]),
+            call([{'event': 2}]),
+        ]
+        assert response.json['data_length'] == 2
+
+    def test_upload_failing_batch(self, client, mock_db):
+        parser = self.mock_parser(mock_db)
+        parser.parse_trace_stream.side_effect = Exception("Missing session")
+
+        response = client.simulate_post('/traces/batch', body=b'{"name": "a", "events": [{}]}\n',
+                                        headers={'content-type': 'application/x-ndjson'})
+
+        assert response.status == falcon.HTTP_BAD_REQUEST
+        assert response.json['error'] == ['Missing session']
+        mock_db.insert_data.assert_not_called()
+
+    def test_upload_unsupported_envelope(self, client, mock_db):
+        response = client.simulate_post('/traces/batch', body=b'{}', headers={'content-type': 'text/plain'})
+
+        assert response.status == falcon.HTTP_UNSUPPORTED_MEDIA_TYPE
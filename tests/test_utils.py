@@ -4,6 +4,8 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 #
 # Copyright MonetDB Solutions B.V. 2018-2019
+import numpy as np
+
 from marvin_backend import utils
 
 
@@ -19,3 +21,55 @@ class TestUtils(object):
 
         d = utils.LDtoDL(ld)
         assert d == {'key1': [1, 2], 'key2': ['a', 'b']}
+
+    def test_page_sql(self):
+        page = utils.Page(10, 42)
+
+        sql = page.sql('heartbeat', 'heartbeat_id', ["server_session=%(sid)s"])
+        assert sql == "SELECT * FROM heartbeat WHERE server_session=%(sid)s AND heartbeat_id > %(after)s ORDER BY heartbeat_id LIMIT %(limit)s"
+        assert page.params({'sid': 'abc'}) == {'sid': 'abc', 'limit': 11, 'after': 42}
+
+    def test_bfs_order(self):
+        g = utils.SimpleGraph([1, 1, 2, 3, 5], [1, 2, 3, 4, 5])
+
+        assert g.bfs(1) == [1, 2, 3, 4]
+        assert g.bfs(3) == [3, 4]
+        assert g.bfs(5) == [5]
+
+    def test_bfs_visits_nodes_once(self):
+        # 1 -> {3, 2} -> 4 -> 1
+        g = utils.SimpleGraph.from_edges([(1, 3), (1, 2), (2, 4), (3, 4), (4, 1)])
+
+        assert g.bfs(1) == [1, 3, 2, 4]
+
+    def test_bfs_no_edges(self):
+        g = utils.SimpleGraph([], [])
+
+        assert g.bfs(7) == [7]
+
+    def test_bfs_matches_naive_search(self):
+        rng = np.random.RandomState(42)
+        tails = rng.randint(0, 200, 600)
+        heads = rng.randint(0, 200, 600)
+        g = utils.SimpleGraph(tails, heads)
+
+        for start in range(0, 200, 17):
+            reachable = {start}
+            frontier = [start]
+            while frontier:
+                frontier = [h for t, h in zip(tails, heads) if t in frontier and h not in reachable]
+                reachable.update(frontier)
+
+            result = g.bfs(start)
+            assert len(result) == len(set(result))
+            assert set(result) == reachable
+
+    def test_find_query_execution_ids(self):
+        relation = {
+            "parent_id": np.array([10, 10, 20, 30]),
+            "child_id": np.array([20, 30, 40, 50]),
+        }
+
+        ids = utils.find_query_execution_ids({'root_execution_id': np.array([10])}, relation)
+        assert ids == [10, 20, 30, 40, 50]
+        assert all(type(i) is int for i in ids)
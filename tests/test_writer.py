@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright MonetDB Solutions B.V. 2018-2019
+import gzip
+import json
+import threading
+import time
+from unittest.mock import MagicMock
+
+import falcon
+from falcon import testing
+from numpy import array
+import pytest
+
+from marvin_backend import marvin_backend, writer
+
+AUTHKEY = b'secret'
+
+
+@pytest.fixture
+def writer_db():
+    return MagicMock()
+
+
+@pytest.fixture
+def write_server(tmp_path, writer_db):
+    app = marvin_backend.create_app(writer_db, spool_dir=str(tmp_path / 'spool'))
+    server = writer.WriteServer(app, str(tmp_path / 'writer.sock'), AUTHKEY)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield server
+    server.close()
+    thread.join()
+
+
+@pytest.fixture
+def reader_client(mock_db, write_server):
+    router = writer.WriteRouter(marvin_backend.create_app(mock_db),
+                                writer.WriterClient(write_server.address, AUTHKEY))
+    return testing.TestClient(router)
+
+
+class TestIsWrite(object):
+    def test_routes(self):
+        assert writer.is_write('POST', '/traces')
+        assert writer.is_write('POST', '/traces/batch')
+        assert writer.is_write('PATCH', '/queries/1')
+        assert writer.is_write('GET', '/traces/0123')
+        assert not writer.is_write('GET', '/queries/1')
+        assert not writer.is_write('GET', '/tracesx')
+
+
+class TestWriteRouter(object):
+    def test_reads_are_local(self, reader_client, mock_db, writer_db):
+        mock_db.execute_query.return_value = {'query_id': array([1])}
+
+        response = reader_client.simulate_get('/queries')
+
+        assert response.status == falcon.HTTP_OK
+        assert mock_db.execute_query.call_count == 1
+        writer_db.execute_query.assert_not_called()
+
+    def test_label_is_forwarded(self, reader_client, mock_db, writer_db):
+        response = reader_client.simulate_patch('/queries/1', body='{"label": "new"}')
+
+        assert response.status == falcon.HTTP_OK
+        mock_db.execute_query.assert_not_called()
+        writer_db.execute_query.assert_called_once_with(
+            "UPDATE query SET query_label=%(label)s WHERE query_id=%(qid)s", {'label': 'new', 'qid': '1'})
+
+    def test_upload_is_forwarded(self, reader_client, mock_db, writer_db):
+        body = b'{"event": 1}\n' * 20000
+
+        response = reader_client.simulate_post('/traces', body=gzip.compress(body),
+                                               headers={'Content-Encoding': 'gzip'})
+
+        assert response.status == falcon.HTTP_ACCEPTED
+        mock_db.execute_query.assert_not_called()
+
+        # The job is only known to the writer
+        status = reader_client.simulate_get('/traces/{}'.format(response.json['data']['job_id']))
+        assert status.status == falcon.HTTP_OK
+        assert status.json['data']['bytes'] == len(body)
+
+    def test_writer_unavailable(self, mock_db, tmp_path):
+        router = writer.WriteRouter(marvin_backend.create_app(mock_db),
+                                    writer.WriterClient(str(tmp_path / 'missing.sock'), AUTHKEY, connect_timeout=0))
+        client = testing.TestClient(router)
+
+        response = client.simulate_post('/traces', body=b'{}')
+
+        assert response.status == falcon.HTTP_SERVICE_UNAVAILABLE
+        assert json.loads(response.text)['title'] == '503 Service Unavailable'
+
+    def test_writer_starting(self, mock_db, writer_db, tmp_path):
+        address = str(tmp_path / 'writer.sock')
+        router = writer.WriteRouter(marvin_backend.create_app(mock_db),
+                                    writer.WriterClient(address, AUTHKEY, connect_timeout=10))
+        client = testing.TestClient(router)
+        servers = list()
+
+        def start_writer():
+            time.sleep(0.2)
+            servers.append(writer.WriteServer(marvin_backend.create_app(writer_db), address, AUTHKEY))
+            servers[0].serve_forever()
+
+        thread = threading.Thread(target=start_writer)
+        thread.start()
+        try:
+            # Waits for the writer to listen
+            response = client.simulate_patch('/queries/1', body='{"label": "new"}')
+        finally:
+            while not servers:
+                time.sleep(0.05)
+            servers[0].close()
+            thread.join()
+
+        assert response.status == falcon.HTTP_OK
+        writer_db.execute_query.assert_called_once_with(
+            "UPDATE query SET query_label=%(label)s WHERE query_id=%(qid)s", {'label': 'new', 'qid': '1'})
+
+
+def exiting_writer(ready):
+    ready.set()
+
+
+def serving_writer(ready):
+    ready.set()
+    time.sleep(60)
+
+
+class TestWriterProcess(object):
+    def test_restart(self):
+        process = writer.WriterProcess(exiting_writer, check_interval=0.05)
+        assert process.start()
+
+        supervisor = threading.Thread(target=process.supervise)
+        supervisor.start()
+        try:
+            for _ in range(100):
+                if process.restarts >= 2:
+                    break
+                time.sleep(0.05)
+        finally:
+            process.stop()
+            supervisor.join()
+
+        assert process.restarts >= 2
+
+    def test_stop(self):
+        process = writer.WriterProcess(serving_writer)
+        assert process.start()
+        assert process.is_alive()
+
+        process.stop()
+
+        assert not process.is_alive()